@@ -0,0 +1,70 @@
+"""
+Response body encodings for the read endpoints.
+
+- json: rows as a list of objects (the default)
+- columnar: the same JSON with the rows as parallel arrays,
+  {"date": [...], "state": [...], ...}, so keys are not repeated per row
+- arrow: the rows as an Arrow IPC stream; the other fields of a response
+  (total, next_cursor, ...) are JSON values in the schema metadata
+
+Both columnar encodings load into a DataFrame without per-row objects:
+pd.DataFrame(body) or pyarrow.ipc.open_stream(body).read_all().to_pandas().
+JSON is written by orjson when it is installed, and arrow needs pyarrow;
+both are optional.
+"""
+import json
+
+from fastapi.encoders import jsonable_encoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+FORMATS = ("json", "columnar", "arrow")
+MEDIA_TYPES = {
+    "json": "application/json",
+    "columnar": "application/json",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+# Same output as FastAPI's default JSONResponse; one encoder serves every call
+_json_encoder = json.JSONEncoder(default=jsonable_encoder, ensure_ascii=False, allow_nan=False,
+                                 separators=(",", ":"))
+
+def dumps(value) -> bytes:
+    """Compact UTF-8 JSON of value; dates as ISO strings"""
+    if orjson is not None:
+        return orjson.dumps(value, default=jsonable_encoder,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return _json_encoder.encode(value).encode("utf-8")
+
+def available(format: str) -> bool:
+    return format != "arrow" or pyarrow is not None
+
+def _arrow(result) -> bytes:
+    # Columns are either the whole result or its "items"
+    if isinstance(result, dict) and "items" in result:
+        columns = result["items"]
+        metadata = {key: dumps(value) for key, value in result.items() if key != "items"}
+    else:
+        columns, metadata = result, None
+    table = pyarrow.table(columns).replace_schema_metadata(metadata)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def encode(result, format: str = "json") -> bytes:
+    """
+    Body of a read endpoint result. For columnar and arrow the result already
+    holds its rows as columns, a dict of equal-length lists.
+    """
+    if format == "arrow":
+        return _arrow(result)
+    return dumps(result)
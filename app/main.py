@@ -1,38 +1,108 @@
-from fastapi import FastAPI, Depends, UploadFile, File, HTTPException
+from fastapi import FastAPI, Depends, UploadFile, File, HTTPException, Query, Request, Response
 from dotenv import load_dotenv
 
 load_dotenv()
 from sqlalchemy.orm import Session
-from . import models, database, schemas
-from .services import ingestion, analytics, api_fetcher
+from . import database, encoding, schemas, streaming
+from .response_cache import cached_response, response_cache
+from .services import ingestion, analytics, api_fetcher, jobs, anomalies, singleflight, datasets, partitions, cursors, \
+    downsample, queries
+from datetime import date
 from typing import List, Optional
 from typing import List, Optional
+import shutil
+import tempfile
 
 # Create DB tables
-models.Base.metadata.create_all(bind=database.engine)
+datasets.get(database.DEFAULT_DATASET)
 
 app = FastAPI(title="Aadhar Hackathon API")
 
+# Largest chunk /upload will read into memory at once
+MAX_CHUNK_SIZE = 1_000_000
+# Largest page /anomalies will return
+MAX_ANOMALY_PAGE = 1000
+# Largest page the trend endpoints will return when paginated
+MAX_TREND_PAGE = 10000
+# Most items /rankings returns
+MAX_RANKING_K = 1000
+# Largest page /aggregate returns when paginated
+MAX_AGGREGATE_PAGE = 10000
+
+def _sync_filters(state, district, fetch_all, incremental):
+    filters_msg = []
+    if state:
+        filters_msg.append(f"state={state}")
+    if district:
+        filters_msg.append(f"district={district}")
+    if fetch_all:
+        filters_msg.append("FETCH_ALL=True")
+    if incremental:
+        filters_msg.append("INCREMENTAL=True")
+    return ", ".join(filters_msg)
+
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...), db: Session = Depends(database.get_db)):
+def upload_file(
+    response: Response,
+    file: UploadFile = File(...),
+    chunk_size: int = Query(ingestion.DEFAULT_CHUNK_SIZE, ge=1, le=MAX_CHUNK_SIZE),
+    background: bool = False,
+    defer_indexes: bool = False,
+    dataset: str = database.DEFAULT_DATASET,
+    target: database.Dataset = Depends(database.get_dataset)
+):
+    """
+    Upload a CSV file into a dataset (default: "default"). The spooled upload
+    is streamed into the database in chunks of chunk_size rows, so memory use
+    does not grow with file size. The response carries the record and chunk
+    counts and the load timings.
+    With background=true the file is queued as a job and its id returned at once;
+    poll /jobs/{job_id} for progress.
+    With defer_indexes=true the secondary indexes of the partitions the file
+    writes to are dropped for the load and rebuilt afterwards (bulk-load mode, for large files).
+    """
     if not file.filename.endswith('.csv'):
         raise HTTPException(status_code=400, detail="Invalid file type. Please upload a CSV.")
+
+    if background:
+        # The spooled upload is gone once this request ends, so copy it to disk first
+        with tempfile.NamedTemporaryFile(suffix=".csv", delete=False) as tmp:
+            shutil.copyfileobj(file.file, tmp)
+        job = jobs.submit_upload(tmp.name, file.filename, chunk_size=chunk_size, defer_indexes=defer_indexes,
+                                 dataset=dataset)
+        response.status_code = 202
+        return {"message": f"Upload of {file.filename} queued.", "job_id": job.id}
     
-    content = await file.read()
+    # Per-chunk detail goes to the log; the response only counts chunks, so its size does not grow with the file
+    chunks_processed = 0
+    def on_chunk(chunk_number, chunk_rows, total_rows):
+        nonlocal chunks_processed
+        chunks_processed = chunk_number
+        print(f"Upload {file.filename}: chunk {chunk_number} ingested {chunk_rows} records ({total_rows} total)")
+
+    timings = {}
     try:
-        count = ingestion.process_csv_and_ingest(content, db)
-        return {"message": f"Successfully processed {count} records."}
+        with target.SessionLocal() as db:
+            count = ingestion.process_csv_stream_and_ingest(file.file, db, chunk_size=chunk_size, progress_callback=on_chunk,
+                                                             defer_indexes=defer_indexes, timings=timings)
+        return {"message": f"Successfully processed {count} records.", "records": count,
+                "chunks_processed": chunks_processed, "timings": timings}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/sync-api")
 def sync_from_api(
+    response: Response,
     limit: int = 100, 
     offset: int = 0, 
     state: str = None, 
     district: str = None, 
     fetch_all: bool = False,
-    db: Session = Depends(database.get_db)
+    concurrency: int = api_fetcher.DEFAULT_CONCURRENCY,
+    incremental: bool = False,
+    background: bool = False,
+    dataset: str = database.DEFAULT_DATASET,
+    target: database.Dataset = Depends(database.get_dataset)
 ):
     """
     Sync data from official Aadhar API.
@@ -43,65 +113,431 @@ def sync_from_api(
     - state: Filter by state name (optional)
     - district: Filter by district name (optional)
     - fetch_all: If true, loops through all pages until all data is fetched (ignores limit for pagination loop)
+    - concurrency: Number of pages fetched in parallel when fetch_all is set (default: 4)
+    - incremental: If true, resume from the offset stored for this state/district filter, pulling only records appended since the last sync
+    - background: If true, run the sync as a job and return its id immediately (poll /jobs/{job_id})
+    - dataset: Dataset to sync into (default: "default")
     """
+    filters = _sync_filters(state, district, fetch_all, incremental)
+    if background:
+        job = jobs.submit_sync(filters, dataset=dataset, limit=limit, offset=offset, state=state, district=district,
+                               fetch_all=fetch_all, concurrency=concurrency, incremental=incremental)
+        response.status_code = 202
+        return {"message": "API sync queued.", "job_id": job.id}
+
+    stats = {}
     try:
-        count = api_fetcher.fetch_and_sync_data(db, limit=limit, offset=offset, state=state, district=district, fetch_all=fetch_all)
-        filters_msg = []
-        if state:
-            filters_msg.append(f"state={state}")
-        if district:
-            filters_msg.append(f"district={district}")
-        if fetch_all:
-            filters_msg.append("FETCH_ALL=True")
-            
-        filter_str = f" with filters: {', '.join(filters_msg)}" if filters_msg else ""
-        return {"message": f"Successfully synced {count} records from API{filter_str}."}
+        with target.SessionLocal() as db:
+            count = api_fetcher.fetch_and_sync_data(db, limit=limit, offset=offset, state=state, district=district, fetch_all=fetch_all, concurrency=concurrency, incremental=incremental, stats=stats)
+        filter_str = f" with filters: {filters}" if filters else ""
+        return {"message": f"Successfully synced {count} records from API{filter_str}.", "stages": stats}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/jobs", response_model=List[schemas.JobStatus])
+def list_jobs():
+    """List background upload/sync jobs, newest first"""
+    return [job.to_dict() for job in jobs.job_manager.list()]
+
+@app.get("/jobs/{job_id}", response_model=schemas.JobStatus)
+def get_job(job_id: str):
+    """Get progress of a background job: rows done, rate, ETA and errors"""
+    job = jobs.job_manager.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job.to_dict()
+
+@app.post("/jobs/{job_id}/cancel", response_model=schemas.JobStatus)
+def cancel_job(job_id: str):
+    """Cancel a queued or running job. Chunks already committed are kept."""
+    job = jobs.job_manager.cancel(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job.to_dict()
+
 @app.get("/options/states")
-def get_state_options(db: Session = Depends(database.get_db)):
+def get_state_options(request: Request, db: Session = Depends(database.get_read_db)):
     """Get list of available states"""
-    return analytics.get_unique_states(db)
+    return cached_response(request, db, "options/states", {}, lambda: analytics.get_unique_states(db))
 
 @app.get("/options/districts")
-def get_district_options(state: Optional[str] = None, db: Session = Depends(database.get_db)):
+def get_district_options(request: Request, state: Optional[str] = None, db: Session = Depends(database.get_read_db)):
     """Get list of available districts (optionally filtered by state)"""
-    return analytics.get_unique_districts(db, state)
+    return cached_response(request, db, "options/districts", {"state": state},
+                           lambda: analytics.get_unique_districts(db, state))
 
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the Aadhar Hackathon API"}
 
 # Analytics Endpoints
+# Every data endpoint takes ?dataset=<name> (default: "default"), and the
+# aggregate endpoints (/aggregate and the summary, age comparison, trends and
+# rankings built on it) any of the filters state, district, pincode (a prefix)
+# and an inclusive start_date / end_date range; /anomalies takes state,
+# district and the date range.
+# Responses are cached until the data changes and carry an ETag (see response_cache.py).
+# They read through the read-only pool, so they are served while an ingest holds the writer.
+
+def _check_pincode(pincode: Optional[str]):
+    if pincode is not None and not pincode.isdigit():
+        raise HTTPException(status_code=400, detail="pincode must be the digits a pincode starts with.")
 
 @app.get("/summary", response_model=schemas.SummaryStats)
-def get_summary(db: Session = Depends(database.get_db)):
-    return analytics.get_overall_summary(db)
+def get_summary(request: Request, state: Optional[str] = None, district: Optional[str] = None,
+                pincode: Optional[str] = None, start_date: Optional[date] = None, end_date: Optional[date] = None,
+                db: Session = Depends(database.get_read_db)):
+    """Enrolment totals and the top state, optionally of one state, district, pincode prefix or date range"""
+    _check_pincode(pincode)
+    filters = {"state": state, "district": district, "pincode": pincode, "start_date": start_date,
+               "end_date": end_date}
+    return cached_response(request, db, "summary", filters, lambda: analytics.get_overall_summary(db, **filters))
+
+def _check_format(format: str):
+    formats = encoding.FORMATS + streaming.FORMATS
+    if format not in formats:
+        raise HTTPException(status_code=400, detail=f"Unknown format. Use one of: {', '.join(formats)}.")
+    if not encoding.available(format):
+        raise HTTPException(status_code=400, detail=f"format={format} needs pyarrow installed on the server.")
+
+def _trend_after(limit: Optional[int], cursor: Optional[str]):
+    # Keyset (date, name) of a trend page cursor, or None
+    if limit is not None and not 1 <= limit <= MAX_TREND_PAGE:
+        raise HTTPException(status_code=400, detail=f"limit must be 1-{MAX_TREND_PAGE}.")
+    return _cursor_keys(cursor, (date.fromisoformat, str))
+
+def _cursor_keys(cursor: Optional[str], types):
+    if cursor is None:
+        return None
+    try:
+        return cursors.decode(cursor, types)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _check_resampling(granularity: str, max_points: Optional[int], limit: Optional[int], cursor: Optional[str],
+                      format: str):
+    if granularity not in analytics.GRANULARITIES:
+        raise HTTPException(status_code=400,
+                            detail=f"Unknown granularity. Use one of: {', '.join(analytics.GRANULARITIES)}.")
+    if max_points is None:
+        return
+    if max_points < downsample.MIN_POINTS:
+        raise HTTPException(status_code=400, detail=f"max_points must be at least {downsample.MIN_POINTS}.")
+    if limit is not None or cursor is not None or format in streaming.FORMATS:
+        # Downsampling looks at whole series, which pages and streams cut up
+        raise HTTPException(status_code=400, detail="max_points cannot be combined with limit, cursor or streaming.")
+
+def _trend_page(result, limit: Optional[int], keys, as_columns: bool):
+    # Without limit, every point; with it, one page and the cursor of the next,
+    # the values of keys in its last point
+    if limit is None:
+        return result
+    if as_columns:
+        count = len(next(iter(result.values()))) if result else 0
+        items = {name: values[:limit] for name, values in result.items()}
+        last = {name: values[limit - 1] for name, values in result.items()} if count > limit else None
+    else:
+        count, items = len(result), result[:limit]
+        last = result[limit - 1] if count > limit else None
+    following = cursors.encode(*[last[key] for key in keys]) if last else None
+    return {"items": items, "limit": limit, "next_cursor": following}
 
 @app.get("/trends/state")
-def get_trends_state(state: Optional[str] = None, db: Session = Depends(database.get_db)):
-    return analytics.get_trends_by_state(db, state)
+def get_trends_state(request: Request, state: Optional[str] = None, start_date: Optional[date] = None,
+                     end_date: Optional[date] = None, limit: Optional[int] = None, cursor: Optional[str] = None,
+                     format: str = "json", granularity: str = "day", max_points: Optional[int] = None,
+                     district: Optional[str] = None, pincode: Optional[str] = None,
+                     db: Session = Depends(database.get_read_db)):
+    """
+    Enrolments per state and day, in (date, state) order.
+
+    - limit: return pages of at most this many points as {items, limit, next_cursor}
+    - cursor: the next_cursor of the previous page
+    - format: json (default); columnar (parallel arrays) or arrow (Arrow IPC);
+      or ndjson / csv to stream every point after cursor
+    - granularity: day (default), week or month; points are then the sums
+      over each week (dated by its Monday) or month (dated by its 1st)
+    - max_points: keep at most this many points of each state's series,
+      chosen to preserve its shape (LTTB); not with limit, cursor or streaming
+    - state / district / pincode: count only the records of one state,
+      district or pincode prefix (optional)
+    """
+    _check_format(format)
+    _check_resampling(granularity, max_points, limit, cursor, format)
+    _check_pincode(pincode)
+    after = _trend_after(limit, cursor)
+    if format in streaming.FORMATS:
+        return streaming.stream_rows(
+            db, lambda session: analytics.iter_trends_by_state(session, state, start_date, end_date, after,
+                                                               granularity, district, pincode),
+            analytics.STATE_TREND_COLUMNS, format)
+    as_columns = format != "json"
+    return cached_response(request, db, "trends/state",
+                           {"state": state, "district": district, "pincode": pincode, "start_date": start_date,
+                            "end_date": end_date, "limit": limit, "cursor": cursor, "granularity": granularity,
+                            "max_points": max_points},
+                           lambda: _trend_page(analytics.get_trends_by_state(
+                               db, state, start_date, end_date, limit + 1 if limit else None, after, as_columns,
+                               granularity, max_points, district, pincode),
+                               limit, ("date", "state"), as_columns),
+                           format)
 
 @app.get("/trends/district")
-def get_trends_district(district: Optional[str] = None, db: Session = Depends(database.get_db)):
-    return analytics.get_trends_by_district(db, district)
+def get_trends_district(request: Request, district: Optional[str] = None, start_date: Optional[date] = None,
+                        end_date: Optional[date] = None, limit: Optional[int] = None, cursor: Optional[str] = None,
+                        format: str = "json", granularity: str = "day", max_points: Optional[int] = None,
+                        state: Optional[str] = None, pincode: Optional[str] = None,
+                        db: Session = Depends(database.get_read_db)):
+    """
+    Enrolments per district and day, in (date, district) order; limit,
+    cursor, format, granularity, max_points and the filters as for
+    /trends/state. A district name shared by two states is summed unless
+    state is given.
+    """
+    _check_format(format)
+    _check_resampling(granularity, max_points, limit, cursor, format)
+    _check_pincode(pincode)
+    after = _trend_after(limit, cursor)
+    if format in streaming.FORMATS:
+        return streaming.stream_rows(
+            db, lambda session: analytics.iter_trends_by_district(session, district, start_date, end_date, after,
+                                                                  granularity, state, pincode),
+            analytics.DISTRICT_TREND_COLUMNS, format)
+    as_columns = format != "json"
+    return cached_response(request, db, "trends/district",
+                           {"district": district, "state": state, "pincode": pincode, "start_date": start_date,
+                            "end_date": end_date, "limit": limit, "cursor": cursor, "granularity": granularity,
+                            "max_points": max_points},
+                           lambda: _trend_page(analytics.get_trends_by_district(
+                               db, district, start_date, end_date, limit + 1 if limit else None, after, as_columns,
+                               granularity, max_points, state, pincode),
+                               limit, ("date", "district"), as_columns),
+                           format)
+
+@app.get("/rankings")
+def get_rankings(request: Request, level: str = "state", by: str = "total", k: int = 10,
+                 state: Optional[str] = None, district: Optional[str] = None, start_date: Optional[date] = None,
+                 end_date: Optional[date] = None, format: str = "json", pincode: Optional[str] = None,
+                 db: Session = Depends(database.get_read_db)):
+    """
+    The top k states, districts or pincodes, largest first.
+
+    - level: state (default), district or pincode
+    - by: total (default), age_0_5, age_5_17 or age_17_plus
+    - k: how many, at most 1000
+    - state / district / pincode: count only the records of one state,
+      district or pincode prefix (optional)
+    - start_date / end_date: count only an inclusive date range (optional)
+    - format: json (default), columnar or arrow
+    """
+    if level not in analytics.RANKING_LEVELS:
+        raise HTTPException(status_code=400, detail=f"Unknown level. Use one of: {', '.join(analytics.RANKING_LEVELS)}.")
+    if by not in analytics.RANKING_MEASURES:
+        raise HTTPException(status_code=400, detail=f"Unknown measure. Use one of: {', '.join(analytics.RANKING_MEASURES)}.")
+    if not 1 <= k <= MAX_RANKING_K:
+        raise HTTPException(status_code=400, detail=f"k must be 1-{MAX_RANKING_K}.")
+    _check_pincode(pincode)
+    _check_format(format)
+    if format in streaming.FORMATS:
+        raise HTTPException(status_code=400, detail=f"Rankings are not streamed. Use one of: {', '.join(encoding.FORMATS)}.")
+    return cached_response(request, db, "rankings",
+                           {"level": level, "by": by, "k": k, "state": state, "district": district,
+                            "pincode": pincode, "start_date": start_date, "end_date": end_date},
+                           lambda: analytics.get_rankings(db, level, by, k, state, district, start_date, end_date,
+                                                          format != "json", pincode),
+                           format)
 
 @app.get("/age-comparison")
-def get_age_comparison(db: Session = Depends(database.get_db)):
-    return analytics.get_age_comparison(db)
+def get_age_comparison(request: Request, state: Optional[str] = None, district: Optional[str] = None,
+                       pincode: Optional[str] = None, start_date: Optional[date] = None,
+                       end_date: Optional[date] = None, db: Session = Depends(database.get_read_db)):
+    """Enrolments per age bucket, with the filters of /summary"""
+    _check_pincode(pincode)
+    filters = {"state": state, "district": district, "pincode": pincode, "start_date": start_date,
+               "end_date": end_date}
+    return cached_response(request, db, "age-comparison", filters, lambda: analytics.get_age_comparison(db, **filters))
+
+def _names(value: str) -> tuple:
+    # Comma-separated query parameter as a tuple of names
+    return tuple(name.strip() for name in value.split(",") if name.strip())
+
+@app.get("/aggregate")
+def get_aggregate(request: Request, group_by: str = "", measures: str = "total", state: Optional[str] = None,
+                  district: Optional[str] = None, pincode: Optional[str] = None, start_date: Optional[date] = None,
+                  end_date: Optional[date] = None, top: Optional[int] = None, limit: Optional[int] = None,
+                  cursor: Optional[str] = None, format: str = "json", db: Session = Depends(database.get_read_db)):
+    """
+    Sums of measures per group, over the records the filters keep.
+
+    - group_by: comma-separated dimensions, any of date, week, month (at most
+      one of these three), state, district and pincode; none gives one total
+    - measures: comma-separated, any of records (the number of records),
+      total (default), age_0_5, age_5_17 and age_17_plus
+    - state / district / pincode (a prefix) / start_date / end_date: filters
+    - top: only the top groups with the largest first measure, largest first;
+      otherwise groups come in group_by order
+    - limit: return pages of at most this many groups as {items, limit, next_cursor}
+    - cursor: the next_cursor of the previous page
+    - format: json (default); columnar or arrow; or ndjson / csv to stream
+      every group after cursor
+    """
+    group_by, measures = _names(group_by), _names(measures)
+    try:
+        queries.check(group_by, measures)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    _check_pincode(pincode)
+    _check_format(format)
+    if top is not None and not 1 <= top <= MAX_RANKING_K:
+        raise HTTPException(status_code=400, detail=f"top must be 1-{MAX_RANKING_K}.")
+    if limit is not None and not 1 <= limit <= MAX_AGGREGATE_PAGE:
+        raise HTTPException(status_code=400, detail=f"limit must be 1-{MAX_AGGREGATE_PAGE}.")
+    if (limit is not None or cursor is not None) and not group_by:
+        raise HTTPException(status_code=400, detail="limit and cursor need group_by.")
+    if top is not None and (limit is not None or cursor is not None or format in streaming.FORMATS):
+        raise HTTPException(status_code=400, detail="top cannot be combined with limit, cursor or streaming.")
+    after = _cursor_keys(cursor, tuple(date.fromisoformat if d in queries.DATE_DIMENSIONS else str
+                                       for d in group_by))
+    filters = {"state": state, "district": district, "pincode": pincode, "start_date": start_date,
+               "end_date": end_date}
+    if format in streaming.FORMATS:
+        names = group_by + measures
+        return streaming.stream_rows(
+            db, lambda session: (dict(zip(names, row)) for row in queries.iter_aggregate(
+                session, group_by, measures, after=after, **filters)),
+            names, format)
+    as_columns = format != "json"
+    return cached_response(request, db, "aggregate",
+                           {"group_by": group_by, "measures": measures, **filters, "top": top, "limit": limit,
+                            "cursor": cursor},
+                           lambda: _trend_page(analytics.get_aggregate(
+                               db, group_by, measures, top=top, limit=limit + 1 if limit else None, after=after,
+                               as_columns=as_columns, **filters),
+                               limit, group_by, as_columns),
+                           format)
 
 @app.get("/anomalies")
-def get_anomalies(db: Session = Depends(database.get_db)):
-    return analytics.get_anomalies(db)
+def get_anomalies(
+    request: Request,
+    method: str = "combined",
+    limit: int = 50,
+    offset: int = 0,
+    state: Optional[str] = None,
+    district: Optional[str] = None,
+    threshold: int = 10,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    cursor: Optional[str] = None,
+    format: str = "json",
+    db: Session = Depends(database.get_read_db)
+):
+    """
+    Ranked, paginated anomalies, most severe first.
+
+    - method: combined (default), zscore, mad, drop or threshold
+    - limit / offset: page size (at most 1000) and start
+    - cursor: instead of offset, the next_cursor of the previous page
+    - format: json (default); columnar (items as parallel arrays) or arrow
+      (items as Arrow IPC, other fields in its schema metadata); or ndjson /
+      csv to stream every item after cursor (limit and offset do not apply)
+    - state / district: restrict to one state or district (optional)
+    - threshold: for method=threshold, flag raw rows with a total below this
+    - start_date / end_date: restrict to an inclusive date range (optional);
+      method=threshold then reads only the month partitions it touches
+    """
+    if method not in anomalies.METHODS:
+        raise HTTPException(status_code=400, detail=f"Unknown method. Use one of: {', '.join(anomalies.METHODS)}.")
+    _check_format(format)
+    if limit < 1 or limit > MAX_ANOMALY_PAGE or offset < 0:
+        raise HTTPException(status_code=400, detail=f"limit must be 1-{MAX_ANOMALY_PAGE} and offset >= 0.")
+    after = None
+    if cursor is not None:
+        if offset:
+            raise HTTPException(status_code=400, detail="Pass either offset or cursor, not both.")
+        try:
+            after = analytics.anomaly_after(method, cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if format in streaming.FORMATS:
+        return streaming.stream_rows(
+            db, lambda session: analytics.iter_anomalies(session, method, state, district, threshold,
+                                                         start_date, end_date, after),
+            analytics.THRESHOLD_COLUMNS if method == "threshold" else anomalies.ITEM_COLUMNS, format)
+    params = {"method": method, "limit": limit, "offset": offset, "state": state, "district": district,
+              "threshold": threshold if method == "threshold" else None,
+              "start_date": start_date, "end_date": end_date, "cursor": cursor}
+    return cached_response(request, db, "anomalies", params,
+                           lambda: analytics.get_anomalies(db, method, limit, offset, state, district, threshold,
+                                                           start_date, end_date, after, format != "json"),
+                           format)
+
+@app.get("/stats/queries")
+def get_query_stats():
+    """Response cache hits/misses, how many analytics calls were coalesced and how many query statements were reused"""
+    return {
+        "response_cache": response_cache.stats(),
+        "coalescing": singleflight.analytics_flight.stats(),
+        "compiled_queries": queries.stats(),
+    }
 
 @app.delete("/clear-data")
-def clear_all_data(db: Session = Depends(database.get_db)):
-    """Clear all enrolment data from the database"""
+def clear_all_data(dataset: str = database.DEFAULT_DATASET):
+    """
+    Clear all enrolment data from a dataset. The dataset is moved to fresh
+    storage rather than deleted row by row, so this takes constant time. An
+    upload or sync running on the dataset is stopped at its next chunk.
+    """
     try:
-        count = db.query(models.EnrolmentData).delete()
-        db.commit()
-        return {"message": f"Successfully deleted {count} records from database."}
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
+        count = datasets.clear(dataset)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"message": f"Successfully deleted {count} records from database."}
+
+@app.get("/partitions")
+def list_partitions(db: Session = Depends(database.get_read_db)):
+    """Month partitions of a dataset with their record counts, oldest first"""
+    return partitions.list_partitions(db)
+
+@app.delete("/partitions/{month}")
+def drop_partition(month: str, db: Session = Depends(database.get_db)):
+    """
+    Delete every record of one month (YYYY-MM). The month's partition is
+    dropped whole and subtracted from the aggregates, so this takes time in
+    the days and districts the month covers rather than its records.
+    """
+    try:
+        partitions.validate_month(month)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if month not in partitions.months(db):
+        raise HTTPException(status_code=404, detail="No partition for that month.")
+    count = partitions.drop(db, [month])
+    return {"message": f"Dropped {month}: deleted {count} records.", "months": [month]}
+
+@app.delete("/partitions")
+def drop_partitions_before(before: str, db: Session = Depends(database.get_db)):
+    """Retention: delete every month before `before` (YYYY-MM), each by dropping its partition"""
+    try:
+        partitions.validate_month(before)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    dropped = [month for month in partitions.months(db) if month < before]
+    count = partitions.drop(db, dropped) if dropped else 0
+    return {"message": f"Dropped {len(dropped)} months before {before}: deleted {count} records.", "months": dropped}
+
+@app.get("/datasets")
+def list_datasets():
+    """Datasets with their record counts"""
+    return datasets.list_datasets()
+
+@app.delete("/datasets/{name}")
+def remove_dataset(name: str):
+    """Delete a dataset and its storage. The default dataset can only be cleared."""
+    try:
+        database.validate_dataset_name(name)
+        if not database.registry.exists(name):
+            raise HTTPException(status_code=404, detail="Dataset not found.")
+        count = datasets.remove(name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"message": f"Removed dataset {name} with {count} records."}
@@ -1,14 +1,160 @@
-from sqlalchemy import Column, Integer, String, Date, Float
+from sqlalchemy import Column, Integer, String, Date, DateTime, Float, ForeignKey, UniqueConstraint, Index
 from .database import Base
 
+class State(Base):
+    """Dimension: one row per state name"""
+    __tablename__ = "dim_state"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
+
+class District(Base):
+    """Dimension: one row per district name within a state"""
+    __tablename__ = "dim_district"
+    __table_args__ = (UniqueConstraint("state_id", "name"),)
+
+    id = Column(Integer, primary_key=True)
+    state_id = Column(Integer, ForeignKey("dim_state.id"), nullable=False)
+    name = Column(String, nullable=False)
+
+class Pincode(Base):
+    """Dimension: one row per pincode"""
+    __tablename__ = "dim_pincode"
+
+    id = Column(Integer, primary_key=True)
+    code = Column(String, nullable=False, unique=True)
+
 class EnrolmentData(Base):
     __tablename__ = "enrolment_data"
+    # Natural key: one row per pincode per day. Ingestion upserts on it.
+    # Secondary indexes are kept minimal since each one is updated by every
+    # ingested row: the aggregate queries read the rollups, not this table.
+    # What is left is the threshold scan (total < ? ORDER BY total, id), for
+    # which (x, total) gives each state or district its rows already in
+    # (total, id) order. Bulk loads can defer them (see services/indexes.py).
+    __table_args__ = (
+        UniqueConstraint("date", "state_id", "district_id", "pincode_id", name="uq_enrolment_natural_key"),
+        Index("ix_enrolment_data_state_total", "state_id", "total"),
+        Index("ix_enrolment_data_district_total", "district_id", "total"),
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
-    date = Column(Date, index=True)
-    state = Column(String, index=True)
-    district = Column(String, index=True)
-    pincode = Column(String, index=True)
+    id = Column(Integer, primary_key=True)
+    date = Column(Date)
+    # Integer keys into the dimension tables, resolved at ingest (see services/dimensions.py)
+    state_id = Column(Integer, ForeignKey("dim_state.id"), nullable=False)
+    district_id = Column(Integer, ForeignKey("dim_district.id"), nullable=False)
+    # Rows without a pincode point at the dimensions.NO_PINCODE row, since
+    # NULLs would never match each other in the natural key
+    pincode_id = Column(Integer, ForeignKey("dim_pincode.id"), nullable=False)
     demo_age_0_5 = Column(Integer)
     demo_age_5_17 = Column(Integer)
     demo_age_17_plus = Column(Integer)
+    # Sum of the three age counts, written at ingest so filters and
+    # rankings on it can use an index
+    total = Column(Integer, nullable=False, default=0, server_default="0", index=True)
+
+class SyncState(Base):
+    """Watermark of an API sync, per resource and (state, district) filter"""
+    __tablename__ = "sync_state"
+    __table_args__ = (UniqueConstraint("resource_id", "state", "district"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    resource_id = Column(String, nullable=False)
+    # Empty string means "no filter" so the unique constraint still applies
+    state = Column(String, nullable=False, default="")
+    district = Column(String, nullable=False, default="")
+    # Offset of the next record to fetch; the API has no date range filter
+    last_offset = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime)
+
+class EnrolmentSummary(Base):
+    """Single-row running totals over enrolment_data, maintained at ingest"""
+    __tablename__ = "enrolment_summary"
+
+    id = Column(Integer, primary_key=True)
+    # Bumped by every write to enrolment_data; caches compare it to detect change
+    generation = Column(Integer, nullable=False, default=0, server_default="0")
+    row_count = Column(Integer, nullable=False, default=0)
+    total_0_5 = Column(Integer, nullable=False, default=0)
+    total_5_17 = Column(Integer, nullable=False, default=0)
+    total_17_plus = Column(Integer, nullable=False, default=0)
+    total_enrolments = Column(Integer, nullable=False, default=0)
+
+class StateTotal(Base):
+    """Running enrolment totals per state, maintained at ingest"""
+    __tablename__ = "state_totals"
+
+    state = Column(String, primary_key=True)
+    row_count = Column(Integer, nullable=False, default=0)
+    total_0_5 = Column(Integer, nullable=False, default=0)
+    total_5_17 = Column(Integer, nullable=False, default=0)
+    total_17_plus = Column(Integer, nullable=False, default=0)
+    total = Column(Integer, nullable=False, default=0, index=True)
+
+class DistrictTotal(Base):
+    """Running enrolment totals per (state, district), maintained at ingest"""
+    __tablename__ = "district_totals"
+
+    state = Column(String, primary_key=True)
+    district = Column(String, primary_key=True)
+    row_count = Column(Integer, nullable=False, default=0)
+    total_0_5 = Column(Integer, nullable=False, default=0)
+    total_5_17 = Column(Integer, nullable=False, default=0)
+    total_17_plus = Column(Integer, nullable=False, default=0)
+    total = Column(Integer, nullable=False, default=0)
+
+class DailyStateRollup(Base):
+    """Enrolment totals per (date, state), maintained at ingest"""
+    __tablename__ = "daily_state_rollup"
+    # Covers /trends/state?state=: seek on state, rows already in date order
+    __table_args__ = (Index("ix_daily_state_rollup_state_date_total", "state", "date", "total"),)
+
+    date = Column(Date, primary_key=True)
+    state = Column(String, primary_key=True)
+    row_count = Column(Integer, nullable=False, default=0)
+    total_0_5 = Column(Integer, nullable=False, default=0)
+    total_5_17 = Column(Integer, nullable=False, default=0)
+    total_17_plus = Column(Integer, nullable=False, default=0)
+    total = Column(Integer, nullable=False, default=0)
+
+class DailyDistrictRollup(Base):
+    """Enrolment totals per (date, state, district), maintained at ingest"""
+    __tablename__ = "daily_district_rollup"
+    # Covers /trends/district?district=: seek on district, rows already in date order
+    __table_args__ = (Index("ix_daily_district_rollup_district_date_total", "district", "date", "total"),)
+
+    date = Column(Date, primary_key=True)
+    state = Column(String, primary_key=True)
+    district = Column(String, primary_key=True)
+    row_count = Column(Integer, nullable=False, default=0)
+    total_0_5 = Column(Integer, nullable=False, default=0)
+    total_5_17 = Column(Integer, nullable=False, default=0)
+    total_17_plus = Column(Integer, nullable=False, default=0)
+    total = Column(Integer, nullable=False, default=0)
+
+class DistrictAnomalyScore(Base):
+    """Anomaly scores of one (date, state, district) point against its trailing window"""
+    __tablename__ = "district_anomaly_score"
+    __table_args__ = (Index("ix_district_anomaly_score_score", "score"),)
+
+    date = Column(Date, primary_key=True)
+    state = Column(String, primary_key=True)
+    district = Column(String, primary_key=True)
+    total = Column(Integer, nullable=False)
+    # Trailing-window mean; None until the window has enough points
+    expected = Column(Float)
+    zscore = Column(Float)
+    robust_z = Column(Float)
+    # Fraction below the trailing mean (negative when above it)
+    drop_ratio = Column(Float)
+    # Largest of the three measures relative to its threshold; >= 1 is anomalous
+    score = Column(Float, nullable=False, default=0)
+
+class AnomalyDirty(Base):
+    """Districts whose daily series changed since their scores were computed"""
+    __tablename__ = "anomaly_dirty"
+
+    state = Column(String, primary_key=True)
+    district = Column(String, primary_key=True)
+    # Earliest changed date; scores from here on are recomputed
+    since = Column(Date, nullable=False)
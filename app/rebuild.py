@@ -0,0 +1,23 @@
+"""
+Rebuild the aggregate tables (summary, state totals, daily rollups) and the
+anomaly scores from enrolment_data. Run after restoring or hand-editing a database:
+
+    python -m app.rebuild [dataset]
+"""
+import sys
+import time
+from . import models, database
+from .services import aggregates, anomalies, datasets
+
+def main():
+    name = sys.argv[1] if len(sys.argv) > 1 else database.DEFAULT_DATASET
+    started = time.perf_counter()
+    with datasets.get(name).SessionLocal() as db:
+        aggregates.rebuild(db)
+        db.commit()
+        anomalies.refresh(db)
+        summary = db.get(models.EnrolmentSummary, aggregates.SUMMARY_ID)
+        print(f"Rebuilt aggregates over {summary.row_count} records of dataset {name} in {time.perf_counter() - started:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Server-side cache for the read endpoints.
+
+Entries are keyed on dataset storage, endpoint, normalized query parameters
+and body format (see encoding.py) and hold the encoded body. A dataset's entries are dropped
+when its data generation counter moves (every upload and sync bumps it; a
+clear moves the dataset to new storage). Each body carries a
+content hash ETag, so clients holding an unchanged payload get a 304.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from fastapi import Request, Response
+from sqlalchemy.orm import Session
+
+from . import database, encoding
+from .services import aggregates
+
+DEFAULT_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+class ResponseCache:
+    """
+    LRU cache of encoded response bodies, capped by total body size. Entries
+    belong to a dataset's storage, and each storage's entries are dropped
+    when its generation moves.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._generations = {}
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _drop(self, storage):
+        for cache_key in [k for k in self._entries if k[0] == storage]:
+            self._size -= len(self._entries.pop(cache_key)[1])
+
+    def _sync_generation(self, storage, generation):
+        if self._generations.get(storage) != generation:
+            self._drop(storage)
+            self._generations[storage] = generation
+
+    def get(self, storage, key, generation):
+        with self._lock:
+            self._sync_generation(storage, generation)
+            entry = self._entries.get((storage, key))
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((storage, key))
+            self.hits += 1
+            return entry
+
+    def put(self, storage, key, generation, entry):
+        body = entry[1]
+        with self._lock:
+            if generation != self._generations.get(storage) or len(body) > self.max_bytes:
+                return
+            cache_key = (storage, key)
+            if cache_key in self._entries:
+                self._size -= len(self._entries.pop(cache_key)[1])
+            self._entries[cache_key] = entry
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def forget(self, storage):
+        """Drop the entries of a dataset file that was cleared or removed"""
+        with self._lock:
+            self._drop(storage)
+            self._generations.pop(storage, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "datasets": len(self._generations),
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+response_cache = ResponseCache()
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in [tag.strip() for tag in header.split(",")]
+
+def cached_response(request: Request, db: Session, endpoint: str, params: dict, compute,
+                    format: str = "json") -> Response:
+    """
+    Return compute()'s result for endpoint/params encoded as format, from the
+    cache when the data has not changed, or a 304 if the client already has it.
+    """
+    storage = database.storage_of(db)
+    generation = aggregates.get_generation(db)
+    key = (endpoint, format, tuple(sorted((k, v) for k, v in params.items() if v is not None)))
+
+    entry = response_cache.get(storage, key, generation)
+    if entry is None:
+        body = encoding.encode(compute(), format)
+        etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        entry = (etag, body)
+        response_cache.put(storage, key, generation, entry)
+
+    etag, body = entry
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type=encoding.MEDIA_TYPES[format], headers=headers)
@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 from datetime import date as date_type
-from typing import Optional
+from typing import List, Optional
 
 class EnrolmentBase(BaseModel):
     date: date_type
@@ -26,3 +26,17 @@ class SummaryStats(BaseModel):
     total_5_17: int
     total_17_plus: int
     top_state: str
+
+class JobStatus(BaseModel):
+    id: str
+    kind: str
+    description: str
+    status: str
+    rows_done: int
+    total_rows: Optional[int] = None
+    progress: Optional[float] = None
+    rate: float
+    elapsed_seconds: float
+    eta_seconds: Optional[float] = None
+    message: Optional[str] = None
+    errors: List[str] = []
@@ -0,0 +1,193 @@
+"""
+Aggregate tables kept in step with enrolment_data inside the ingest transaction.
+
+Ingestion stages each batch in a temp table, calls apply_staged_deltas() to
+fold the difference between the staged rows and any rows they overwrite into
+the aggregates, and only then merges the batch into the enrolment_data
+partitions of its months (see services/partitions.py). The districts a batch
+touches are also queued for anomaly rescoring. remove_dates() does the same
+in reverse when whole months are dropped.
+"""
+from collections import defaultdict
+from sqlalchemy import func, literal, select, text
+from sqlalchemy.orm import Session
+from .. import models
+from . import anomalies, dimensions, indexes, partitions
+
+SUMMARY_ID = 1
+FACT_TABLE = models.EnrolmentData.__tablename__
+STAGING_TABLE = "temp.enrolment_staging"
+# Value of enrolment_data.total for a row; missing counts add nothing
+TOTAL_SQL = "COALESCE(demo_age_0_5, 0) + COALESCE(demo_age_5_17, 0) + COALESCE(demo_age_17_plus, 0)"
+
+# Every aggregate: (model, key columns, name of its grand-total column).
+# Keys are a subset of (date, state, district); the summary has none.
+AGGREGATES = [
+    (models.EnrolmentSummary, (), "total_enrolments"),
+    (models.StateTotal, ("state",), "total"),
+    (models.DistrictTotal, ("state", "district"), "total"),
+    (models.DailyStateRollup, ("date", "state"), "total"),
+    (models.DailyDistrictRollup, ("date", "state", "district"), "total"),
+]
+DELTA_KEYS = ("date", "state", "district")
+MEASURES = ("row_count", "total_0_5", "total_5_17", "total_17_plus")
+
+def create_staging_table(cursor):
+    """(Re)create the empty per-connection staging table for one batch"""
+    cursor.execute(
+        f"CREATE TEMP TABLE IF NOT EXISTS enrolment_staging ("
+        f"date TEXT, state_id INTEGER, district_id INTEGER, pincode_id INTEGER, "
+        f"demo_age_0_5 INTEGER, demo_age_5_17 INTEGER, demo_age_17_plus INTEGER, "
+        # Later rows of a batch replace earlier ones, as sequential upserts would
+        f"UNIQUE (date, state_id, district_id, pincode_id) ON CONFLICT REPLACE)"
+    )
+    cursor.execute(f"DELETE FROM {STAGING_TABLE}")
+
+def _staged_deltas(cursor, month):
+    # Per (date, state, district) of one month: new rows, and staged counts
+    # minus the counts they overwrite in the month's partition. Aggregates are
+    # keyed by name, so ids are mapped back here.
+    return cursor.execute(f"""
+        SELECT s.date, st.name, d.name,
+               SUM(CASE WHEN e.id IS NULL THEN 1 ELSE 0 END),
+               SUM(s.demo_age_0_5 - COALESCE(e.demo_age_0_5, 0)),
+               SUM(s.demo_age_5_17 - COALESCE(e.demo_age_5_17, 0)),
+               SUM(s.demo_age_17_plus - COALESCE(e.demo_age_17_plus, 0))
+        FROM {STAGING_TABLE} s
+        LEFT JOIN {partitions.table_name(month)} e
+          ON e.date = s.date AND e.state_id = s.state_id AND e.district_id = s.district_id
+         AND e.pincode_id = s.pincode_id
+        JOIN {models.State.__tablename__} st ON st.id = s.state_id
+        JOIN {models.District.__tablename__} d ON d.id = s.district_id
+        WHERE s.date >= ? AND s.date < ?
+        GROUP BY s.date, s.state_id, s.district_id
+    """, partitions.bounds(month)).fetchall()
+
+def _add_sql(model, keys, total_column):
+    # Upsert that adds the given deltas onto an aggregate row
+    table = model.__tablename__
+    columns = list(keys) + list(MEASURES) + [total_column]
+    conflict_keys = keys or ("id",)
+    if not keys:
+        columns = ["id"] + columns
+    updates = ", ".join(f"{col} = {col} + excluded.{col}" for col in list(MEASURES) + [total_column])
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)}) "
+        f"ON CONFLICT ({', '.join(conflict_keys)}) DO UPDATE SET {updates}"
+    )
+
+def apply_staged_deltas(cursor, months):
+    """Fold the staged batch, whose rows fall in the given months, into every aggregate table"""
+    apply_deltas(cursor, [row for month in months for row in _staged_deltas(cursor, month)])
+
+def apply_deltas(cursor, deltas):
+    """
+    Add (date, state, district, *MEASURES) delta rows onto every aggregate
+    table, queue their districts for rescoring and bump the data generation
+    """
+    if not deltas:
+        return
+
+    for model, keys, total_column in AGGREGATES:
+        positions = [DELTA_KEYS.index(k) for k in keys]
+        grouped = defaultdict(lambda: [0] * len(MEASURES))
+        for row in deltas:
+            sums = grouped[tuple(row[p] for p in positions)]
+            for i, value in enumerate(row[len(DELTA_KEYS):]):
+                sums[i] += value
+
+        prefix = () if keys else (SUMMARY_ID,)
+        cursor.executemany(_add_sql(model, keys, total_column), [
+            prefix + key + tuple(sums) + (sums[1] + sums[2] + sums[3],)
+            for key, sums in grouped.items()
+        ])
+
+    anomalies.mark_dirty(cursor, deltas)
+    cursor.execute("UPDATE enrolment_summary SET generation = generation + 1 WHERE id = ?", (SUMMARY_ID,))
+
+def remove_dates(cursor, start: str, end: str) -> int:
+    """
+    Take the rows dated in [start, end) out of every aggregate, as deleting
+    them would. The deltas come from daily_district_rollup, so the cost
+    follows the number of (date, district) points rather than rows. Returns
+    the number of rows removed. Does not commit.
+    """
+    deltas = cursor.execute(
+        f"SELECT date, state, district, -row_count, -total_0_5, -total_5_17, -total_17_plus "
+        f"FROM {models.DailyDistrictRollup.__tablename__} WHERE date >= ? AND date < ?", (start, end)
+    ).fetchall()
+    apply_deltas(cursor, deltas)
+    # Daily rollup rows of the range are now all zero
+    for model, keys, _ in AGGREGATES:
+        if "date" in keys:
+            cursor.execute(f"DELETE FROM {model.__tablename__} WHERE date >= ? AND date < ?", (start, end))
+    return -sum(row[3] for row in deltas)
+
+def get_generation(db: Session) -> int:
+    """Data generation counter; changes whenever enrolment_data does"""
+    generation = db.query(models.EnrolmentSummary.generation).filter(models.EnrolmentSummary.id == SUMMARY_ID).scalar()
+    return generation or 0
+
+def _next_generation(db: Session) -> int:
+    return get_generation(db) + 1
+
+def _totals_columns():
+    e = models.EnrolmentData
+    return [
+        func.count(),
+        func.coalesce(func.sum(e.demo_age_0_5), 0),
+        func.coalesce(func.sum(e.demo_age_5_17), 0),
+        func.coalesce(func.sum(e.demo_age_17_plus), 0),
+        func.coalesce(func.sum(e.total), 0),
+    ]
+
+def rebuild(db: Session):
+    """Recompute every aggregate from enrolment_data (all partitions). Does not commit."""
+    e = models.EnrolmentData
+    names = {"date": e.date, "state": models.State.name, "district": models.District.name}
+    facts = e.__table__.join(models.State.__table__, models.State.id == e.state_id) \
+        .join(models.District.__table__, models.District.id == e.district_id)
+    generation = _next_generation(db)
+    for model, keys, total_column in AGGREGATES:
+        db.query(model).delete()
+        group_by = [names[k] for k in keys]
+        query = select(*(group_by or [literal(SUMMARY_ID)]), *_totals_columns()).select_from(facts)
+        if group_by:
+            query = query.group_by(*group_by)
+        db.execute(model.__table__.insert().from_select(
+            list(keys or ("id",)) + list(MEASURES) + [total_column], query
+        ))
+    db.query(models.EnrolmentSummary).update({"generation": generation})
+    anomalies.mark_all_dirty(db)
+
+def _ensure_total_column(db: Session):
+    # enrolment_data.total was added after the first databases were created
+    columns = {row[1] for row in db.execute(text(f"PRAGMA table_info({FACT_TABLE})"))}
+    if "total" in columns:
+        return
+    db.execute(text(f"ALTER TABLE {FACT_TABLE} ADD COLUMN total INTEGER NOT NULL DEFAULT 0"))
+    db.execute(text(f"UPDATE {FACT_TABLE} SET total = {TOTAL_SQL}"))
+    db.commit()
+
+def ensure_built(db: Session):
+    """Build the aggregates for a database that predates them"""
+    _ensure_total_column(db)
+    # Collapsed duplicates leave the aggregates counting rows that are gone
+    collapsed = dimensions.migrate_string_columns(db)
+    partitions.migrate(db)
+    collapsed |= partitions.migrate_missing_pincodes(db)
+    indexes.sync(db)
+    summary = db.get(models.EnrolmentSummary, SUMMARY_ID)
+    # Aggregate tables added since the database was built are still empty
+    missing_rollups = summary is not None and summary.row_count > 0 and (
+        db.query(models.DailyStateRollup).first() is None or db.query(models.DistrictTotal).first() is None)
+    if summary is None or missing_rollups or collapsed:
+        rebuild(db)
+        db.commit()
+    elif (db.query(models.DistrictAnomalyScore).first() is None
+          and db.query(models.AnomalyDirty).first() is None
+          and db.query(models.DailyDistrictRollup).first() is not None):
+        # Rollups that predate anomaly scoring
+        anomalies.mark_all_dirty(db)
+        db.commit()
+    anomalies.refresh(db)
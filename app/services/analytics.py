@@ -1,89 +1,332 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import func, desc
+from sqlalchemy import func, literal, select, tuple_, union_all
 from .. import models
+from . import anomalies, columnar, cursors, downsample, partitions, queries
+from .singleflight import coalesce
+from datetime import date
+from itertools import islice
+from operator import itemgetter
+import heapq
 import pandas as pd
 
-def get_overall_summary(db: Session):
-    total_enrolments = db.query(
-        func.sum(models.EnrolmentData.demo_age_0_5 + models.EnrolmentData.demo_age_5_17 + models.EnrolmentData.demo_age_17_plus)
-    ).scalar() or 0
-    
-    total_0_5 = db.query(func.sum(models.EnrolmentData.demo_age_0_5)).scalar() or 0
-    total_5_17 = db.query(func.sum(models.EnrolmentData.demo_age_5_17)).scalar() or 0
-    total_17_plus = db.query(func.sum(models.EnrolmentData.demo_age_17_plus)).scalar() or 0
-    
-    # Top state by enrolment
-    top_state = db.query(
-        models.EnrolmentData.state,
-        func.sum(models.EnrolmentData.demo_age_0_5 + models.EnrolmentData.demo_age_5_17 + models.EnrolmentData.demo_age_17_plus).label("total")
-    ).group_by(models.EnrolmentData.state).order_by(desc("total")).first()
-    
+@coalesce
+def get_overall_summary(db: Session, state: str = None, district: str = None, pincode: str = None,
+                        start_date: date = None, end_date: date = None):
+    """
+    Enrolment totals and the state with the most enrolments, over the rows
+    within the optional state, district, pincode prefix and date range. With
+    no filters both are single-row reads of the totals maintained at ingest
+    (see services/aggregates.py), whatever the size of enrolment_data.
+    """
+    filters = {"state": state, "district": district, "pincode": pincode, "start_date": start_date,
+               "end_date": end_date}
+    totals = queries.aggregate(db, (), ("total", "age_0_5", "age_5_17", "age_17_plus"), **filters)[0]
+    top_state = queries.aggregate(db, ("state",), ("total",), top=1, **filters)
     return {
-        "total_enrolments": total_enrolments,
-        "total_0_5": total_0_5,
-        "total_5_17": total_5_17,
-        "total_17_plus": total_17_plus,
-        "top_state": top_state[0] if top_state else "N/A"
+        "total_enrolments": totals["total"],
+        "total_0_5": totals["age_0_5"],
+        "total_5_17": totals["age_5_17"],
+        "total_17_plus": totals["age_17_plus"],
+        "top_state": top_state[0]["state"] if top_state else "N/A"
     }
 
-def get_trends_by_state(db: Session, state: str = None):
-    query = db.query(
-        models.EnrolmentData.date,
-        models.EnrolmentData.state,
-        func.sum(models.EnrolmentData.demo_age_0_5 + models.EnrolmentData.demo_age_5_17 + models.EnrolmentData.demo_age_17_plus).label("count")
-    )
-    if state:
-        query = query.filter(models.EnrolmentData.state == state)
-        
-    results = query.group_by(models.EnrolmentData.date, models.EnrolmentData.state).all()
-    # Format for chart: [{date: '...', value: ...}]
-    return [{"date": r.date, "state": r.state, "enrolments": r.count} for r in results]
-
-def get_trends_by_district(db: Session, district: str = None):
-    query = db.query(
-        models.EnrolmentData.date,
-        models.EnrolmentData.district,
-        func.sum(models.EnrolmentData.demo_age_0_5 + models.EnrolmentData.demo_age_5_17 + models.EnrolmentData.demo_age_17_plus).label("count")
-    )
+STATE_TREND_COLUMNS = ("date", "state", "enrolments")
+DISTRICT_TREND_COLUMNS = ("date", "district", "enrolments")
+THRESHOLD_COLUMNS = ("date", "state", "district", "total_enrolment", "type")
+# Trend buckets: each day, or weeks (from Monday) or calendar months dated by their
+# first day; each is grouped by as the queries.DATE_DIMENSIONS of the same position
+GRANULARITIES = ("day", "week", "month")
+# What /rankings ranks, and the names that identify one of them
+RANKING_LEVELS = ("state", "district", "pincode")
+RANKING_KEYS = {"state": ("state",), "district": ("state", "district"), "pincode": ("pincode",)}
+# What /rankings can rank by
+RANKING_MEASURES = ("total", "age_0_5", "age_5_17", "age_17_plus")
+
+def _columns(names, rows) -> dict:
+    # Row tuples as parallel lists, one per name
+    values = list(zip(*rows)) or [()] * len(names)
+    return {name: list(column) for name, column in zip(names, values)}
+
+def _rows(columns: dict) -> list:
+    return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+def _in_range(column, start_date: date = None, end_date: date = None):
+    # Conditions for an optional, inclusive date range
+    conditions = []
+    if start_date:
+        conditions.append(column >= start_date)
+    if end_date:
+        conditions.append(column <= end_date)
+    return conditions
+
+def _thinned(result, key: str, as_columns: bool, max_points: int = None):
+    # Trend columns with each series downsampled to max_points, in the requested layout
+    if max_points:
+        result = downsample.thin(result, key, "enrolments", max_points)
+    return result if as_columns else _rows(result)
+
+def _trend_query(granularity: str, key: str) -> tuple:
+    # (group_by, measures) of the points of a trend
+    return (queries.DATE_DIMENSIONS[GRANULARITIES.index(granularity)], key), ("total",)
+
+def _trend_columns(columns: dict, key: str) -> dict:
+    # Aggregate columns renamed to the trend point fields
+    date_column, names, totals = columns.values()
+    return {"date": date_column, key: names, "enrolments": totals}
+
+@coalesce
+def get_trends_by_state(db: Session, state: str = None, start_date: date = None, end_date: date = None,
+                        limit: int = None, after=None, as_columns: bool = False,
+                        granularity: str = "day", max_points: int = None, district: str = None,
+                        pincode: str = None):
+    """
+    Totals per state and day, or per GRANULARITIES bucket, in (date, state)
+    order, as a list of points, or with as_columns as parallel lists keyed by
+    STATE_TREND_COLUMNS; optionally only of the rows within a state, district
+    or pincode prefix. Without a pincode this reads the daily rollups
+    maintained at ingest, not the raw table. max_points downsamples each
+    state's series to at most that many points (see downsample.py); it needs
+    whole series, so not limit or after.
+    """
+    group_by, measures = _trend_query(granularity, "state")
+    columns = queries.aggregate(db, group_by, measures, start_date, end_date, state, district, pincode,
+                                limit=limit, after=after, as_columns=True)
+    return _thinned(_trend_columns(columns, "state"), "state", as_columns, max_points)
+
+def iter_trends_by_state(db: Session, state: str = None, start_date: date = None, end_date: date = None, after=None,
+                         granularity: str = "day", district: str = None, pincode: str = None):
+    """The points of get_trends_by_state one at a time, from a server-side cursor"""
+    group_by, measures = _trend_query(granularity, "state")
+    for day, name, total in queries.iter_aggregate(db, group_by, measures, start_date, end_date, state, district,
+                                                   pincode, after):
+        yield {"date": day, "state": name, "enrolments": total}
+
+@coalesce
+def get_trends_by_district(db: Session, district: str = None, start_date: date = None, end_date: date = None,
+                           limit: int = None, after=None, as_columns: bool = False,
+                           granularity: str = "day", max_points: int = None, state: str = None,
+                           pincode: str = None):
+    """
+    Totals per district in (date, district) order; a district name shared by
+    two states is summed unless state is given. The options are those of
+    get_trends_by_state.
+    """
+    group_by, measures = _trend_query(granularity, "district")
+    columns = queries.aggregate(db, group_by, measures, start_date, end_date, state, district, pincode,
+                                limit=limit, after=after, as_columns=True)
+    return _thinned(_trend_columns(columns, "district"), "district", as_columns, max_points)
+
+def iter_trends_by_district(db: Session, district: str = None, start_date: date = None, end_date: date = None,
+                            after=None, granularity: str = "day", state: str = None, pincode: str = None):
+    """The points of get_trends_by_district one at a time, from a server-side cursor"""
+    group_by, measures = _trend_query(granularity, "district")
+    for day, name, total in queries.iter_aggregate(db, group_by, measures, start_date, end_date, state, district,
+                                                   pincode, after):
+        yield {"date": day, "district": name, "enrolments": total}
+
+@coalesce
+def get_aggregate(db: Session, group_by=(), measures=("total",), start_date: date = None, end_date: date = None,
+                  state: str = None, district: str = None, pincode: str = None, top: int = None, limit: int = None,
+                  after=None, as_columns: bool = False):
+    """queries.aggregate(): measures per group of group_by over the filtered rows"""
+    return queries.aggregate(db, group_by, measures, start_date, end_date, state, district, pincode, top, limit,
+                             after, as_columns)
+
+@coalesce
+def get_age_comparison(db: Session, state: str = None, district: str = None, pincode: str = None,
+                       start_date: date = None, end_date: date = None):
+    """Enrolments per age bucket, with the filters of get_overall_summary"""
+    return queries.aggregate(db, (), ("age_0_5", "age_5_17", "age_17_plus"), start_date, end_date, state,
+                             district, pincode)[0]
+
+@coalesce
+def get_anomalies(db: Session, method: str = "combined", limit: int = 50, offset: int = 0,
+                  state: str = None, district: str = None, threshold: int = 10,
+                  start_date: date = None, end_date: date = None, after=None, as_columns: bool = False):
+    """
+    Ranked, paginated anomalies, optionally dated from start_date to
+    end_date. method is one of anomalies.METHODS: "combined", "zscore", "mad"
+    and "drop" score each district's daily series against its trailing
+    window (see services/anomalies.py); "threshold" lists raw rows whose
+    total is below `threshold`, lowest first. A page starts offset items in,
+    or after `after`, the keyset of the last item of the previous page; it is
+    returned as "next_cursor" (None on the last page) and read back with
+    anomaly_after(). With as_columns, items are parallel lists keyed by
+    THRESHOLD_COLUMNS or anomalies.ITEM_COLUMNS.
+    """
+    if method == "threshold":
+        total, items, following = _threshold_anomalies(db, threshold, limit, offset, state, district,
+                                                       start_date, end_date, after, as_columns)
+    else:
+        total, items, following = anomalies.ranked(db, method, limit, offset, state, district,
+                                                   start_date, end_date, after, as_columns)
+    return {"method": method, "total": total, "limit": limit, "offset": offset, "items": items,
+            "next_cursor": cursors.encode(*following) if following else None}
+
+def anomaly_after(method: str, cursor: str):
+    """Keyset of a get_anomalies next_cursor for method; ValueError if it is malformed"""
+    if method == "threshold":
+        # (total, month, id)
+        return cursors.decode(cursor, (int, partitions.validate_month, int))
+    # (metric, date, state, district)
+    return cursors.decode(cursor, (float, date.fromisoformat, str, str))
+
+def iter_anomalies(db: Session, method: str = "combined", state: str = None, district: str = None,
+                   threshold: int = 10, start_date: date = None, end_date: date = None, after=None):
+    """Every item get_anomalies would page through, one at a time from server-side cursors"""
+    if method != "threshold":
+        yield from anomalies.iter_ranked(db, method, state, district, start_date, end_date, after)
+        return
+    rows = _threshold_rows(db, _threshold_conditions(db, threshold, state, district, start_date, end_date),
+                           start_date, end_date, after)
+    try:
+        for row in rows:
+            yield _threshold_item(row)
+    finally:
+        rows.close()
+
+def _region_filter(db: Session, state: str = None, district: str = None):
+    # Function from a partition to its conditions for an optional state and
+    # district. Names are resolved to dimension ids first, so the filter on
+    # each partition is an id lookup that needs no joins
+    district_ids = state_ids = None
     if district:
-        query = query.filter(models.EnrolmentData.district == district)
-        
-    results = query.group_by(models.EnrolmentData.date, models.EnrolmentData.district).all()
-    return [{"date": r.date, "district": r.district, "enrolments": r.count} for r in results]
-
-def get_age_comparison(db: Session):
-    # Overall split
-    total_0_5 = db.query(func.sum(models.EnrolmentData.demo_age_0_5)).scalar() or 0
-    total_5_17 = db.query(func.sum(models.EnrolmentData.demo_age_5_17)).scalar() or 0
-    total_17_plus = db.query(func.sum(models.EnrolmentData.demo_age_17_plus)).scalar() or 0
-    
-    return {
-        "age_0_5": total_0_5,
-        "age_5_17": total_5_17,
-        "age_17_plus": total_17_plus
-    }
+        # District ids are per state, so they already imply the state filter
+        districts = db.query(models.District.id).filter(models.District.name == district)
+        if state:
+            districts = districts.join(models.State, models.State.id == models.District.state_id) \
+                .filter(models.State.name == state)
+        district_ids = [r[0] for r in districts]
+    elif state:
+        state_ids = [r[0] for r in db.query(models.State.id).filter(models.State.name == state)]
+
+    def conditions(e):
+        if district_ids is not None:
+            return [e.c.district_id.in_(district_ids)]
+        if state_ids is not None:
+            return [e.c.state_id.in_(state_ids)]
+        return []
+
+    return conditions
+
+def _threshold_conditions(db: Session, threshold, state, district, start_date=None, end_date=None):
+    # Per-partition conditions for rows below threshold. In each partition
+    # the region filter is a single (state_id, total) or (district_id, total)
+    # index range that is already in (total, id) order
+    region = _region_filter(db, state, district)
+
+    def conditions(e):
+        found = [e.c.total < threshold]
+        if not partitions.within(e, start_date, end_date):
+            found += _in_range(e.c.date, start_date, end_date)
+        return found + region(e)
+
+    return conditions
+
+def _after_threshold_key(e, after):
+    # Rows of partition e past the keyset (total, month, id): ties on total
+    # are in month then id order
+    total, month, row_id = after
+    if e.info["month"] < month:
+        return e.c.total > total
+    if e.info["month"] > month:
+        return e.c.total >= total
+    return tuple_(e.c.total, e.c.id) > (total, row_id)
+
+def _threshold_rows(db: Session, conditions, start_date=None, end_date=None, after=None, head: int = None):
+    """
+    Rows matching conditions as (total, month, id, date, state, district),
+    lowest total first, ties in month then row order, after the keyset
+    (total, month, id) if given. Each partition of the date range is read in
+    (total, id) order from its own index and the streams are merged, so rows
+    come one at a time whatever the size of the result. head caps the rows
+    read from each partition when only the first head are wanted.
+    """
+    results = []
+    try:
+        for e in partitions.tables(db, start_date, end_date):
+            query = select(e.c.total, literal(e.info["month"]), e.c.id, e.c.date, models.State.name, models.District.name) \
+                .join(models.State, models.State.id == e.c.state_id) \
+                .join(models.District, models.District.id == e.c.district_id) \
+                .where(*conditions(e)).order_by(e.c.total, e.c.id)
+            if after:
+                query = query.where(_after_threshold_key(e, after))
+            if head is not None:
+                query = query.limit(head)
+            else:
+                query = query.execution_options(yield_per=anomalies.FETCH_BATCH)
+            # On the connection, rows skip the ORM's result processing
+            results.append(db.connection().execute(query))
+        yield from heapq.merge(*results, key=itemgetter(0, 1, 2))
+    finally:
+        for result in results:
+            result.close()
+
+def _threshold_item(row) -> dict:
+    total, _, _, day, state, district = row
+    return {"date": day, "state": state, "district": district, "total_enrolment": total, "type": "Low Enrolment"}
+
+def _threshold_anomalies(db: Session, threshold, limit, offset, state, district, start_date=None, end_date=None,
+                         after=None, as_columns=False):
+    if columnar.enabled():
+        return columnar.get_store(db).anomalies(threshold, limit, offset, state, district, start_date, end_date,
+                                                after, as_columns)
+
+    # Districts with very low enrolment on specific days, lowest total first,
+    # ties in month then row order. Only the partitions of the date range are read
+    tables = partitions.tables(db, start_date, end_date)
+    if not tables:
+        return 0, _columns(THRESHOLD_COLUMNS, []) if as_columns else [], None
+    conditions = _threshold_conditions(db, threshold, state, district, start_date, end_date)
+    counts = union_all(*[select(func.count().label("n")).select_from(e).where(*conditions(e)) for e in tables]).subquery()
+    count = db.execute(select(func.sum(counts.c.n))).scalar()
+    # Each partition contributes at most its first offset + limit rows to the
+    # page, plus one that tells whether there is a next page
+    rows = _threshold_rows(db, conditions, start_date, end_date, after, head=offset + limit + 1)
+    try:
+        page = list(islice(rows, offset, offset + limit + 1))
+    finally:
+        rows.close()
+    following = tuple(page[limit - 1][:3]) if len(page) > limit else None
+    page = page[:limit]
+    if as_columns:
+        totals, _, _, days, states, districts = (list(column) for column in zip(*page)) if page else ([],) * 6
+        return count, dict(zip(THRESHOLD_COLUMNS, (days, states, districts, totals, ["Low Enrolment"] * len(page)))), \
+            following
+    return count, [_threshold_item(r) for r in page], following
 
-def get_anomalies(db: Session, threshold: int = 10):
-    # Find districts with very low enrolment on specific days
-    results = db.query(
-        models.EnrolmentData.date,
-        models.EnrolmentData.district,
-        (models.EnrolmentData.demo_age_0_5 + models.EnrolmentData.demo_age_5_17 + models.EnrolmentData.demo_age_17_plus).label("total")
-    ).filter(
-        (models.EnrolmentData.demo_age_0_5 + models.EnrolmentData.demo_age_5_17 + models.EnrolmentData.demo_age_17_plus) < threshold
-    ).all()
-    
-    return [{"date": r.date, "district": r.district, "total_enrolment": r.total, "type": "Low Enrolment"} for r in results]
+@coalesce
+def get_rankings(db: Session, level: str = "state", by: str = "total", k: int = 10, state: str = None,
+                 district: str = None, start_date: date = None, end_date: date = None, as_columns: bool = False,
+                 pincode: str = None):
+    """
+    The k states, districts or pincodes (RANKING_LEVELS) with the largest
+    total or age-bucket count (RANKING_MEASURES), largest first and ties in
+    name order, optionally within an inclusive date range, a state, district
+    or pincode prefix. Each item holds the RANKING_KEYS of its level and the
+    value under the name of by; with as_columns, parallel lists.
+    """
+    return queries.aggregate(db, RANKING_KEYS[level], (by,), start_date, end_date, state, district, pincode,
+                             top=k, as_columns=as_columns)
 
+@coalesce
 def get_unique_states(db: Session):
     """Get list of unique states in the database"""
-    results = db.query(models.EnrolmentData.state).distinct().filter(models.EnrolmentData.state != None).order_by(models.EnrolmentData.state).all()
+    if columnar.enabled():
+        return columnar.get_store(db).unique_states()
+    # States with data, from the ingest-maintained totals (the dimension table
+    # also keeps states whose rows were cleared)
+    results = db.query(models.StateTotal.state).filter(models.StateTotal.row_count > 0).order_by(models.StateTotal.state).all()
     return [r[0] for r in results]
 
+@coalesce
 def get_unique_districts(db: Session, state: str = None):
     """Get list of unique districts in the database (optionally filtered by state)"""
-    query = db.query(models.EnrolmentData.district).distinct().filter(models.EnrolmentData.district != None)
+    if columnar.enabled():
+        return columnar.get_store(db).unique_districts(state)
+    rollup = models.DailyDistrictRollup
+    query = db.query(rollup.district).distinct()
     if state:
-        query = query.filter(models.EnrolmentData.state == state)
-    results = query.order_by(models.EnrolmentData.district).all()
+        query = query.filter(rollup.state == state)
+    results = query.order_by(rollup.district).all()
     return [r[0] for r in results]
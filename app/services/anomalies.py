@@ -0,0 +1,284 @@
+"""
+Statistical anomaly detection over each district's daily enrolment series.
+
+Every (date, state, district) point in daily_district_rollup is scored
+against the WINDOW points before it in the same district:
+
+- zscore: (total - mean) / std of the window
+- robust_z: 0.6745 * (total - median) / MAD of the window
+- drop_ratio: how far total falls below the window mean (0.6 = 60% below)
+
+Scores are stored in district_anomaly_score. Ingest marks the districts it
+touches in anomaly_dirty (see mark_dirty), and refresh() rescores only those
+districts from their earliest changed date, so appending new days costs one
+window read per district rather than a rescan of history. refresh() runs on
+the writer at the end of every upload and sync; queries only read scores.
+"""
+import threading
+import warnings
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import and_, desc, func, or_, text, tuple_
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from .. import models
+
+# Trailing window length, in observed days of the district's series
+WINDOW = 28
+# Points with fewer prior observations than this are not scored
+MIN_PERIODS = 7
+Z_THRESHOLD = 3.0
+MAD_THRESHOLD = 3.5
+DROP_THRESHOLD = 0.5
+# Points scored per vectorized pass (each needs a WINDOW-wide row)
+SCORE_BATCH = 50000
+# Rows fetched per round trip when results are streamed
+FETCH_BATCH = 1000
+
+METHODS = ("combined", "zscore", "mad", "drop", "threshold")
+
+SCORE_TABLE = models.DistrictAnomalyScore.__tablename__
+DIRTY_TABLE = models.AnomalyDirty.__tablename__
+ROLLUP_TABLE = models.DailyDistrictRollup.__tablename__
+SCORE_COLUMNS = ("date", "state", "district", "total", "expected", "zscore", "robust_z", "drop_ratio", "score")
+
+_refresh_lock = threading.Lock()
+
+def mark_dirty(cursor, deltas):
+    """
+    Record the earliest changed date of every district in an ingest batch.
+    deltas are aggregates._staged_deltas rows: (date, state, district, *measures).
+    """
+    earliest = {}
+    for date, state, district, *measures in deltas:
+        if not any(measures):
+            continue
+        key = (state, district)
+        if key not in earliest or date < earliest[key]:
+            earliest[key] = date
+    cursor.executemany(
+        f"INSERT INTO {DIRTY_TABLE} (state, district, since) VALUES (?, ?, ?) "
+        f"ON CONFLICT (state, district) DO UPDATE SET since = MIN(since, excluded.since)",
+        [key + (since,) for key, since in earliest.items()]
+    )
+
+def mark_all_dirty(db: Session):
+    """Schedule a full rescore, e.g. after the rollups were rebuilt"""
+    db.query(models.DistrictAnomalyScore).delete()
+    db.query(models.AnomalyDirty).delete()
+    db.execute(text(
+        f"INSERT INTO {DIRTY_TABLE} (state, district, since) "
+        f"SELECT state, district, MIN(date) FROM {ROLLUP_TABLE} GROUP BY state, district"
+    ))
+
+def _load_dirty_series(db: Session) -> pd.DataFrame:
+    # Each dirty district's points from `since` on, plus the WINDOW points before it
+    rows = db.execute(text(f"""
+        WITH history AS (
+            SELECT r.state, r.district, r.date, r.total,
+                   ROW_NUMBER() OVER (PARTITION BY r.state, r.district ORDER BY r.date DESC) AS back
+            FROM {ROLLUP_TABLE} r
+            JOIN {DIRTY_TABLE} d ON d.state = r.state AND d.district = r.district
+            WHERE r.date < d.since
+        )
+        SELECT state, district, date, total, 0 FROM history WHERE back <= :window
+        UNION ALL
+        SELECT r.state, r.district, r.date, r.total, 1
+        FROM {ROLLUP_TABLE} r
+        JOIN {DIRTY_TABLE} d ON d.state = r.state AND d.district = r.district
+        WHERE r.date >= d.since
+        ORDER BY 1, 2, 3
+    """), {"window": WINDOW}).fetchall()
+    return pd.DataFrame(rows, columns=["state", "district", "date", "total", "rescore"])
+
+def _trailing_windows(values, group_pos, rows):
+    # (len(rows), WINDOW) matrix of the previous WINDOW values in each row's group, NaN-padded
+    offsets = np.arange(-WINDOW, 0)
+    valid = group_pos[rows, None] + offsets >= 0
+    cols = np.clip(rows[:, None] + offsets, 0, None)
+    return np.where(valid, values[cols], np.nan)
+
+def score_series(frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    Score the rows of frame flagged `rescore`. frame holds whole trailing
+    windows and is sorted by (state, district, date).
+    """
+    values = frame["total"].to_numpy(dtype=np.float64)
+    group_start = frame.groupby(["state", "district"], sort=False).cumcount().to_numpy()
+    targets = np.flatnonzero(frame["rescore"].to_numpy() == 1)
+
+    expected = np.full(len(targets), np.nan)
+    zscore = np.full(len(targets), np.nan)
+    robust_z = np.full(len(targets), np.nan)
+    drop_ratio = np.full(len(targets), np.nan)
+
+    with warnings.catch_warnings(), np.errstate(invalid="ignore", divide="ignore"):
+        # All-NaN windows (too little history) warn in nanmean/nanmedian
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for start in range(0, len(targets), SCORE_BATCH):
+            part = slice(start, start + SCORE_BATCH)
+            rows = targets[part]
+            windows = _trailing_windows(values, group_start, rows)
+            x = values[rows]
+            enough = (~np.isnan(windows)).sum(axis=1) >= MIN_PERIODS
+
+            mean = np.nanmean(windows, axis=1)
+            std = np.nanstd(windows, axis=1, ddof=1)
+            median = np.nanmedian(windows, axis=1)
+            mad = np.nanmedian(np.abs(windows - median[:, None]), axis=1)
+
+            expected[part] = np.where(enough, mean, np.nan)
+            zscore[part] = np.where(enough & (std > 0), (x - mean) / std, np.nan)
+            robust_z[part] = np.where(enough & (mad > 0), 0.6745 * (x - median) / mad, np.nan)
+            drop_ratio[part] = np.where(enough & (mean > 0), 1 - x / mean, np.nan)
+
+    score = np.nanmax(np.vstack([
+        np.abs(zscore) / Z_THRESHOLD,
+        np.abs(robust_z) / MAD_THRESHOLD,
+        drop_ratio / DROP_THRESHOLD,
+        np.zeros(len(targets)),
+    ]), axis=0)
+
+    scored = frame.iloc[targets][["date", "state", "district", "total"]].reset_index(drop=True)
+    scored["expected"] = expected
+    scored["zscore"] = zscore
+    scored["robust_z"] = robust_z
+    scored["drop_ratio"] = drop_ratio
+    scored["score"] = score
+    return scored
+
+def _records(scored: pd.DataFrame):
+    # NaN -> NULL, NumPy scalars -> Python
+    scored = scored.astype(object).where(scored.notna(), None)
+    return list(scored[list(SCORE_COLUMNS)].itertuples(index=False, name=None))
+
+def refresh(db: Session) -> int:
+    """
+    Rescore districts changed by ingest since the last refresh and commit.
+    Returns the number of points scored. The data generation is bumped so
+    cached anomaly responses are recomputed. If another process holds the
+    database the refresh is skipped and left for the next one.
+    """
+    if db.query(models.AnomalyDirty).first() is None:
+        return 0
+    with _refresh_lock:
+        try:
+            # Take the write lock before reading, so a batch ingested meanwhile
+            # cannot mark a district that is then cleared without being scored
+            db.execute(text(f"UPDATE {DIRTY_TABLE} SET since = since"))
+            frame = _load_dirty_series(db)
+            scored = score_series(frame) if len(frame) else frame
+            db.execute(text(f"""
+                DELETE FROM {SCORE_TABLE} WHERE EXISTS (
+                    SELECT 1 FROM {DIRTY_TABLE} d
+                    WHERE d.state = {SCORE_TABLE}.state AND d.district = {SCORE_TABLE}.district
+                      AND {SCORE_TABLE}.date >= d.since)
+            """))
+            if len(scored):
+                cursor = db.connection().connection.cursor()
+                cursor.executemany(
+                    f"INSERT INTO {SCORE_TABLE} ({', '.join(SCORE_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' for _ in SCORE_COLUMNS)})",
+                    _records(scored)
+                )
+            db.execute(text(f"DELETE FROM {DIRTY_TABLE}"))
+            db.query(models.EnrolmentSummary).update({"generation": models.EnrolmentSummary.generation + 1})
+            db.commit()
+            return len(scored)
+        except OperationalError:
+            db.rollback()
+            return 0
+
+def _label(row) -> str:
+    if row.drop_ratio is not None and row.drop_ratio >= DROP_THRESHOLD:
+        return "Sudden Drop"
+    deviation = row.zscore if row.zscore is not None else row.robust_z
+    return "Spike" if deviation is not None and deviation > 0 else "Low Enrolment"
+
+def _round(value):
+    return round(value, 3) if value is not None else None
+
+def _ranked_query(db: Session, method: str, state: str = None, district: str = None,
+                  start_date=None, end_date=None, after=None):
+    # Points past a method's threshold in rank order, and the metric ranked on
+    a = models.DistrictAnomalyScore
+    metric, threshold = {
+        "combined": (a.score, 1.0),
+        "zscore": (func.abs(a.zscore), Z_THRESHOLD),
+        "mad": (func.abs(a.robust_z), MAD_THRESHOLD),
+        "drop": (a.drop_ratio, DROP_THRESHOLD),
+    }[method]
+
+    query = db.query(a).filter(metric >= threshold)
+    if state:
+        query = query.filter(a.state == state)
+    if district:
+        query = query.filter(a.district == district)
+    if start_date:
+        query = query.filter(a.date >= start_date)
+    if end_date:
+        query = query.filter(a.date <= end_date)
+    if after:
+        # Keyset of the last point already returned: (metric, date, state, district)
+        value, *key = after
+        query = query.filter(or_(metric < value, and_(metric == value, tuple_(a.date, a.state, a.district) > tuple(key))))
+    return query, metric
+
+def _sort_key(row, method: str) -> tuple:
+    value = {
+        "combined": row.score,
+        "zscore": abs(row.zscore) if row.zscore is not None else None,
+        "mad": abs(row.robust_z) if row.robust_z is not None else None,
+        "drop": row.drop_ratio,
+    }[method]
+    return value, row.date, row.state, row.district
+
+# Fields of a ranked item, each read from a score row
+ITEM_FIELDS = {
+    "date": lambda r: r.date,
+    "state": lambda r: r.state,
+    "district": lambda r: r.district,
+    "total_enrolment": lambda r: r.total,
+    "expected": lambda r: _round(r.expected),
+    "zscore": lambda r: _round(r.zscore),
+    "robust_z": lambda r: _round(r.robust_z),
+    "drop_ratio": lambda r: _round(r.drop_ratio),
+    "score": lambda r: _round(r.score),
+    "type": _label,
+}
+ITEM_COLUMNS = tuple(ITEM_FIELDS)
+
+def _item(r) -> dict:
+    return {name: field(r) for name, field in ITEM_FIELDS.items()}
+
+def ranked(db: Session, method: str = "combined", limit: int = 50, offset: int = 0,
+           state: str = None, district: str = None, start_date=None, end_date=None, after=None,
+           as_columns: bool = False):
+    """
+    Anomalous points for one scoring method, most severe first, optionally
+    dated from start_date to end_date. A page starts offset points in, or
+    after the keyset `after` (metric, date, state, district) of the last
+    point of the previous page. Returns (total, items, next keyset), the
+    keyset being None on the last page; with as_columns, items are parallel
+    lists keyed by ITEM_COLUMNS.
+    """
+    total = _ranked_query(db, method, state, district, start_date, end_date)[0].count()
+    query, metric = _ranked_query(db, method, state, district, start_date, end_date, after)
+    a = models.DistrictAnomalyScore
+    # One row past the page tells whether there is a next one
+    rows = query.order_by(desc(metric), a.date, a.state, a.district).offset(offset).limit(limit + 1).all()
+    following = _sort_key(rows[limit - 1], method) if len(rows) > limit else None
+    rows = rows[:limit]
+    if as_columns:
+        return total, {name: [field(r) for r in rows] for name, field in ITEM_FIELDS.items()}, following
+    return total, [_item(r) for r in rows], following
+
+def iter_ranked(db: Session, method: str = "combined", state: str = None, district: str = None,
+                start_date=None, end_date=None, after=None):
+    """Every point ranked() would page through, one at a time from a server-side cursor"""
+    query, metric = _ranked_query(db, method, state, district, start_date, end_date, after)
+    a = models.DistrictAnomalyScore
+    for r in query.order_by(desc(metric), a.date, a.state, a.district).yield_per(FETCH_BATCH):
+        yield _item(r)
@@ -2,75 +2,189 @@ import requests
 import io
 import os
 import pandas as pd
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from sqlalchemy.orm import Session
-from .ingestion import process_csv_and_ingest
+from .ingestion import read_csv_frames, insert_frame
+from . import anomalies, sync_state
+from .pipeline import Pipeline
 
 # API Configuration moved inside function to support late environment loading
 RESOURCE_ID = "19eac040-0b94-49fa-b239-4f2fd8677d53"
 BASE_URL = f"https://api.data.gov.in/resource/{RESOURCE_ID}"
 
-def fetch_and_sync_data(db: Session, limit: int = 1000, offset: int = 0, state: str = None, district: str = None, fetch_all: bool = False):
+# Number of pages requested in parallel when fetch_all is set
+DEFAULT_CONCURRENCY = 4
+# Pages buffered between pipeline stages, and rows written per transaction
+DEFAULT_QUEUE_SIZE = 4
+DEFAULT_COMMIT_ROWS = 50_000
+REQUEST_TIMEOUT = 60
+
+def create_http_session(pool_size: int = DEFAULT_CONCURRENCY) -> requests.Session:
+    """Create a keep-alive HTTP session whose connection pool fits pool_size workers"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def build_params(api_key: str, limit: int, offset: int, state: str = None, district: str = None):
+    params = {
+        "api-key": api_key,
+        "format": "csv",
+        "limit": limit,
+        "offset": offset
+    }
+
+    # Add filters if provided
+    if state:
+        params["filters[state]"] = state
+    if district:
+        params["filters[district]"] = district
+    return params
+
+def fetch_page(session: requests.Session, params: dict) -> bytes:
+    """Fetch one page of CSV. Returns b"" when the API has no more data."""
+    response = session.get(BASE_URL, params=params, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+
+    # Check if content is empty (or only carries the header row)
+    content = response.content.strip() if response.content else b""
+    if not content or b"\n" not in content:
+        return b""
+    return response.content
+
+def iter_pages(api_key: str, limit: int, offset: int = 0, state: str = None, district: str = None, fetch_all: bool = False, concurrency: int = DEFAULT_CONCURRENCY):
+    """
+    Yields raw CSV pages in offset order, keeping up to `concurrency` requests
+    in flight over a pooled session. Stops at the first empty page.
+    """
+    concurrency = max(1, concurrency) if fetch_all else 1
+    session = create_http_session(concurrency)
+    next_offset = offset
+    in_flight = deque()
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            def submit_next():
+                nonlocal next_offset
+                params = build_params(api_key, limit, next_offset, state, district)
+                in_flight.append((next_offset, executor.submit(fetch_page, session, params)))
+                next_offset += limit
+
+            for _ in range(concurrency):
+                submit_next()
+
+            try:
+                while in_flight:
+                    page_offset, future = in_flight.popleft()
+                    content = future.result()
+                    if not content:
+                        break
+
+                    yield content
+
+                    if not fetch_all:
+                        break
+
+                    print(f"Fetched page at offset {page_offset}. Next offset: {page_offset + limit}")
+                    submit_next()
+            finally:
+                # Stop cleanly: drop pages past the end of the data
+                for _, future in in_flight:
+                    future.cancel()
+    finally:
+        session.close()
+
+def parse_page(content: bytes):
+    """Parse one API page. Returns (raw row count, normalized frame)."""
+    return next(read_csv_frames(content))
+
+def fetch_and_sync_data(db: Session, limit: int = 1000, offset: int = 0, state: str = None, district: str = None, fetch_all: bool = False,
+                        concurrency: int = DEFAULT_CONCURRENCY, commit_rows: int = DEFAULT_COMMIT_ROWS, queue_size: int = DEFAULT_QUEUE_SIZE,
+                        incremental: bool = False, stats: dict = None, progress_callback=None):
     """
     Fetches data from Aadhar API and ingests it into the database.
     Supports filtering by state and district.
-    If fetch_all is True, iteratively fetches all pages until no more data is returned.
+    If fetch_all is True, fetches all pages until no more data is returned,
+    keeping up to `concurrency` page requests in flight over a pooled session.
+
+    Download, parse and write run as a pipeline of threads joined by bounded
+    queues (queue_size pages each), so network waits overlap with parsing and
+    inserts. Writes are committed once at least commit_rows rows are pending.
+    If a stats dict is passed it is filled with per-stage throughput.
+    progress_callback, if given, is called as (page_number, page_rows, total_rows)
+    after each page is written; an exception raised from it aborts the sync.
+
+    If incremental is True, the sync resumes from the watermark stored for this
+    (state, district) filter instead of `offset`, so only records appended since
+    the last sync are pulled. Incremental syncs and full syncs from offset 0 save
+    their watermark alongside every commit. The watermark is an offset only (the
+    API cannot filter by date range): records changed or inserted before it are
+    not picked up again, which takes a full sync.
     """
     api_key = os.getenv("API_KEY")
     if not api_key:
         print("Warning: API_KEY not found in environment variables.")
         # Fallback to module level if it was set (though we are moving it)
-    
+
+    if incremental:
+        watermark = sync_state.get_watermark(db, RESOURCE_ID, state, district)
+        if watermark:
+            offset = watermark.last_offset
+            print(f"Incremental sync from offset {offset}")
+    track_watermark = incremental or (fetch_all and offset == 0)
+
     total_synced = 0
-    current_offset = offset
-    
-    # If fetch_all is requested, loop until no data is returned
-    # Otherwise, run once with provided limit/offset
-    
-    while True:
-        params = {
-            "api-key": api_key,
-            "format": "csv",
-            "limit": limit,
-            "offset": current_offset
-        }
-        
-        # Add filters if provided
-        if state:
-            params["filters[state]"] = state
-        if district:
-            params["filters[district]"] = district
-        
-        try:
-            response = requests.get(BASE_URL, params=params)
-            response.raise_for_status()
-            
-            # Check if content is empty
-            if not response.content:
-                break
-                
-            content_str = response.content.decode('utf-8')
-            if content_str.strip() == "":
-                 break
-                 
-            count = process_csv_and_ingest(response.content, db)
-            
-            if count == 0:
-                break
-                
-            total_synced += count
-            
-            if not fetch_all:
-                break
-                
-            # Prepare for next page
-            current_offset += limit
-            print(f"Fetched {count} records. Next offset: {current_offset}")
-            
-        except requests.exceptions.RequestException as e:
-            print(f"API Request Failed: {e}")
-            raise e
-        except Exception as e:
-            print(f"Sync Failed: {e}")
-            raise e
-            
+    pages_written = 0
+    pending_rows = 0
+    consumed_rows = 0
+
+    def commit():
+        nonlocal pending_rows
+        if track_watermark:
+            sync_state.save_watermark(db, RESOURCE_ID, state, district, offset + consumed_rows)
+        db.commit()
+        pending_rows = 0
+
+    def write(page):
+        nonlocal total_synced, pages_written, pending_rows, consumed_rows
+        raw_rows, df = page
+        count = insert_frame(df, db)
+        consumed_rows += raw_rows
+        total_synced += count
+        pages_written += 1
+        pending_rows += count
+        if pending_rows >= commit_rows:
+            commit()
+        if progress_callback:
+            progress_callback(pages_written, count, total_synced)
+
+    pipeline = Pipeline(queue_size=queue_size)
+    try:
+        pipeline.run(
+            iter_pages(api_key, limit, offset, state, district, fetch_all, concurrency),
+            parse_page,
+            write,
+            measure_source=len,
+            measure=lambda page: len(page[1])
+        )
+        commit()
+        anomalies.refresh(db)
+    except requests.exceptions.RequestException as e:
+        db.rollback()
+        print(f"API Request Failed: {e}")
+        raise e
+    except Exception as e:
+        db.rollback()
+        print(f"Sync Failed: {e}")
+        raise e
+
+    report = pipeline.report()
+    for name, stage in pipeline.stats.items():
+        print(f"Stage {name}: {stage.items} items, {stage.rows} {stage.unit} in {stage.busy_seconds:.2f}s")
+    if stats is not None:
+        stats.update(report)
+
     return total_synced
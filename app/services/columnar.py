@@ -0,0 +1,276 @@
+"""
+In-process columnar analytics backend.
+
+Holds enrolment_data as dictionary-encoded NumPy columns and answers the
+analytics queries with vectorized group-bys; date ranges are masks over the
+day column. Enabled with
+ANALYTICS_BACKEND=columnar; the arrays are reloaded only when the data
+generation counter (see aggregates.get_generation) changes.
+"""
+import os
+import threading
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy.orm import Session
+
+from .. import database, models
+from . import aggregates, dimensions, partitions
+
+EPOCH = date(1970, 1, 1)
+
+def enabled() -> bool:
+    return os.getenv("ANALYTICS_BACKEND", "sql").lower() == "columnar"
+
+def _group_sum(keys, weights, size):
+    return np.bincount(keys, weights=weights, minlength=size).astype(np.int64)
+
+class ColumnarStore:
+    """One immutable snapshot of enrolment_data as NumPy arrays"""
+
+    def __init__(self, generation: int, frame: pd.DataFrame):
+        self.generation = generation
+        # Dates as int days since 1970-01-01
+        self.days = frame['date'].to_numpy(dtype=np.int32)
+        # Sorted dictionaries, so code order is the same as string order
+        self.state_codes, self.states = pd.factorize(frame['state'], sort=True)
+        self.district_codes, self.districts = pd.factorize(frame['district'], sort=True)
+        self.state_codes = self.state_codes.astype(np.int32)
+        self.district_codes = self.district_codes.astype(np.int32)
+        self.states = np.asarray(self.states, dtype=object)
+        self.districts = np.asarray(self.districts, dtype=object)
+        # Rows without a pincode get code -1
+        self.pincode_codes, self.pincodes = pd.factorize(frame['pincode'], sort=True)
+        self.pincode_codes = self.pincode_codes.astype(np.int32)
+        self.pincodes = np.asarray(self.pincodes, dtype=object)
+        self.age_0_5 = frame['demo_age_0_5'].to_numpy(dtype=np.int32)
+        self.age_5_17 = frame['demo_age_5_17'].to_numpy(dtype=np.int32)
+        self.age_17_plus = frame['demo_age_17_plus'].to_numpy(dtype=np.int32)
+        self.total = frame['total'].to_numpy(dtype=np.int64)
+        # Partition month (YYYYMM) and row id, the tie order of threshold anomalies
+        self.months = frame['month'].to_numpy(dtype=np.int32)
+        self.ids = frame['id'].to_numpy(dtype=np.int64)
+
+    @classmethod
+    def load(cls, db: Session, generation: int):
+        # Partitions in month order, each in rowid order, matching the tie
+        # order of the SQL path
+        connection = db.connection().connection.driver_connection
+        rows = []
+        for table in partitions.tables(db):
+            rows += connection.execute(
+                f"SELECT CAST(julianday(e.date) - 2440587.5 AS INTEGER), s.name, d.name, "
+                f"COALESCE(e.demo_age_0_5, 0), COALESCE(e.demo_age_5_17, 0), COALESCE(e.demo_age_17_plus, 0), e.total, "
+                f"{table.name[-6:]}, e.id, NULLIF(p.code, ?) "
+                f"FROM {table.name} e "
+                f"JOIN {models.State.__tablename__} s ON s.id = e.state_id "
+                f"JOIN {models.District.__tablename__} d ON d.id = e.district_id "
+                f"JOIN {models.Pincode.__tablename__} p ON p.id = e.pincode_id "
+                f"ORDER BY e.id", (dimensions.NO_PINCODE,)
+            ).fetchall()
+        frame = pd.DataFrame(rows, columns=[
+            'date', 'state', 'district', 'demo_age_0_5', 'demo_age_5_17', 'demo_age_17_plus', 'total', 'month', 'id',
+            'pincode'
+        ])
+        return cls(generation, frame)
+
+    @staticmethod
+    def _to_date(days):
+        return EPOCH + timedelta(days=int(days))
+
+    @staticmethod
+    def _to_dates(days) -> list:
+        # Day numbers as a list of dates, without a Python loop
+        return np.asarray(days, dtype="datetime64[D]").astype(object).tolist()
+
+    def _in_range(self, start_date: date = None, end_date: date = None):
+        # Row mask for an optional, inclusive date range, or None for all rows
+        if not start_date and not end_date:
+            return None
+        mask = np.ones(len(self.days), dtype=bool)
+        if start_date:
+            mask &= self.days >= (start_date - EPOCH).days
+        if end_date:
+            mask &= self.days <= (end_date - EPOCH).days
+        return mask
+
+    @staticmethod
+    def _bucket(days, dimension: str = "date"):
+        # Day number of the bucket each day falls in, as queries.bucket does in SQL
+        if dimension == "week":
+            # The epoch is a Thursday; step back to Monday
+            return days - (days + 3) % 7
+        if dimension == "month":
+            return days.astype("datetime64[D]").astype("datetime64[M]").astype("datetime64[D]").astype(days.dtype)
+        return days
+
+    def anomalies(self, threshold: int = 10, limit: int = 50, offset: int = 0,
+                  state: str = None, district: str = None, start_date: date = None, end_date: date = None,
+                  after=None, as_columns: bool = False):
+        # Rows below threshold, lowest total first (load order, i.e. month then id, within ties),
+        # from offset or after the keyset (total, month, id): (count, page, next keyset).
+        # With as_columns the page is parallel lists, as in the SQL path
+        mask = self.total < threshold
+        in_range = self._in_range(start_date, end_date)
+        if in_range is not None:
+            mask &= in_range
+        if state:
+            mask &= self.state_codes == self._code(self.states, state)
+        if district:
+            mask &= self.district_codes == self._code(self.districts, district)
+        rows = np.flatnonzero(mask)
+        rows = rows[np.argsort(self.total[rows], kind="stable")]
+        count = len(rows)
+        if after:
+            total, month, row_id = after[0], int(after[1].replace("-", "")), after[2]
+            totals, months = self.total[rows], self.months[rows]
+            later = (months > month) | ((months == month) & (self.ids[rows] > row_id))
+            rows = rows[(totals > total) | ((totals == total) & later)]
+        page = rows[offset:offset + limit + 1]
+        following = None
+        if len(page) > limit:
+            last = page[limit - 1]
+            month = str(self.months[last])
+            following = (int(self.total[last]), f"{month[:4]}-{month[4:]}", int(self.ids[last]))
+        page = page[:limit]
+        if as_columns:
+            return count, {"date": self._to_dates(self.days[page]), "state": self.states[self.state_codes[page]].tolist(),
+                           "district": self.districts[self.district_codes[page]].tolist(),
+                           "total_enrolment": self.total[page].tolist(), "type": ["Low Enrolment"] * len(page)}, following
+        return count, [{"date": self._to_date(self.days[i]), "state": self.states[self.state_codes[i]],
+                        "district": self.districts[self.district_codes[i]],
+                        "total_enrolment": int(self.total[i]), "type": "Low Enrolment"}
+                       for i in page], following
+
+    def aggregate(self, group_by: tuple, measures: tuple, start_date: date = None, end_date: date = None,
+                  state: str = None, district: str = None, pincode: str = None, top: int = None,
+                  limit: int = None, after=None):
+        # Vectorized queries.aggregate: sums of measures per group of group_by
+        # over the filtered rows, as columns in key order, or the top largest
+        # by the first measure with ties in key order
+        mask = self._in_range(start_date, end_date)
+        conditions = []
+        if state:
+            conditions.append(self.state_codes == self._code(self.states, state))
+        if district:
+            conditions.append(self.district_codes == self._code(self.districts, district))
+        if pincode:
+            # In a sorted dictionary the codes sharing a prefix are one range
+            low, high = np.searchsorted(self.pincodes, [pincode, pincode[:-1] + chr(ord(pincode[-1]) + 1)])
+            conditions.append((self.pincode_codes >= low) & (self.pincode_codes < high))
+        if "pincode" in group_by:
+            conditions.append(self.pincode_codes >= 0)
+        for condition in conditions:
+            mask = condition if mask is None else mask & condition
+
+        def rows(column):
+            return column if mask is None else column[mask]
+
+        values = {"total": self.total, "age_0_5": self.age_0_5, "age_5_17": self.age_5_17,
+                  "age_17_plus": self.age_17_plus}
+        if not group_by:
+            count = len(self.days) if mask is None else int(np.count_nonzero(mask))
+            return {m: [count if m == "records" else int(rows(values[m]).sum(dtype=np.int64))] for m in measures}
+        # Per dimension, the codes of the rows kept, their dictionary (None for
+        # day numbers) and how many codes there can be
+        codes, dictionaries, sizes, base = [], [], [], 0
+        for dimension in group_by:
+            if dimension in ("date", "week", "month"):
+                days = self._bucket(rows(self.days), dimension)
+                base = int(days.min()) if len(days) else 0
+                codes.append(days - base)
+                dictionaries.append(None)
+                sizes.append(int(days.max()) - base + 1 if len(days) else 1)
+            else:
+                dictionary = {"state": self.states, "district": self.districts, "pincode": self.pincodes}[dimension]
+                codes.append(rows({"state": self.state_codes, "district": self.district_codes,
+                                   "pincode": self.pincode_codes}[dimension]))
+                dictionaries.append(dictionary)
+                sizes.append(max(1, len(dictionary)))
+        # One mixed-radix key per row; key order is group key order
+        keys = np.zeros(len(codes[0]), dtype=np.int64)
+        for code, size in zip(codes, sizes):
+            keys = keys * size + code
+        space = int(np.prod(sizes, dtype=np.float64))
+        if space <= 4 * len(keys) + 1024:
+            # Few possible keys: count into a dense array rather than sort
+            counts = np.bincount(keys, minlength=space)
+            groups = np.flatnonzero(counts)
+            sums = {m: counts[groups] if m == "records" else _group_sum(keys, rows(values[m]), space)[groups]
+                    for m in measures}
+        else:
+            groups, inverse = np.unique(keys, return_inverse=True)
+            sums = {m: np.bincount(inverse, minlength=len(groups)) if m == "records"
+                    else _group_sum(inverse, rows(values[m]), len(groups)) for m in measures}
+        parts = []
+        for size in reversed(sizes):
+            parts.append(groups % size)
+            groups = groups // size
+        parts.reverse()
+        chosen = np.arange(len(parts[0]))
+        if after:
+            # Groups after the keys of the last one already returned, compared
+            # from the last dimension to the first
+            later = np.zeros(len(chosen), dtype=bool)
+            for part, dictionary, value in reversed(list(zip(parts, dictionaries, after))):
+                if dictionary is None:
+                    low = (value - EPOCH).days - base
+                    high = low + 1
+                else:
+                    low, high = np.searchsorted(dictionary, value, "left"), np.searchsorted(dictionary, value, "right")
+                later = (part >= high) | ((part >= low) & (part < high) & later)
+            chosen = np.flatnonzero(later)
+        if top is not None:
+            first = sums[measures[0]]
+            if len(chosen) > top:
+                # Partial sort: the groups at least as large as the top-th
+                # largest, ties included, and only those are ordered
+                chosen = np.flatnonzero(first >= np.partition(first, len(first) - top)[len(first) - top])
+            chosen = chosen[np.lexsort((chosen, -first[chosen]))][:top]
+        elif limit is not None:
+            chosen = chosen[:limit]
+        columns = {}
+        for dimension, part, dictionary in zip(group_by, parts, dictionaries):
+            if dictionary is None:
+                columns[dimension] = self._to_dates(part[chosen] + base)
+            else:
+                columns[dimension] = dictionary[part[chosen]].tolist()
+        return {**columns, **{m: sums[m][chosen].tolist() for m in measures}}
+
+    def unique_states(self):
+        return list(self.states)
+
+    def unique_districts(self, state: str = None):
+        if not state:
+            return list(self.districts)
+        codes = np.unique(self.district_codes[self.state_codes == self._code(self.states, state)])
+        return list(self.districts[codes])
+
+    @staticmethod
+    def _code(dictionary, value):
+        # Code of a value in a sorted dictionary, or -1 if it is absent
+        i = np.searchsorted(dictionary, value)
+        return i if i < len(dictionary) and dictionary[i] == value else -1
+
+# Dataset storage path -> its current snapshot
+_stores = {}
+_store_lock = threading.Lock()
+
+def get_store(db: Session) -> ColumnarStore:
+    """Current snapshot of the session's dataset, reloaded if the data generation has moved on"""
+    storage = database.storage_of(db)
+    generation = aggregates.get_generation(db)
+    store = _stores.get(storage)
+    if store is not None and store.generation == generation:
+        return store
+    with _store_lock:
+        store = _stores.get(storage)
+        if store is None or store.generation != generation:
+            store = _stores[storage] = ColumnarStore.load(db, generation)
+        return store
+
+def forget(storage: str):
+    """Drop the snapshot of a dataset file that was cleared or removed"""
+    with _store_lock:
+        _stores.pop(storage, None)
@@ -0,0 +1,30 @@
+"""
+Opaque keyset pagination cursors.
+
+A cursor is the sort key of the last row of a page, as URL-safe base64 of
+its JSON. The next page holds the rows whose sort key comes after it, found
+with an index seek instead of by skipping offset rows, so every page costs
+the same however deep it is and rows inserted meanwhile do not shift pages.
+"""
+import base64
+import binascii
+import json
+from datetime import date
+
+def encode(*key) -> str:
+    """Cursor for a sort key; dates are written as ISO strings"""
+    values = [value.isoformat() if isinstance(value, date) else value for value in key]
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode(cursor: str, types) -> tuple:
+    """
+    Sort key of a cursor, each value converted by the matching callable in
+    types (e.g. date.fromisoformat). Raises ValueError for a malformed cursor.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError
+        return tuple(convert(value) for convert, value in zip(types, values))
+    except (ValueError, TypeError, binascii.Error):
+        raise ValueError("Invalid cursor. Pass the next_cursor of a previous page unchanged.")
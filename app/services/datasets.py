@@ -0,0 +1,66 @@
+"""
+Dataset lifecycle on top of database.registry.
+
+get() returns a dataset's storage with the schema in place. clear() empties
+a dataset by moving it to fresh storage (see database.DatasetRegistry) and
+remove() deletes it, so neither touches individual rows. Both wait for the
+write in progress on the dataset (at most one ingest chunk) to commit; an
+upload or sync still running then fails instead of writing into the old
+storage. The in-process caches that belonged to it are dropped, as they are
+when the registry closes an idle dataset.
+"""
+from sqlalchemy import text
+
+from .. import database, models
+from ..response_cache import response_cache
+from . import aggregates, columnar, dimensions
+
+def _initialize(dataset: database.Dataset):
+    models.Base.metadata.create_all(bind=dataset.engine)
+    with dataset.SessionLocal() as db:
+        aggregates.ensure_built(db)
+
+def _forget(dataset: database.Dataset):
+    # In-process caches of storage that was closed or discarded
+    dimensions.forget(dataset.path)
+    columnar.forget(dataset.path)
+    response_cache.forget(dataset.path)
+
+database.registry.on_open.append(_initialize)
+database.registry.on_close.append(_forget)
+
+def get(name: str) -> database.Dataset:
+    """Storage for a dataset, created empty if it does not exist yet"""
+    return database.registry.open(database.validate_dataset_name(name))
+
+def _row_count(connection) -> int:
+    count = connection.execute(text(
+        f"SELECT row_count FROM {models.EnrolmentSummary.__tablename__} WHERE id = :id"
+    ), {"id": aggregates.SUMMARY_ID}).scalar()
+    return count or 0
+
+def row_count(name: str) -> int:
+    """Records in a dataset, from its summary row"""
+    with get(name).read_engine.connect() as connection:
+        return _row_count(connection)
+
+def _retire(name: str, swap) -> int:
+    old = get(name)
+    # Holding the writer connection waits out the transaction in progress
+    with old.engine.connect() as connection:
+        count = _row_count(connection)
+        swap(name)
+    database.registry.discard(old)
+    return count
+
+def clear(name: str) -> int:
+    """Empty a dataset. Returns the number of records it held."""
+    return _retire(database.validate_dataset_name(name), database.registry.reset)
+
+def remove(name: str) -> int:
+    """Delete a dataset other than the default. Returns the number of records it held."""
+    return _retire(database.validate_dataset_name(name), database.registry.remove)
+
+def list_datasets():
+    """Every dataset with its record count, default first"""
+    return [{"name": name, "records": row_count(name)} for name in database.registry.names()]
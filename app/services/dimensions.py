@@ -0,0 +1,208 @@
+"""
+Dimension tables for state, district and pincode.
+
+enrolment_data stores integer ids into dim_state, dim_district and
+dim_pincode instead of repeating the strings on every row. Ingestion maps a
+frame's strings to ids with resolve_frame(), which consults an in-process
+cache and only goes to the database for values it has not seen before.
+Rows without a pincode get the NO_PINCODE row, so they still have one
+natural key each.
+
+Ids created by a transaction that is still open are kept on its connection
+and only enter the shared cache when that transaction commits, so a rolled
+back ingest never leaves ids in the cache that the database does not have.
+Each dataset file has its own ids, so there is one cache per file.
+"""
+import threading
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import Pool
+
+from .. import models
+
+# kind -> (table, key columns). District names are only unique within a state.
+DIMENSIONS = {
+    "state": (models.State.__tablename__, ("name",)),
+    "district": (models.District.__tablename__, ("state_id", "name")),
+    "pincode": (models.Pincode.__tablename__, ("code",)),
+}
+# dim_pincode code of rows without a pincode
+NO_PINCODE = ""
+# Connection info key holding ids inserted by the open transaction
+PENDING_KEY = "pending_dimensions"
+# Values per IN (...) lookup, under SQLite's bound parameter limit
+LOOKUP_BATCH = 400
+
+class DimensionCache:
+    """Committed key -> id maps per dimension, shared by all sessions on one dataset file"""
+
+    def __init__(self):
+        self._ids = {kind: {} for kind in DIMENSIONS}
+        self._lock = threading.Lock()
+
+    def get(self, kind, key):
+        return self._ids[kind].get(key)
+
+    def update(self, kind, ids: dict):
+        with self._lock:
+            self._ids[kind].update(ids)
+
+# Storage path (see database.create_engines) -> DimensionCache
+_caches = {}
+_caches_lock = threading.Lock()
+
+def cache_for(storage: str) -> DimensionCache:
+    with _caches_lock:
+        return _caches.setdefault(storage, DimensionCache())
+
+def forget(storage: str):
+    """Drop the cache of a dataset file that was cleared or removed"""
+    with _caches_lock:
+        _caches.pop(storage, None)
+
+@event.listens_for(Engine, "commit")
+def _publish_pending(connection):
+    info = connection.connection.info
+    pending = info.pop(PENDING_KEY, None)
+    if pending:
+        cache = cache_for(info["storage"])
+        for kind, ids in pending.items():
+            cache.update(kind, ids)
+
+@event.listens_for(Engine, "rollback")
+def _drop_pending(connection):
+    connection.connection.info.pop(PENDING_KEY, None)
+
+@event.listens_for(Pool, "checkin")
+def _drop_pending_on_checkin(dbapi_connection, connection_record):
+    # A connection returned without commit was rolled back by the pool
+    connection_record.info.pop(PENDING_KEY, None)
+
+def _select_ids(cursor, table, columns, keys):
+    found = {}
+    row_value = len(columns) > 1
+    for start in range(0, len(keys), LOOKUP_BATCH):
+        batch = keys[start:start + LOOKUP_BATCH]
+        if row_value:
+            target = f"({', '.join(columns)})"
+            placeholders = "VALUES " + ", ".join(f"({', '.join('?' for _ in columns)})" for _ in batch)
+            params = [value for key in batch for value in key]
+        else:
+            target = columns[0]
+            placeholders = ", ".join("?" for _ in batch)
+            params = batch
+        rows = cursor.execute(
+            f"SELECT id, {', '.join(columns)} FROM {table} WHERE {target} IN ({placeholders})", params
+        ).fetchall()
+        for row in rows:
+            found[tuple(row[1:]) if row_value else row[1]] = row[0]
+    return found
+
+def resolve(cursor, info: dict, kind: str, keys: list) -> list:
+    """
+    Ids for keys (names, codes, or (state_id, name) pairs for districts),
+    inserting dimension rows for keys not seen before. Runs on the caller's
+    DBAPI cursor, inside its transaction.
+    """
+    table, columns = DIMENSIONS[kind]
+    cache = cache_for(info["storage"])
+    pending = info.setdefault(PENDING_KEY, {}).setdefault(kind, {})
+    ids = {}
+    missing = []
+    for key in keys:
+        id_ = cache.get(kind, key) or pending.get(key)
+        if id_ is None:
+            missing.append(key)
+        else:
+            ids[key] = id_
+
+    if missing:
+        # Committed by another process or an earlier run of this one
+        found = _select_ids(cursor, table, columns, missing)
+        cache.update(kind, found)
+        ids.update(found)
+        new = [key for key in missing if key not in found]
+        if new:
+            cursor.executemany(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                [key if len(columns) > 1 else (key,) for key in new]
+            )
+            created = _select_ids(cursor, table, columns, new)
+            pending.update(created)
+            ids.update(created)
+    return [ids[key] for key in keys]
+
+def resolve_frame(df: pd.DataFrame, cursor, info: dict, pincodes: list):
+    """
+    (state_ids, district_ids, pincode_ids) lists for a normalized frame.
+    Each distinct value is resolved once; None in pincodes is NO_PINCODE.
+    """
+    state_codes, states = pd.factorize(df['state'].astype(str))
+    state_id_of = np.asarray(resolve(cursor, info, "state", list(states)), dtype=np.int64)
+    state_ids = state_id_of[state_codes]
+
+    # Distinct (state, district) pairs via a combined code
+    district_codes, districts = pd.factorize(df['district'].astype(str))
+    n = max(1, len(districts))
+    pairs, pair_index = np.unique(state_codes.astype(np.int64) * n + district_codes, return_inverse=True)
+    keys = [(int(state_id_of[pair // n]), districts[pair % n]) for pair in pairs]
+    district_ids = np.asarray(resolve(cursor, info, "district", keys), dtype=np.int64)[pair_index]
+
+    pincode_codes, codes = pd.factorize(pd.Series(pincodes, dtype=object).fillna(NO_PINCODE))
+    pincode_ids = np.asarray(resolve(cursor, info, "pincode", list(codes)), dtype=np.int64)[pincode_codes]
+
+    return state_ids.tolist(), district_ids.tolist(), pincode_ids.tolist()
+
+def migrate_string_columns(db: Session) -> bool:
+    """
+    Convert an enrolment_data table from before the dimension tables (state,
+    district and pincode strings on every row) to integer keys. Row ids are
+    kept. Those tables had no natural key, so a file uploaded twice left two
+    copies of its rows; each key keeps only its latest row. Returns whether
+    the table was converted, in which case the aggregates need rebuilding.
+    """
+    fact = models.EnrolmentData.__tablename__
+    columns = {row[1] for row in db.execute(text(f"PRAGMA table_info({fact})"))}
+    if "state_id" in columns or "state" not in columns:
+        return False
+
+    db.execute(text(f"INSERT OR IGNORE INTO dim_state (name) SELECT DISTINCT state FROM {fact} WHERE state IS NOT NULL"))
+    db.execute(text(
+        f"INSERT OR IGNORE INTO dim_district (state_id, name) "
+        f"SELECT DISTINCT s.id, e.district FROM {fact} e JOIN dim_state s ON s.name = e.state "
+        f"WHERE e.district IS NOT NULL"
+    ))
+    db.execute(text(f"INSERT OR IGNORE INTO dim_pincode (code) SELECT DISTINCT COALESCE(pincode, :none) FROM {fact}"),
+               {"none": NO_PINCODE})
+
+    # The old table's index names would clash with the new table's
+    indexes = db.execute(text(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table AND sql IS NOT NULL"
+    ), {"table": fact}).scalars().all()
+    for name in indexes:
+        db.execute(text(f"DROP INDEX {name}"))
+    db.execute(text(f"ALTER TABLE {fact} RENAME TO {fact}_old"))
+    models.EnrolmentData.__table__.create(bind=db.connection())
+    db.execute(text(f"""
+        INSERT INTO {fact} (id, date, state_id, district_id, pincode_id,
+                            demo_age_0_5, demo_age_5_17, demo_age_17_plus, total)
+        SELECT o.id, o.date, s.id, d.id, p.id, o.demo_age_0_5, o.demo_age_5_17, o.demo_age_17_plus, o.total
+        FROM {fact}_old o
+        JOIN dim_state s ON s.name = o.state
+        JOIN dim_district d ON d.state_id = s.id AND d.name = o.district
+        JOIN dim_pincode p ON p.code = COALESCE(o.pincode, :none)
+        WHERE o.id IN (SELECT MAX(id) FROM {fact}_old GROUP BY date, state, district, COALESCE(pincode, :none))
+    """), {"none": NO_PINCODE})
+    db.execute(text(f"DROP TABLE {fact}_old"))
+    db.commit()
+    return True
+
+def no_pincode_id(cursor) -> int:
+    """Id of the NO_PINCODE row, inserting it if needed, on the caller's DBAPI cursor"""
+    table = models.Pincode.__tablename__
+    cursor.execute(f"INSERT OR IGNORE INTO {table} (code) VALUES (?)", (NO_PINCODE,))
+    return cursor.execute(f"SELECT id FROM {table} WHERE code = ?", (NO_PINCODE,)).fetchone()[0]
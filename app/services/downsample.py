@@ -0,0 +1,85 @@
+"""
+Shape-preserving downsampling of chart series.
+
+lttb() picks points by Largest-Triangle-Three-Buckets: the first and last
+points are kept, the rest of the series is cut into equal buckets, and each
+bucket keeps the point that forms the largest triangle with the point kept
+before it and the mean of the next bucket. Peaks and dips survive, unlike
+with averaging or taking every nth point, and every kept point is a real
+observation.
+"""
+import numpy as np
+import pandas as pd
+
+# Fewest points a downsampled series can have: its first, last and one between
+MIN_POINTS = 3
+
+def _lttb(x, y, starts, sizes, n: int) -> np.ndarray:
+    # LTTB of many series at once, series j being x/y[starts[j]:starts[j] + sizes[j]]
+    # with sizes[j] > n. Buckets are taken in step across the series, so the loop runs
+    # n times however many series there are. Returns the kept positions as (series, n)
+    count = len(starts)
+    ends = starts + sizes
+    # Bucket i of a series covers bounds[i] to bounds[i + 1]; the first point is alone
+    # before it, and the last bucket holds only the last point
+    bounds = np.column_stack([starts[:, None] + np.arange(n - 1) * (sizes[:, None] - 2) // (n - 2) + 1, ends])
+    # Bucket means, from sums over each bucket (and the gaps between series, unused)
+    edges = bounds.ravel()
+    lengths = np.diff(bounds, axis=1)
+    mean_x = np.add.reduceat(np.append(x, 0), edges).reshape(count, n)[:, :-1] / lengths
+    mean_y = np.add.reduceat(np.append(y, 0), edges).reshape(count, n)[:, :-1] / lengths
+    kept = np.empty((count, n), dtype=np.int64)
+    kept[:, 0], kept[:, -1] = starts, ends - 1
+    previous = starts
+    for i in range(n - 2):
+        # Every position of bucket i, series after series
+        size = lengths[:, i]
+        offsets = np.cumsum(size) - size
+        owner = np.repeat(np.arange(count), size)
+        positions = np.arange(size.sum()) + np.repeat(bounds[:, i] - offsets, size)
+        px, py = x[previous][owner], y[previous][owner]
+        # Twice the triangle areas with the previous kept point and the next bucket's mean;
+        # the factor does not change the argmax
+        areas = np.abs((px - mean_x[owner, i + 1]) * (y[positions] - py)
+                       - (px - x[positions]) * (mean_y[owner, i + 1] - py))
+        best = np.flatnonzero(areas == np.maximum.reduceat(areas, offsets)[owner])
+        # The first largest of each series
+        best = best[np.r_[True, owner[best[1:]] != owner[best[:-1]]]]
+        previous = kept[:, i + 1] = positions[best]
+    return kept
+
+def lttb(x, y, n: int) -> np.ndarray:
+    """Positions of the n points of the series (x, y) that LTTB keeps, ascending"""
+    size = len(x)
+    if n >= size or n < MIN_POINTS:
+        return np.arange(size)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    return _lttb(x, y, np.array([0]), np.array([size]), n)[0]
+
+def thin(columns: dict, key: str, value: str, max_points: int) -> dict:
+    """
+    Trend columns (parallel lists with "date", key and value) with each
+    series, the points sharing a key, cut to at most max_points by lttb().
+    Points keep their order.
+    """
+    keys = columns[key]
+    if len(keys) <= max_points:
+        return columns
+    codes = pd.factorize(pd.Series(keys, dtype=object))[0]
+    # Rows of each series in row (date) order, one series after another
+    order = np.argsort(codes, kind="stable")
+    sizes = np.bincount(codes)
+    starts = np.cumsum(sizes) - sizes
+    # Dates as day numbers; series share dates, so only the distinct ones are converted
+    day_codes, days = pd.factorize(pd.Series(columns["date"], dtype=object))
+    x = np.array([day.toordinal() for day in days], dtype=np.float64)[day_codes][order]
+    y = np.asarray(columns[value], dtype=np.float64)[order]
+    # Series no longer than max_points are kept whole
+    longer = sizes > max_points
+    keep = np.zeros(len(keys), dtype=bool)
+    keep[order[~np.repeat(longer, sizes)]] = True
+    if longer.any():
+        keep[order[_lttb(x, y, starts[longer], sizes[longer], max_points).ravel()]] = True
+    kept = np.flatnonzero(keep)
+    return {name: [values[i] for i in kept] for name, values in columns.items()}
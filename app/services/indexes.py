@@ -0,0 +1,101 @@
+"""
+Secondary index management.
+
+sync() brings an existing database's indexes in line with the models:
+indexes declared on a model (or, for the enrolment_data partitions, on
+EnrolmentData) are created if missing, and undeclared ones (left behind by
+an older schema) are dropped. deferred() is the bulk-load mode: the
+partitions a load writes to lose their secondary indexes when it first
+reaches them (the ones it creates never get them), and each is rebuilt in a
+single sorted pass afterwards, instead of updating every B-tree row by row. The
+natural-key unique index is never deferred since the upsert depends on it.
+"""
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from .. import models
+from . import partitions
+
+# Tables whose indexes are owned by the models, besides the enrolment_data partitions
+MANAGED_MODELS = [
+    models.DailyStateRollup,
+    models.DailyDistrictRollup,
+    models.StateTotal,
+    models.DistrictAnomalyScore,
+]
+
+def _existing(db: Session, table: str):
+    # Explicitly created indexes only; autoindexes back PRIMARY KEY / UNIQUE
+    return set(db.execute(text(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table AND sql IS NOT NULL"
+    ), {"table": table}).scalars())
+
+def sync(db: Session):
+    """Create missing model indexes and drop ones no model declares. Commits if anything changed."""
+    changed = False
+    connection = db.connection()
+    for table in [model.__table__ for model in MANAGED_MODELS] + partitions.tables(db):
+        declared = {index.name: index for index in table.indexes}
+        existing = _existing(db, table.name)
+        for name in existing - set(declared):
+            db.execute(text(f"DROP INDEX {name}"))
+            changed = True
+        for name in set(declared) - existing:
+            declared[name].create(bind=connection)
+            changed = True
+    if changed:
+        db.commit()
+
+class DeferredIndexes:
+    """
+    Partitions a bulk load has taken the secondary indexes off, to be rebuilt
+    when it ends. The load passes this to ingestion.insert_frame, which
+    covers each month it writes to before merging into it.
+    """
+
+    def __init__(self):
+        self.months = set()
+        self.drop_seconds = 0.0
+
+    def cover(self, cursor, months):
+        """
+        Drop the secondary indexes of months the load has not written to
+        before, in the cursor's transaction. Partitions it created are
+        already without them.
+        """
+        started = time.perf_counter()
+        for month in months:
+            if month not in self.months:
+                for index in partitions.table(month).indexes:
+                    cursor.execute(f"DROP INDEX IF EXISTS {index.name}")
+                self.months.add(month)
+        self.drop_seconds += time.perf_counter() - started
+
+@contextmanager
+def deferred(db: Session, timings: dict = None):
+    """
+    Run a bulk load with the secondary indexes off the partitions it writes
+    to, then rebuild them. Yields the DeferredIndexes the load passes to
+    each insert; other writers and partitions it does not reach keep their
+    indexes. The indexes are rebuilt even if the body fails. timings, if
+    given, receives drop_seconds and rebuild_seconds.
+    """
+    deferral = DeferredIndexes()
+    try:
+        yield deferral
+    finally:
+        db.rollback()
+        rebuild_started = time.perf_counter()
+        connection = db.connection()
+        # Retention may have dropped a covered month meanwhile
+        for table in partitions.tables(db):
+            if table.info["month"] in deferral.months:
+                for index in table.indexes:
+                    index.create(bind=connection, checkfirst=True)
+        db.commit()
+        if timings is not None:
+            timings["drop_seconds"] = round(deferral.drop_seconds, 3)
+            timings["rebuild_seconds"] = round(time.perf_counter() - rebuild_started, 3)
@@ -1,70 +1,339 @@
 import pandas as pd
 from sqlalchemy.orm import Session
-from .. import models
+from .. import database
+from . import aggregates, anomalies, dimensions, indexes, partitions
 from datetime import datetime
+from itertools import islice
 import io
+import os
+import time
+
+try:
+    import pyarrow
+    import pyarrow.csv as pyarrow_csv
+except ImportError:
+    pyarrow = None
+    pyarrow_csv = None
+
+# Rows per chunk for streaming ingestion. Keeps peak memory bounded regardless
+# of the size of the uploaded file.
+DEFAULT_CHUNK_SIZE = 50_000
+
+# Known CSV header layouts, mapped to DB columns. The layout is detected once
+# per file from its header row.
+HEADER_FORMATS = {
+    # Expected: Date, State, District, Pincode, Demo_age_5_17, Demo_age_17+
+    "legacy": {
+        "Date": "date",
+        "State": "state",
+        "District": "district",
+        "Pincode": "pincode",
+        "Demo_age_5_17": "demo_age_5_17",
+        "Demo_age_17+": "demo_age_17_plus",
+    },
+    # New format support
+    "age_buckets": {
+        "date": "date",
+        "state": "state",
+        "district": "district",
+        "pincode": "pincode",
+        "age_0_5": "demo_age_0_5",
+        "age_5_17": "demo_age_5_17",
+        "age_18_greater": "demo_age_17_plus",
+    },
+    # Another format variation (data.gov.in API)
+    "api": {
+        "date": "date",
+        "state": "state",
+        "district": "district",
+        "pincode": "pincode",
+        "demo_age_5_17": "demo_age_5_17",
+        "demo_age_17_": "demo_age_17_plus",
+    },
+}
+
+# Union of all layouts, used when a header matches none of them exactly
+COLUMN_MAP = {source: target for layout in HEADER_FORMATS.values() for source, target in layout.items()}
+
+NUMERIC_COLS = ['demo_age_0_5', 'demo_age_5_17', 'demo_age_17_plus']
+KEY_COLS = ['date', 'state', 'district', 'pincode']
+# The same key in enrolment_data, with strings replaced by dimension ids
+FACT_KEY_COLS = ['date', 'state_id', 'district_id', 'pincode_id']
+
+# Fixed dtypes per DB column. Everything is read as text except the age
+# counts, which are read as float so blanks survive until fillna.
+COLUMN_DTYPES = {
+    "date": "str",
+    "state": "str",
+    "district": "str",
+    "pincode": "str",
+    "demo_age_0_5": "float64",
+    "demo_age_5_17": "float64",
+    "demo_age_17_plus": "float64",
+}
+
+# CSV parser: "c" (pandas default) or "pyarrow" if it is installed
+CSV_ENGINE = os.getenv("CSV_ENGINE", "c")
+
+# Rows per executemany() call on the fast-load path
+FAST_LOAD_BATCH_SIZE = 100_000
+
+def detect_header_format(columns):
+    """Return the HEADER_FORMATS layout that matches the given header, or None"""
+    columns = set(c.strip() for c in columns)
+    for layout in HEADER_FORMATS.values():
+        if set(layout) <= columns:
+            return layout
+    return None
+
+def parse_dates(values: pd.Series) -> pd.Series:
+    """
+    Parse DD-MM-YYYY style dates. A file holds only a few hundred distinct date
+    strings, so each one is parsed once and the result mapped back by code.
+    """
+    codes, uniques = pd.factorize(values)
+    parsed = pd.to_datetime(pd.Series(uniques, dtype=object), errors='coerce', dayfirst=True)
+    dates = parsed.take(codes.clip(min=0)).reset_index(drop=True)
+    dates[codes < 0] = pd.NaT
+    dates.index = values.index
+    return dates
+
+def clean_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Drop unusable rows and fill/convert columns of a frame already in DB column names"""
+    # Drop rows where critical fields are null
+    df = df.dropna(subset=['date', 'state', 'district'])
+
+    # Fill numeric nulls with 0
+    for col in NUMERIC_COLS:
+        if col not in df.columns:
+            df[col] = 0
+        df[col] = df[col].fillna(0)
+
+    # Date parsing
+    # Assuming format might vary, but standard is usually YYYY-MM-DD or DD-MM-YYYY
+    # dayfirst=True handles DD-MM-YYYY
+    df['date'] = parse_dates(df['date'])
+    df = df.dropna(subset=['date']) # Drop invalid dates
+    return df
+
+def normalize_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Rename, clean and type a raw CSV frame into EnrolmentData columns"""
+    # Standardize column names (stripping spaces, lowercase)
+    df.columns = df.columns.str.strip()
+    df = df.rename(columns=COLUMN_MAP)
+    return clean_frame(df)
+
+def _resolve_engine(engine):
+    engine = engine or CSV_ENGINE
+    if engine == "pyarrow" and pyarrow_csv is None:
+        print("Warning: pyarrow is not installed, falling back to the C CSV parser.")
+        return "c"
+    return engine
+
+def _peek_header(file_obj):
+    # Column names as the parsers see them: quotes removed, padding kept
+    position = file_obj.tell()
+    line = file_obj.readline()
+    file_obj.seek(position)
+    if isinstance(line, bytes):
+        line = line.decode('utf-8-sig')
+    return [c[1:-1] if len(c) > 1 and c[0] == c[-1] == '"' else c for c in line.rstrip('\r\n').split(',')]
+
+def _as_spelled(layout, header):
+    # The layout keyed by the header's own spelling of each column, which
+    # may be padded with spaces (detect_header_format matches stripped names)
+    spelled = {name.strip(): name for name in header}
+    return {spelled[source]: target for source, target in layout.items()}
+
+def _iter_pyarrow_frames(file_obj, layout, chunk_size):
+    # pandas cannot chunk with the pyarrow engine, so stream record batches
+    # straight from pyarrow; a batch holds roughly chunk_size rows
+    position = file_obj.tell()
+    sample = file_obj.read(1 << 16)
+    file_obj.seek(position)
+    bytes_per_row = max(1, len(sample) // max(1, sample.count(b"\n")))
+    reader = pyarrow_csv.open_csv(
+        file_obj,
+        read_options=pyarrow_csv.ReadOptions(block_size=max(1 << 16, bytes_per_row * chunk_size)),
+        convert_options=pyarrow_csv.ConvertOptions(
+            include_columns=list(layout),
+            column_types={source: pyarrow.string() if COLUMN_DTYPES[target] == "str" else pyarrow.float64()
+                          for source, target in layout.items()}
+        )
+    )
+    for batch in reader:
+        yield batch.to_pandas()
+
+def read_csv_frames(source, chunk_size: int = None, engine: str = None):
+    """
+    Parse CSV bytes or a binary file object into normalized frames.
+    Yields (raw_rows, frame) per chunk, or once for the whole input when
+    chunk_size is None. Known header layouts are read with fixed dtypes and
+    only the columns that are needed; unknown ones fall back to inference.
+    """
+    file_obj = io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+    header = _peek_header(file_obj)
+    layout = detect_header_format(header)
+    if layout is not None:
+        layout = _as_spelled(layout, header)
+    engine = _resolve_engine(engine)
+
+    if layout is None:
+        reader = pd.read_csv(file_obj, chunksize=chunk_size)
+        frames = reader if chunk_size else [reader]
+        for df in frames:
+            yield len(df), normalize_frame(df)
+        return
+
+    if engine == "pyarrow" and chunk_size:
+        frames = _iter_pyarrow_frames(file_obj, layout, chunk_size)
+    else:
+        dtypes = {source: COLUMN_DTYPES[target] for source, target in layout.items()}
+        reader = pd.read_csv(file_obj, usecols=list(layout), dtype=dtypes, engine=engine,
+                             chunksize=chunk_size if engine != "pyarrow" else None)
+        frames = reader if chunk_size else [reader]
+
+    for df in frames:
+        df = df.rename(columns=layout)
+        yield len(df), clean_frame(df)
+
+def _stage_sql():
+    columns = FACT_KEY_COLS + NUMERIC_COLS
+    return f"INSERT INTO {aggregates.STAGING_TABLE} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+
+def _merge_sql(month):
+    # Moves the staged rows of one month into its partition. Re-ingesting a
+    # known (date, state, district, pincode) overwrites its counts instead of
+    # adding a duplicate row
+    table = partitions.table_name(month)
+    columns = ", ".join(FACT_KEY_COLS + NUMERIC_COLS)
+    updates = ", ".join(f"{col} = excluded.{col}" for col in NUMERIC_COLS + ["total"])
+    # The WHERE clause also keeps SQLite from reading ON CONFLICT as a join constraint
+    return (
+        f"INSERT INTO {table} ({columns}, total) "
+        f"SELECT {columns}, {aggregates.TOTAL_SQL} FROM {aggregates.STAGING_TABLE} WHERE date >= ? AND date < ? "
+        f"ON CONFLICT ({', '.join(FACT_KEY_COLS)}) DO UPDATE SET {updates}"
+    )
+
+def _pincode_values(df: pd.DataFrame):
+    if 'pincode' not in df.columns:
+        return [None] * len(df)
+    pincode = df['pincode']
+    if pd.api.types.is_numeric_dtype(pincode):
+        # Numeric pincodes would otherwise be stored as "364070.0"
+        pincode = pincode.astype('Int64').astype('string')
+    else:
+        pincode = pincode.astype('string').str.strip()
+    return pincode.astype(object).where(pincode.notna(), None).tolist()
+
+def frame_rows(df: pd.DataFrame, cursor, info: dict):
+    """
+    Typed column tuples for a normalized frame, in FACT_KEY_COLS + NUMERIC_COLS
+    order. State, district and pincode are resolved to dimension ids on cursor.
+    """
+    state_ids, district_ids, pincode_ids = dimensions.resolve_frame(df, cursor, info, _pincode_values(df))
+    return zip(
+        df['date'].dt.strftime('%Y-%m-%d').tolist(),
+        state_ids,
+        district_ids,
+        pincode_ids,
+        *(df[col].astype('int64').tolist() for col in NUMERIC_COLS)
+    )
+
+def insert_frame(df: pd.DataFrame, db: Session, deferral: indexes.DeferredIndexes = None):
+    """
+    Upsert a normalized frame without committing. Returns the row count.
+    Rows go straight to the DBAPI cursor as tuples via executemany, bypassing
+    per-row dicts and the ORM, on the session's connection and transaction.
+    Each batch is staged in a temp table first so the aggregate tables can be
+    updated by the exact change the batch makes, in the same transaction, and
+    is then merged into the month partitions its rows belong to. With the
+    deferral of a bulk load (see indexes.deferred), the partitions written
+    to go without their secondary indexes until the load ends.
+    """
+    connection = db.connection()
+    database.tune_for_bulk_load(connection)
+    cursor = connection.connection.driver_connection.cursor()
+
+    stage_sql = _stage_sql()
+    info = connection.connection.info
+    rows = frame_rows(df, cursor, info)
+    try:
+        while True:
+            batch = list(islice(rows, FAST_LOAD_BATCH_SIZE))
+            if not batch:
+                break
+            aggregates.create_staging_table(cursor)
+            cursor.executemany(stage_sql, batch)
+            months = partitions.ensure(cursor, {partitions.month_of(row[0]) for row in batch},
+                                       with_indexes=deferral is None)
+            if deferral is not None:
+                deferral.cover(cursor, months)
+            aggregates.apply_staged_deltas(cursor, months)
+            for month in months:
+                cursor.execute(_merge_sql(month), partitions.bounds(month))
+    finally:
+        cursor.close()
+    return len(df)
+
+def parse_csv_bytes(file_content: bytes) -> pd.DataFrame:
+    """Read and normalize an in-memory CSV payload"""
+    _, df = next(read_csv_frames(file_content))
+    return df
 
 def process_csv_and_ingest(file_content: bytes, db: Session):
     try:
-        # Read CSV
-        df = pd.read_csv(io.BytesIO(file_content))
-        
-        # Standardize column names (stripping spaces, lowercase)
-        df.columns = df.columns.str.strip()
-        
-        # Mapping CSV columns to DB columns
-        # Expected: Date, State, District, Pincode, Demo_age_5_17, Demo_age_17+
-        # DB: date, state, district, pincode, demo_age_5_17, demo_age_17_plus
-        
-        column_map = {
-            "Date": "date",
-            "State": "state",
-            "District": "district",
-            "Pincode": "pincode",
-            "Demo_age_5_17": "demo_age_5_17",
-            "Demo_age_17+": "demo_age_17_plus",
-            # New format support
-            "date": "date",
-            "state": "state",
-            "district": "district",
-            "pincode": "pincode",
-            "age_0_5": "demo_age_0_5",
-            "age_5_17": "demo_age_5_17",
-            "age_18_greater": "demo_age_17_plus",
-            # Another format variation
-            "demo_age_17_": "demo_age_17_plus"
-        }
-        
-        # Renaissance checks / renaming
-        # Check if columns exist, if not try case insensitive search
-        
-        df = df.rename(columns=column_map)
-        
-        # Drop rows where critical fields are null
-        df = df.dropna(subset=['date', 'state', 'district'])
-        
-        # Fill numeric nulls with 0
-        numeric_cols = ['demo_age_0_5', 'demo_age_5_17', 'demo_age_17_plus']
-        for col in numeric_cols:
-            if col not in df.columns:
-                df[col] = 0
-            df[col] = df[col].fillna(0)
-        
-        # Date parsing
-        # Assuming format might vary, but standard is usually YYYY-MM-DD or DD-MM-YYYY
-        # We will use pd.to_datetime with infer_datetime_format and dayfirst=True to handle DD-MM-YYYY
-        df['date'] = pd.to_datetime(df['date'], errors='coerce', dayfirst=True)
-        df = df.dropna(subset=['date']) # Drop invalid dates
-        
-        # Convert to dictionary records
-        records = df.to_dict(orient='records')
-        
-        # Bulk Insert
-        db.bulk_insert_mappings(models.EnrolmentData, records)
+        df = parse_csv_bytes(file_content)
+
+        count = insert_frame(df, db)
         db.commit()
-        
-        return len(records)
-        
+        anomalies.refresh(db)
+
+        return count
+
+    except Exception as e:
+        db.rollback()
+        raise e
+
+def process_csv_stream_and_ingest(file_obj, db: Session, chunk_size: int = DEFAULT_CHUNK_SIZE, progress_callback=None,
+                                  defer_indexes: bool = False, timings: dict = None):
+    """
+    Streams a CSV file object into the database in fixed-size chunks.
+    Each chunk is normalized, inserted and committed before the next one is
+    read, so only one chunk is held in memory at a time.
+    progress_callback, if given, is called as (chunk_number, chunk_rows, total_rows).
+    With defer_indexes, the secondary indexes of the partitions the load
+    writes to are dropped as it reaches them and rebuilt once at the end (see
+    services/indexes.py); worthwhile for loads that are large relative to
+    the table. timings, if given, receives
+    load_seconds and, when deferring, drop_seconds and rebuild_seconds.
+    """
+    timings = {} if timings is None else timings
+    started = time.perf_counter()
+    if defer_indexes:
+        with indexes.deferred(db, timings) as deferral:
+            total = _ingest_chunks(file_obj, db, chunk_size, progress_callback, deferral)
+    else:
+        total = _ingest_chunks(file_obj, db, chunk_size, progress_callback)
+    timings["load_seconds"] = round(time.perf_counter() - started, 3)
+    return total
+
+def _ingest_chunks(file_obj, db: Session, chunk_size: int, progress_callback, deferral=None):
+    total = 0
+    try:
+        for chunk_number, (_, chunk) in enumerate(read_csv_frames(file_obj, chunk_size), start=1):
+            count = insert_frame(chunk, db, deferral)
+            db.commit()
+
+            total += count
+            if progress_callback:
+                progress_callback(chunk_number, count, total)
+            else:
+                print(f"Chunk {chunk_number}: ingested {count} records ({total} total)")
+
+        anomalies.refresh(db)
+        return total
+
     except Exception as e:
         db.rollback()
         raise e
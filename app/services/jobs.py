@@ -0,0 +1,196 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from .. import database
+from . import ingestion, api_fetcher, datasets
+
+# Number of uploads/syncs that may run at the same time
+DEFAULT_JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Finished jobs kept for status polling
+MAX_FINISHED_JOBS = 100
+
+class JobCancelled(Exception):
+    """Raised inside a job's work when a cancel has been requested"""
+
+class Job:
+    """State of one background upload or sync"""
+
+    def __init__(self, kind: str, description: str = "", total_rows: int = None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.description = description
+        self.status = "queued"
+        self.rows_done = 0
+        self.total_rows = total_rows
+        # Fraction complete (0..1) when the work can estimate it, e.g. bytes read
+        self.progress = None
+        self.message = None
+        self.errors = []
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def cancel_requested(self):
+        return self._cancel_event.is_set()
+
+    def update(self, rows_done: int = None, progress: float = None):
+        """Report progress. Raises JobCancelled if the job should stop."""
+        with self._lock:
+            if rows_done is not None:
+                self.rows_done = rows_done
+            if progress is not None:
+                self.progress = min(1.0, progress)
+        if self._cancel_event.is_set():
+            raise JobCancelled(f"Job {self.id} cancelled after {self.rows_done} records.")
+
+    def _fraction_done(self):
+        if self.progress is not None:
+            return self.progress
+        if self.total_rows:
+            return min(1.0, self.rows_done / self.total_rows)
+        return None
+
+    def to_dict(self):
+        with self._lock:
+            end = self.finished_at or time.time()
+            elapsed = end - self.started_at if self.started_at else 0.0
+            rate = self.rows_done / elapsed if elapsed > 0 else 0.0
+            fraction = self._fraction_done()
+            eta = None
+            if self.status == "running" and fraction:
+                eta = elapsed * (1 - fraction) / fraction
+            return {
+                "id": self.id,
+                "kind": self.kind,
+                "description": self.description,
+                "status": self.status,
+                "rows_done": self.rows_done,
+                "total_rows": self.total_rows,
+                "progress": round(fraction, 4) if fraction is not None else None,
+                "rate": round(rate, 1),
+                "elapsed_seconds": round(elapsed, 1),
+                "eta_seconds": round(eta, 1) if eta is not None else None,
+                "message": self.message,
+                "errors": list(self.errors),
+            }
+
+class JobManager:
+    """Runs jobs on a bounded thread pool and keeps their status for polling"""
+
+    def __init__(self, max_workers: int = DEFAULT_JOB_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind: str, work, description: str = "", total_rows: int = None, cleanup=None) -> Job:
+        """
+        Queue work(job) to run in the background and return the Job at once.
+        work returns a result message; cleanup, if given, runs when it ends.
+        """
+        job = Job(kind, description, total_rows)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        self._executor.submit(self._run, job, work, cleanup)
+        return job
+
+    def _run(self, job: Job, work, cleanup):
+        try:
+            if job.cancel_requested:
+                raise JobCancelled(f"Job {job.id} cancelled before it started.")
+            job.status = "running"
+            job.started_at = time.time()
+            job.message = work(job)
+            job.status = "succeeded"
+            if job.progress is not None:
+                job.progress = 1.0
+        except JobCancelled as e:
+            job.status = "cancelled"
+            job.message = str(e)
+        except Exception as e:
+            job.status = "failed"
+            job.errors.append(str(e))
+        finally:
+            job.finished_at = time.time()
+            if cleanup:
+                cleanup()
+
+    def _prune(self):
+        finished = [j for j in self._jobs.values() if j.finished_at]
+        for job in sorted(finished, key=lambda j: j.finished_at)[:-MAX_FINISHED_JOBS or None]:
+            del self._jobs[job.id]
+
+    def get(self, job_id: str):
+        return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda j: j.created_at, reverse=True)
+
+    def cancel(self, job_id: str):
+        """Request cancellation. Running jobs stop at their next progress report."""
+        job = self._jobs.get(job_id)
+        if job and not job.finished_at:
+            job._cancel_event.set()
+        return job
+
+job_manager = JobManager()
+
+def _described(description: str, dataset: str) -> str:
+    return description if dataset == database.DEFAULT_DATASET else f"{description} [{dataset}]"
+
+def submit_upload(path: str, filename: str, chunk_size: int = None, delete_after: bool = True,
+                  defer_indexes: bool = False, dataset: str = database.DEFAULT_DATASET) -> Job:
+    """Stream a CSV file on disk into a dataset as a background job"""
+    size = os.path.getsize(path)
+    database.validate_dataset_name(dataset)
+
+    def work(job: Job):
+        db = datasets.get(dataset).SessionLocal()
+        try:
+            with open(path, "rb") as f:
+                def on_chunk(chunk_number, chunk_rows, total_rows):
+                    job.update(rows_done=total_rows, progress=f.tell() / size if size else None)
+
+                count = ingestion.process_csv_stream_and_ingest(
+                    f, db, chunk_size=chunk_size or ingestion.DEFAULT_CHUNK_SIZE, progress_callback=on_chunk,
+                    defer_indexes=defer_indexes)
+            return f"Successfully processed {count} records."
+        finally:
+            db.close()
+
+    def cleanup():
+        if delete_after and os.path.exists(path):
+            os.remove(path)
+
+    return job_manager.submit("upload", work, description=_described(filename, dataset), cleanup=cleanup)
+
+def submit_sync(filters: str = "", dataset: str = database.DEFAULT_DATASET, **sync_params) -> Job:
+    """
+    Run api_fetcher.fetch_and_sync_data(**sync_params) into a dataset as a
+    background job. filters is a readable summary of the sync parameters for
+    status messages.
+    """
+    database.validate_dataset_name(dataset)
+    filter_str = f" with filters: {filters}" if filters else ""
+    # Without fetch_all a sync pulls at most one page of `limit` records
+    total_rows = None if sync_params.get("fetch_all") else sync_params.get("limit")
+
+    def work(job: Job):
+        db = datasets.get(dataset).SessionLocal()
+        try:
+            def on_page(page_number, page_rows, total_rows):
+                job.update(rows_done=total_rows)
+
+            count = api_fetcher.fetch_and_sync_data(db, progress_callback=on_page, **sync_params)
+            return f"Successfully synced {count} records from API{filter_str}."
+        finally:
+            db.close()
+
+    return job_manager.submit("sync", work, description=_described(f"API sync{filter_str}", dataset),
+                              total_rows=total_rows)
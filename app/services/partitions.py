@@ -0,0 +1,233 @@
+"""
+Month partitions of enrolment_data.
+
+Each calendar month of rows is stored in its own table, enrolment_data_YYYYMM,
+built from the EnrolmentData model: the same columns, natural key and
+indexes, with the month in the index names. enrolment_data itself is a view
+that UNION ALLs the partitions, so reads over the whole history still go
+through the model unchanged.
+
+Queries with a date range read only the partitions it touches (tables()).
+Ingest creates partitions as rows for new months arrive (ensure()) and merges
+each batch into the partitions of its rows' months. drop() takes whole
+months out of the aggregates and drops their tables, so retention never
+deletes rows one at a time.
+"""
+import re
+import threading
+from datetime import date, timedelta
+
+from sqlalchemy import MetaData, Table, text
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from .. import models
+from . import aggregates, anomalies, dimensions
+
+FACT_TABLE = models.EnrolmentData.__tablename__
+MONTH = re.compile(r"^\d{4}-(0[1-9]|1[0-2])$")
+# sqlite_master GLOB for partition table names
+PARTITION_GLOB = f"{FACT_TABLE}_[0-9][0-9][0-9][0-9][0-9][0-9]"
+
+# Partition tables are described apart from the models, next to the dimension
+# tables their foreign keys name
+_metadata = MetaData()
+for _model in (models.State, models.District, models.Pincode):
+    _model.__table__.to_metadata(_metadata)
+_metadata_lock = threading.Lock()
+_dialect = sqlite.dialect()
+
+def validate_month(month: str) -> str:
+    """Return month if it is a YYYY-MM string, else raise ValueError"""
+    if not isinstance(month, str) or not MONTH.match(month):
+        raise ValueError(f"Invalid month {month!r}. Use YYYY-MM.")
+    return month
+
+def month_of(day) -> str:
+    """YYYY-MM of a date or an ISO date string"""
+    return day.isoformat()[:7] if isinstance(day, date) else day[:7]
+
+def bounds(month: str):
+    """(first day, first day of the next month) as ISO strings, for date >= ? AND date < ?"""
+    year, number = int(month[:4]), int(month[5:7])
+    return f"{month}-01", f"{year + number // 12:04d}-{number % 12 + 1:02d}-01"
+
+def table_name(month: str) -> str:
+    return f"{FACT_TABLE}_{month[:4]}{month[5:7]}"
+
+def table(month: str) -> Table:
+    """Table of a month's partition, whether or not it exists yet"""
+    name = table_name(month)
+    with _metadata_lock:
+        partition = _metadata.tables.get(name)
+        if partition is None:
+            partition = models.EnrolmentData.__table__.to_metadata(_metadata, name=name)
+            partition.info["month"] = month
+            # Index names are per database; column-flag indexes already follow the table name
+            for index in partition.indexes:
+                if name not in index.name:
+                    index.name = index.name.replace(FACT_TABLE, name, 1)
+        return partition
+
+def _months(names) -> list:
+    return sorted(f"{name[-6:-2]}-{name[-2:]}" for name in names)
+
+def months(db: Session) -> list:
+    """Months that have a partition, oldest first"""
+    return _months(db.execute(text(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB :pattern"
+    ), {"pattern": PARTITION_GLOB}).scalars())
+
+def tables(db: Session, start: date = None, end: date = None) -> list:
+    """Partitions that can hold rows dated from start to end (both optional), oldest first"""
+    first = month_of(start) if start else None
+    last = month_of(end) if end else None
+    return [table(month) for month in months(db)
+            if (first is None or month >= first) and (last is None or month <= last)]
+
+def within(partition: Table, start: date = None, end: date = None) -> bool:
+    """
+    Whether a date range covers the partition's whole month, so queries on it
+    need no date condition (which would steer SQLite to the natural key)
+    """
+    first, following = bounds(partition.info["month"])
+    return ((start is None or start.isoformat() <= first)
+            and (end is None or end + timedelta(days=1) >= date.fromisoformat(following)))
+
+def _cursor(db: Session):
+    return db.connection().connection.driver_connection.cursor()
+
+def _begin(cursor):
+    # pysqlite only opens a transaction before DML; DDL would otherwise commit on its own
+    if not cursor.connection.in_transaction:
+        cursor.execute("BEGIN")
+
+def _create(cursor, month: str, with_indexes: bool = True):
+    partition = table(month)
+    cursor.execute(str(CreateTable(partition).compile(dialect=_dialect)))
+    if with_indexes:
+        for index in partition.indexes:
+            cursor.execute(str(CreateIndex(index).compile(dialect=_dialect)))
+
+def _replace_view(cursor, partitioned: list):
+    columns = ", ".join(column.name for column in models.EnrolmentData.__table__.columns)
+    if partitioned:
+        body = " UNION ALL ".join(f"SELECT {columns} FROM {table_name(month)}" for month in partitioned)
+    else:
+        body = "SELECT " + ", ".join(f"NULL AS {column.name}" for column in models.EnrolmentData.__table__.columns) + " WHERE 0"
+    cursor.execute(f"DROP VIEW IF EXISTS {FACT_TABLE}")
+    cursor.execute(f"CREATE VIEW {FACT_TABLE} AS {body}")
+
+def ensure(cursor, wanted, with_indexes: bool = True) -> list:
+    """
+    Create the partitions of the wanted months that do not exist yet, in the
+    cursor's transaction, and return the wanted months sorted. A bulk load
+    that defers secondary indexes (see indexes.deferred) passes
+    with_indexes=False.
+    """
+    wanted = sorted(set(wanted))
+    existing = set(_months(row[0] for row in cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB ?", (PARTITION_GLOB,)
+    )))
+    missing = [month for month in wanted if month not in existing]
+    if missing:
+        _begin(cursor)
+        for month in missing:
+            _create(cursor, month, with_indexes=with_indexes)
+        _replace_view(cursor, sorted(existing.union(missing)))
+    return wanted
+
+def migrate(db: Session):
+    """
+    Split an enrolment_data table from before partitioning into month
+    partitions, keeping row ids, and put the view in its place. Secondary
+    indexes are left to indexes.sync(), which builds each in one pass.
+    """
+    kind = db.execute(text("SELECT type FROM sqlite_master WHERE name = :name"), {"name": FACT_TABLE}).scalar()
+    if kind == "view":
+        return
+    cursor = _cursor(db)
+    _begin(cursor)
+    found = []
+    if kind == "table":
+        columns = ", ".join(column.name for column in models.EnrolmentData.__table__.columns)
+        found = sorted(row[0] for row in cursor.execute(
+            f"SELECT DISTINCT substr(date, 1, 7) FROM {FACT_TABLE} WHERE date IS NOT NULL"
+        ).fetchall())
+        for month in found:
+            _create(cursor, month, with_indexes=False)
+            # The natural key leads with date, so each month is one index range
+            cursor.execute(
+                f"INSERT INTO {table_name(month)} ({columns}) SELECT {columns} FROM {FACT_TABLE} "
+                f"WHERE date >= ? AND date < ? ORDER BY id", bounds(month)
+            )
+        cursor.execute(f"DROP TABLE {FACT_TABLE}")
+    _replace_view(cursor, found)
+    db.commit()
+
+def migrate_missing_pincodes(db: Session) -> bool:
+    """
+    Rebuild partitions from when rows without a pincode had a NULL
+    pincode_id, which never matched another row's in the natural key, so
+    re-ingesting such rows added copies. Each key keeps its latest row,
+    pointed at the dimensions.NO_PINCODE row. Secondary indexes are left
+    to indexes.sync(). Returns whether any partition was rebuilt, in which
+    case the aggregates need rebuilding.
+    """
+    nullable = [month for month in months(db) if not any(
+        row[1] == "pincode_id" and row[3]
+        for row in db.execute(text(f"PRAGMA table_info({table_name(month)})")))]
+    if not nullable:
+        return False
+    cursor = _cursor(db)
+    _begin(cursor)
+    none = dimensions.no_pincode_id(cursor)
+    columns = [column.name for column in models.EnrolmentData.__table__.columns]
+    copied = ", ".join("COALESCE(pincode_id, :none)" if name == "pincode_id" else name for name in columns)
+    # Renaming a partition would rewrite the view to name its old table
+    cursor.execute(f"DROP VIEW {FACT_TABLE}")
+    for month in nullable:
+        name = table_name(month)
+        for (index,) in cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (name,)
+        ).fetchall():
+            cursor.execute(f"DROP INDEX {index}")
+        cursor.execute(f"ALTER TABLE {name} RENAME TO {name}_old")
+        _create(cursor, month, with_indexes=False)
+        cursor.execute(
+            f"INSERT INTO {name} ({', '.join(columns)}) SELECT {copied} FROM {name}_old "
+            f"WHERE id IN (SELECT MAX(id) FROM {name}_old "
+            f"GROUP BY date, state_id, district_id, COALESCE(pincode_id, :none)) ORDER BY id", {"none": none}
+        )
+        cursor.execute(f"DROP TABLE {name}_old")
+    _replace_view(cursor, months(db))
+    db.commit()
+    return True
+
+def list_partitions(db: Session):
+    """Every partition with its record count, from the daily rollup, oldest first"""
+    rollup = models.DailyStateRollup.__tablename__
+    counts = dict(db.execute(text(
+        f"SELECT substr(date, 1, 7), SUM(row_count) FROM {rollup} GROUP BY substr(date, 1, 7)"
+    )).all())
+    return [{"month": month, "table": table_name(month), "records": counts.get(month, 0)} for month in months(db)]
+
+def drop(db: Session, dropped: list) -> int:
+    """
+    Delete every row of the given months, which must have partitions: their
+    rows are subtracted from the aggregates and their tables dropped, in one
+    transaction. Anomaly scores after them are then recomputed. Returns the
+    number of rows deleted.
+    """
+    remaining = [month for month in months(db) if month not in dropped]
+    cursor = _cursor(db)
+    _begin(cursor)
+    rows = 0
+    for month in dropped:
+        rows += aggregates.remove_dates(cursor, *bounds(month))
+        cursor.execute(f"DROP TABLE {table_name(month)}")
+    _replace_view(cursor, remaining)
+    db.commit()
+    anomalies.refresh(db)
+    return rows
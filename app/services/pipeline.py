@@ -0,0 +1,143 @@
+import queue
+import threading
+import time
+
+# Marks the end of a stage's output
+_DONE = object()
+
+class StageStats:
+    """Throughput counters for one pipeline stage"""
+
+    def __init__(self, name: str, unit: str = "rows"):
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.rows = 0
+        self.busy_seconds = 0.0
+
+    def record(self, rows: int, seconds: float):
+        self.items += 1
+        self.rows += rows
+        self.busy_seconds += seconds
+
+    def as_dict(self):
+        rate = self.rows / self.busy_seconds if self.busy_seconds else 0.0
+        return {
+            "items": self.items,
+            self.unit: self.rows,
+            "busy_seconds": round(self.busy_seconds, 3),
+            f"{self.unit}_per_second": round(rate, 1)
+        }
+
+class Pipeline:
+    """
+    Runs source -> transform -> sink with each of the first two stages on its
+    own thread, connected by bounded queues. When a downstream stage falls
+    behind the queues fill up and the upstream stages block (backpressure).
+
+    - source: iterable of items; measure_source(item) returns its size in source_unit
+    - transform: item -> item, run on the parse thread; measure(result) returns its row count
+    - sink: called on the caller's thread for every transformed item
+    """
+
+    def __init__(self, queue_size: int = 4):
+        self.queue_size = queue_size
+        self.stop_event = threading.Event()
+        self.stats = {}
+        self._errors = []
+
+    def _put(self, q: queue.Queue, item):
+        # Blocking put that gives up once the pipeline is stopping
+        while not self.stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: queue.Queue):
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if self.stop_event.is_set():
+                    return _DONE
+
+    def _run_source(self, name, source, measure, out_q):
+        stats = self.stats[name]
+        iterator = iter(source)
+        try:
+            while not self.stop_event.is_set():
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                stats.record(measure(item), time.perf_counter() - started)
+                if not self._put(out_q, item):
+                    break
+        except Exception as e:
+            self._errors.append(e)
+            self.stop_event.set()
+        finally:
+            # Let generator sources release their resources (e.g. thread pools)
+            if hasattr(iterator, "close"):
+                iterator.close()
+            self._put(out_q, _DONE)
+
+    def _run_transform(self, name, transform, measure, in_q, out_q):
+        stats = self.stats[name]
+        try:
+            while True:
+                item = self._get(in_q)
+                if item is _DONE:
+                    break
+                started = time.perf_counter()
+                result = transform(item)
+                stats.record(measure(result), time.perf_counter() - started)
+                if not self._put(out_q, result):
+                    break
+        except Exception as e:
+            self._errors.append(e)
+            self.stop_event.set()
+        finally:
+            self._put(out_q, _DONE)
+
+    def run(self, source, transform, sink, source_name="download", transform_name="parse", sink_name="write",
+            measure_source=lambda item: 0, measure=lambda item: 0, source_unit="bytes"):
+        self.stats[source_name] = StageStats(source_name, unit=source_unit)
+        self.stats[transform_name] = StageStats(transform_name)
+        self.stats[sink_name] = StageStats(sink_name)
+
+        raw_q = queue.Queue(maxsize=self.queue_size)
+        parsed_q = queue.Queue(maxsize=self.queue_size)
+        threads = [
+            threading.Thread(target=self._run_source, args=(source_name, source, measure_source, raw_q), daemon=True),
+            threading.Thread(target=self._run_transform, args=(transform_name, transform, measure, raw_q, parsed_q), daemon=True),
+        ]
+        for t in threads:
+            t.start()
+
+        sink_stats = self.stats[sink_name]
+        try:
+            while True:
+                item = self._get(parsed_q)
+                if item is _DONE:
+                    break
+                started = time.perf_counter()
+                sink(item)
+                sink_stats.record(measure(item), time.perf_counter() - started)
+        except Exception:
+            self.stop_event.set()
+            raise
+        finally:
+            self.stop_event.set()
+            for t in threads:
+                t.join()
+
+        if self._errors:
+            raise self._errors[0]
+
+    def report(self):
+        return {name: stats.as_dict() for name, stats in self.stats.items()}
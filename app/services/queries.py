@@ -0,0 +1,260 @@
+"""
+Filtered aggregate queries over enrolment data.
+
+aggregate() answers any combination of filters (an inclusive date range, a
+state, a district and a pincode prefix), GROUP BY dimensions (DIMENSIONS,
+at most one of them a date bucket) and summed MEASURES. The summary, age
+comparison, trend and ranking reads of analytics.py are calls to it.
+
+A query reads the smallest table that has its dimensions and filters
+(SOURCES): the single summary row, the per-state or per-district running
+totals, the daily rollups, and for pincodes only, the enrolment_data
+partitions of its date range. Its statement is built once per shape, i.e.
+which table, dimensions, measures, filters, ordering and partitions it
+uses, and reused with the filter values as bound parameters; SQLAlchemy
+then finds the compiled SQL in its own cache as well.
+"""
+import functools
+from datetime import date
+
+from sqlalchemy import Date, Integer, String, bindparam, func, select, tuple_, union_all
+from sqlalchemy.orm import Session
+
+from .. import models
+from . import anomalies, columnar, dimensions, partitions
+
+# Date buckets: each day, weeks (from Monday) or calendar months dated by their first day
+DATE_DIMENSIONS = ("date", "week", "month")
+DIMENSIONS = DATE_DIMENSIONS + ("state", "district", "pincode")
+# Summed per group; records is the number of enrolment_data rows
+MEASURES = ("records", "total", "age_0_5", "age_5_17", "age_17_plus")
+# Query shapes whose statements are kept
+COMPILED_SHAPES = 256
+
+_TOTALS = {"records": "row_count", "total": "total", "age_0_5": "total_0_5", "age_5_17": "total_5_17",
+           "age_17_plus": "total_17_plus"}
+# Aggregate tables a query can read instead of enrolment_data, smallest
+# first: (model, the dimensions it can group and filter by, measure -> column).
+# The first that has every dimension and filter of a query is used
+SOURCES = [
+    (models.EnrolmentSummary, (), {**_TOTALS, "total": "total_enrolments"}),
+    (models.StateTotal, ("state",), _TOTALS),
+    (models.DistrictTotal, ("state", "district"), _TOTALS),
+    (models.DailyStateRollup, ("date", "state"), _TOTALS),
+    (models.DailyDistrictRollup, ("date", "state", "district"), _TOTALS),
+]
+# Measure -> the enrolment_data column it sums
+_FACT_COLUMNS = {"total": "total", "age_0_5": "demo_age_0_5", "age_5_17": "demo_age_5_17",
+                 "age_17_plus": "demo_age_17_plus"}
+# Dimension -> the dimension table its enrolment_data ids point to, and the name there
+_NAMES = {"state": (models.State, models.State.name), "district": (models.District, models.District.name),
+          "pincode": (models.Pincode, models.Pincode.code)}
+
+def check(group_by, measures):
+    """Raise ValueError unless group_by and measures make a valid query"""
+    for dimension in group_by:
+        if dimension not in DIMENSIONS:
+            raise ValueError(f"Unknown dimension {dimension}. Use any of: {', '.join(DIMENSIONS)}.")
+    for measure in measures:
+        if measure not in MEASURES:
+            raise ValueError(f"Unknown measure {measure}. Use any of: {', '.join(MEASURES)}.")
+    if not measures:
+        raise ValueError("Give at least one measure.")
+    if len(set(group_by)) < len(group_by) or len(set(measures)) < len(measures):
+        raise ValueError("Each dimension and measure can be given only once.")
+    if sum(dimension in DATE_DIMENSIONS for dimension in group_by) > 1:
+        raise ValueError(f"Group by at most one of {', '.join(DATE_DIMENSIONS)}.")
+
+def bucket(column, dimension: str = "date"):
+    """Date of the DATE_DIMENSIONS bucket a date column falls in"""
+    # SQLite's 'weekday 1' moves forward to a Monday, so step back six days first
+    if dimension == "week":
+        return func.date(column, "-6 days", "weekday 1", type_=Date)
+    if dimension == "month":
+        return func.date(column, "start of month", type_=Date)
+    return column
+
+def _prefix_end(prefix: str) -> str:
+    # Smallest string after every string starting with prefix
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def _date_conditions(column, filters, after_date: bool):
+    found = []
+    if "start_date" in filters:
+        found.append(column >= bindparam("start_date", type_=Date))
+    if "end_date" in filters:
+        found.append(column <= bindparam("end_date", type_=Date))
+    if after_date:
+        # Keyset led by a date bucket: no later group starts before the last
+        # one returned, so it also bounds the rows read
+        found.append(column >= bindparam("after_0", type_=Date))
+    return found
+
+def _from_aggregate(source: int, group_by, measures, filters, after_date: bool):
+    # (statement, group keys, measure values) over one of SOURCES
+    model, dimensions, columns = SOURCES[source]
+    keys = [bucket(model.date, d) if d in DATE_DIMENSIONS else getattr(model, d) for d in group_by]
+    # Grouped by exactly the table's key, its rows are the groups
+    direct = bool(group_by) and sorted(group_by) == sorted(dimensions)
+    values = [getattr(model, columns[m]) for m in measures]
+    if not direct:
+        values = [func.coalesce(func.sum(value), 0) for value in values]
+    if "date" in dimensions:
+        conditions = _date_conditions(model.date, filters, after_date)
+    else:
+        # Running totals keep a zeroed row for data that was removed
+        conditions = [model.row_count > 0]
+    for name in ("state", "district"):
+        if name in filters:
+            conditions.append(getattr(model, name) == bindparam(name))
+    statement = select(*[key.label(d) for key, d in zip(keys, group_by)],
+                       *[value.label(m) for value, m in zip(values, measures)]).where(*conditions)
+    if group_by and not direct:
+        statement = statement.group_by(*keys)
+    return statement, keys, values
+
+def _from_facts(months, group_by, measures, filters, after_date: bool):
+    # (statement, group keys, measure values) over the partitions of months,
+    # each (month, whether the date range covers all of it). Each partition
+    # groups its own rows by dimension ids, and names are joined to the sums
+    parts = []
+    for month, within in months:
+        e = partitions.table(month)
+        keys = [bucket(e.c.date, d) if d in DATE_DIMENSIONS else e.c[f"{d}_id"] for d in group_by]
+        values = [func.count() if m == "records" else func.sum(e.c[_FACT_COLUMNS[m]]) for m in measures]
+        conditions = _date_conditions(e.c.date, () if within else filters, after_date)
+        for name in ("state", "district"):
+            if name in filters:
+                model, column = _NAMES[name]
+                conditions.append(e.c[f"{name}_id"].in_(select(model.id).where(column == bindparam(name))))
+        if "pincode" in filters:
+            # A prefix is a range of codes, which the unique index on code covers
+            conditions.append(e.c.pincode_id.in_(select(models.Pincode.id).where(
+                models.Pincode.code >= bindparam("pincode"), models.Pincode.code < bindparam("pincode_end"))))
+        part = select(*[key.label(d) for key, d in zip(keys, group_by)],
+                      *[value.label(m) for value, m in zip(values, measures)]).where(*conditions)
+        parts.append(part.group_by(*keys) if group_by else part)
+    facts = (union_all(*parts) if len(parts) > 1 else parts[0]).subquery("facts")
+    keys, joined = [], facts
+    for dimension in group_by:
+        if dimension in DATE_DIMENSIONS:
+            keys.append(facts.c[dimension])
+        else:
+            model, column = _NAMES[dimension]
+            condition = model.id == facts.c[dimension]
+            if dimension == "pincode":
+                # Rows without a pincode are in no pincode's group
+                condition &= column != dimensions.NO_PINCODE
+            joined = joined.join(model, condition)
+            keys.append(column)
+    values = [func.coalesce(func.sum(facts.c[m]), 0) for m in measures]
+    statement = select(*[key.label(d) for key, d in zip(keys, group_by)],
+                       *[value.label(m) for value, m in zip(values, measures)]).select_from(joined)
+    if group_by:
+        statement = statement.group_by(*keys)
+    return statement, keys, values
+
+@functools.lru_cache(maxsize=COMPILED_SHAPES)
+def _compile(shape):
+    # Statement of a query shape (see _shape), with bound parameters for its values
+    source, group_by, measures, filters, top, limited, after, months = shape
+    after_date = after and group_by[0] in DATE_DIMENSIONS
+    if source is not None:
+        statement, keys, values = _from_aggregate(source, group_by, measures, filters, after_date)
+    elif months:
+        statement, keys, values = _from_facts(months, group_by, measures, filters, after_date)
+    else:
+        return None
+    if after:
+        # Keyset of the last group already returned
+        statement = statement.where(tuple_(*keys) > tuple_(*[
+            bindparam(f"after_{i}", type_=Date if d in DATE_DIMENSIONS else String) for i, d in enumerate(group_by)]))
+    if top:
+        # ORDER BY ... LIMIT keeps only the best groups while SQLite sorts
+        statement = statement.order_by(values[0].desc(), *keys)
+    elif group_by:
+        statement = statement.order_by(*keys)
+    if limited:
+        statement = statement.limit(bindparam("limit", type_=Integer))
+    return statement
+
+def _shape(db: Session, group_by, measures, filters: dict, top, limit, after):
+    # Hashable description of a query: everything its statement depends on but the values
+    names = tuple(name for name, value in filters.items() if value)
+    needed = {"date" if d in DATE_DIMENSIONS else d for d in group_by}
+    needed |= {"date" if name.endswith("_date") else name for name in names}
+    source = next((i for i, (_, dimensions, _) in enumerate(SOURCES) if needed <= set(dimensions)), None)
+    months = ()
+    if source is None:
+        start_date, end_date = filters.get("start_date"), filters.get("end_date")
+        months = tuple((e.info["month"], partitions.within(e, start_date, end_date))
+                       for e in partitions.tables(db, start_date, end_date))
+    return (source, group_by, measures, names, top is not None, top is not None or limit is not None,
+            after is not None, months)
+
+def _prepare(db: Session, group_by, measures, filters: dict, top=None, limit=None, after=None):
+    # (statement or None when there are no rows to read, its parameters)
+    check(group_by, measures)
+    if top is not None and (limit is not None or after is not None):
+        raise ValueError("top cannot be combined with limit or after.")
+    statement = _compile(_shape(db, group_by, measures, filters, top, limit, after))
+    params = {name: value for name, value in filters.items() if value}
+    if filters.get("pincode"):
+        params["pincode_end"] = _prefix_end(filters["pincode"])
+    if top is not None or limit is not None:
+        params["limit"] = top if top is not None else limit
+    if after is not None:
+        params.update((f"after_{i}", value) for i, value in enumerate(after))
+    return statement, params
+
+def aggregate(db: Session, group_by=(), measures=("total",), start_date: date = None, end_date: date = None,
+              state: str = None, district: str = None, pincode: str = None, top: int = None, limit: int = None,
+              after=None, as_columns: bool = False):
+    """
+    Sums of measures per group of group_by over the rows within the
+    inclusive date range, state, district and pincode prefix given. Groups
+    come in group key order, or with top only the top largest by the first
+    measure (ties in key order). limit and after page through groups in key
+    order, after being the keys of the last group already returned. Without
+    group_by there is one group, all rows. Each group is a dict of its keys
+    and measures; with as_columns, parallel lists keyed by the same names.
+    Raises ValueError for an invalid query.
+    """
+    group_by, measures = tuple(group_by), tuple(measures)
+    if columnar.enabled():
+        check(group_by, measures)
+        columns = columnar.get_store(db).aggregate(group_by, measures, start_date, end_date, state, district,
+                                                   pincode, top, limit, after)
+    else:
+        filters = {"start_date": start_date, "end_date": end_date, "state": state, "district": district,
+                   "pincode": pincode}
+        statement, params = _prepare(db, group_by, measures, filters, top, limit, after)
+        # Core rows; ORM rows cost more to build than the columns take to fill
+        rows = db.connection().execute(statement, params).all() if statement is not None else []
+        if not group_by and not rows:
+            rows = [(0,) * len(measures)]
+        values = list(zip(*rows)) or [()] * (len(group_by) + len(measures))
+        columns = {name: list(column) for name, column in zip(group_by + measures, values)}
+    return columns if as_columns else [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+def iter_aggregate(db: Session, group_by=(), measures=("total",), start_date: date = None, end_date: date = None,
+                   state: str = None, district: str = None, pincode: str = None, after=None):
+    """The groups of aggregate() in key order one at a time as (keys..., measures...), from a server-side cursor"""
+    group_by, measures = tuple(group_by), tuple(measures)
+    filters = {"start_date": start_date, "end_date": end_date, "state": state, "district": district,
+               "pincode": pincode}
+    statement, params = _prepare(db, group_by, measures, filters, after=after)
+    if statement is None:
+        if not group_by:
+            yield (0,) * len(measures)
+        return
+    result = db.connection().execute(statement, params, execution_options={"yield_per": anomalies.FETCH_BATCH})
+    try:
+        yield from result
+    finally:
+        result.close()
+
+def stats() -> dict:
+    """Query shapes with a built statement, and how often one was built or reused"""
+    info = _compile.cache_info()
+    return {"shapes": info.currsize, "built": info.misses, "reused": info.hits}
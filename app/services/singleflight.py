@@ -0,0 +1,94 @@
+"""
+Single-flight coalescing for analytics queries.
+
+Concurrent calls with the same key share one in-flight computation: the
+first caller runs it, the others wait and receive the same result (or the
+same exception). Nothing is kept once the computation finishes, so this
+only collapses duplicate work that overlaps in time.
+"""
+import functools
+import threading
+
+from sqlalchemy.orm import Session
+
+from .. import database
+from . import aggregates
+
+class _Call:
+    """One in-flight computation and the callers waiting on it"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """Runs at most one computation per key at a time"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        # name -> {"calls", "executions", "coalesced"}
+        self._counters = {}
+
+    def _count(self, name, field):
+        counters = self._counters.setdefault(name, {"calls": 0, "executions": 0, "coalesced": 0})
+        counters["calls"] += 1
+        counters[field] += 1
+
+    def do(self, key, fn, name: str = None):
+        """Return fn(), sharing the result with concurrent calls for the same key"""
+        name = name or str(key)
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            self._count(name, "executions" if leader else "coalesced")
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            per_function = {name: dict(c) for name, c in self._counters.items()}
+            return {
+                "in_flight": len(self._calls),
+                "calls": sum(c["calls"] for c in per_function.values()),
+                "coalesced": sum(c["coalesced"] for c in per_function.values()),
+                "functions": per_function,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self._counters.clear()
+
+analytics_flight = SingleFlight()
+
+def coalesce(fn):
+    """
+    Decorator for analytics functions taking (db, *args). Identical concurrent
+    calls against the same dataset and data generation run the query once.
+    """
+    @functools.wraps(fn)
+    def wrapper(db: Session, *args, **kwargs):
+        # The generation is part of the key so a caller that arrives after a
+        # write never receives a result computed before it
+        key = (fn.__name__, database.storage_of(db), aggregates.get_generation(db), args,
+               tuple(sorted(kwargs.items())))
+        return analytics_flight.do(key, lambda: fn(db, *args, **kwargs), name=fn.__name__)
+    return wrapper
@@ -0,0 +1,25 @@
+from datetime import datetime
+from sqlalchemy.orm import Session
+from .. import models
+
+def get_watermark(db: Session, resource_id: str, state: str = None, district: str = None):
+    """Get the stored sync watermark for a resource and filter, or None"""
+    return db.query(models.SyncState).filter(
+        models.SyncState.resource_id == resource_id,
+        models.SyncState.state == (state or ""),
+        models.SyncState.district == (district or "")
+    ).first()
+
+def save_watermark(db: Session, resource_id: str, state: str, district: str, last_offset: int):
+    """
+    Record how far a sync got, as the offset of the next record to fetch. Does not commit, so the watermark lands in the
+    same transaction as the rows it describes.
+    """
+    watermark = get_watermark(db, resource_id, state, district)
+    if watermark is None:
+        watermark = models.SyncState(resource_id=resource_id, state=state or "", district=district or "")
+        db.add(watermark)
+
+    watermark.last_offset = last_offset
+    watermark.updated_at = datetime.utcnow()
+    return watermark
@@ -0,0 +1,228 @@
+"""
+Benchmark: ingestion parse and write paths.
+
+- parse: untyped read_csv + per-element date parsing vs read_csv_frames()
+- write: ORM bulk_insert_mappings vs the raw DBAPI fast-load path, the
+  latter with the previous index set, the current one, and with secondary
+  indexes deferred until the end of the load
+- query: the indexed read paths, timed after each load
+- drop: retention of the oldest month by dropping its partition
+
+Scales testingdata.csv up to --rows rows (each copy of the file gets its own
+pincode suffix so the natural keys stay unique), then parses it with
+each parser and loads it into a scratch SQLite database with each writer,
+printing rows/second.
+
+    python bench_ingest.py --rows 10000000
+"""
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+import pandas as pd
+
+SOURCE_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testingdata.csv")
+
+def build_scaled_csv(path, rows):
+    base = pd.read_csv(SOURCE_CSV)
+    written = 0
+    copy = 0
+    with open(path, "w", newline="") as f:
+        while written < rows:
+            frame = base.head(rows - written).copy()
+            frame['pincode'] = frame['pincode'].astype(str) + f"{copy:05d}"
+            frame.to_csv(f, header=(copy == 0), index=False)
+            written += len(frame)
+            copy += 1
+    return written
+
+def legacy_parse(csv_path, chunk_size):
+    # The original parser: inferred dtypes, full-column date parsing
+    from app.services import ingestion
+    for chunk in pd.read_csv(csv_path, chunksize=chunk_size):
+        chunk.columns = chunk.columns.str.strip()
+        chunk = chunk.rename(columns=ingestion.COLUMN_MAP)
+        chunk = chunk.dropna(subset=['date', 'state', 'district'])
+        for col in ingestion.NUMERIC_COLS:
+            if col not in chunk.columns:
+                chunk[col] = 0
+            chunk[col] = chunk[col].fillna(0)
+        chunk['date'] = pd.to_datetime(chunk['date'], errors='coerce', dayfirst=True, cache=False)
+        yield chunk.dropna(subset=['date'])
+
+def time_parse(label, frames):
+    started = time.perf_counter()
+    total = sum(len(df) for df in frames)
+    elapsed = time.perf_counter() - started
+    print(f"parse {label:<12} {total:>12,} rows  {elapsed:8.1f}s  {total / elapsed:>12,.0f} rows/s")
+
+def legacy_insert(df, db, deferral=None):
+    # The pre-fast-load writer: one dict per row through SQLAlchemy, into each
+    # month's partition
+    from app.services import dimensions, ingestion, partitions
+    connection = db.connection()
+    cursor = connection.connection.driver_connection.cursor()
+    state_ids, district_ids, pincode_ids = dimensions.resolve_frame(
+        df, cursor, connection.connection.info, ingestion._pincode_values(df))
+    frame = df[['date'] + ingestion.NUMERIC_COLS].assign(
+        state_id=state_ids, district_id=district_ids, pincode_id=pincode_ids)
+    months = frame['date'].dt.strftime('%Y-%m')
+    wanted = partitions.ensure(cursor, months.unique(), with_indexes=deferral is None)
+    if deferral is not None:
+        deferral.cover(cursor, wanted)
+    for month in wanted:
+        db.execute(partitions.table(month).insert(), frame[months == month].to_dict(orient='records'))
+    return len(frame)
+
+def source_months():
+    # The scaled file repeats the source file's dates
+    from app.services import ingestion
+    with open(SOURCE_CSV, "rb") as f:
+        return sorted({month for _, df in ingestion.read_csv_frames(f) for month in df['date'].dt.strftime('%Y-%m')})
+
+# Index set before the workload-chosen composite indexes: a redundant index
+# on the fact table's primary key, total alone, and non-covering rollup indexes
+LEGACY_INDEXES = [
+    "CREATE INDEX ix_daily_state_rollup_state_date ON daily_state_rollup (state, date)",
+    "CREATE INDEX ix_daily_district_rollup_district_date ON daily_district_rollup (district, date)",
+]
+
+def use_legacy_indexes(db):
+    from sqlalchemy import text
+    from app.services import partitions
+    # The partitions are created up front so they can be given the old index set
+    connection = db.connection()
+    partitions.ensure(connection.connection.driver_connection.cursor(), source_months())
+    for table in partitions.tables(db):
+        for index in table.indexes:
+            if len(index.columns) > 1:
+                index.drop(bind=connection)
+        db.execute(text(f"CREATE INDEX ix_{table.name}_id ON {table.name} (id)"))
+    for name in ["ix_daily_state_rollup_state_date_total", "ix_daily_district_rollup_district_date_total"]:
+        db.execute(text(f"DROP INDEX {name}"))
+    for sql in LEGACY_INDEXES:
+        db.execute(text(sql))
+    db.commit()
+
+def time_queries(db, label, repeat=20):
+    # Median latency of each read path that goes through an index
+    from app import models
+    from app.services import analytics, partitions
+    state = db.query(models.StateTotal.state).order_by(models.StateTotal.total.desc()).first()[0]
+    district = db.query(models.DailyDistrictRollup.district).filter_by(state=state).first()[0]
+    start, end = (date.fromisoformat(day) for day in partitions.bounds(partitions.months(db)[-1]))
+    end -= timedelta(days=1)
+    # Keyset of the 10,000th row below the threshold, to compare a deep cursor page with a deep offset
+    deep = analytics._threshold_anomalies(db, 100, 1, 9999, None, None)[2]
+    queries = {
+        "anomalies threshold page": lambda: analytics._threshold_anomalies(db, 10, 50, 0, None, None),
+        "anomalies threshold 1 month": lambda: analytics._threshold_anomalies(db, 10, 50, 0, None, None, start, end),
+        "anomalies threshold ?state=": lambda: analytics._threshold_anomalies(db, 10, 50, 0, state, None),
+        "anomalies threshold ?district=": lambda: analytics._threshold_anomalies(db, 10, 50, 0, None, district),
+        "anomalies threshold offset 10k": lambda: analytics._threshold_anomalies(db, 100, 50, 10000, None, None),
+        "anomalies threshold cursor 10k": lambda: analytics._threshold_anomalies(db, 100, 50, 0, None, None,
+                                                                                 None, None, deep),
+        "trends/state?state=": lambda: analytics.get_trends_by_state.__wrapped__(db, state),
+        "trends/district?district=": lambda: analytics.get_trends_by_district.__wrapped__(db, district),
+        "trends/district all days": lambda: analytics.get_trends_by_district.__wrapped__(db),
+        "trends/district months": lambda: analytics.get_trends_by_district.__wrapped__(db, granularity="month"),
+        "trends/district max_points=100": lambda: analytics.get_trends_by_district.__wrapped__(db, max_points=100),
+        "rankings state": lambda: analytics.get_rankings.__wrapped__(db),
+        "rankings district 1 month": lambda: analytics.get_rankings.__wrapped__(db, "district", start_date=start,
+                                                                               end_date=end),
+        "rankings pincode": lambda: analytics.get_rankings.__wrapped__(db, "pincode"),
+        "summary ?district=": lambda: analytics.get_overall_summary.__wrapped__(db, district=district),
+        "aggregate month x state": lambda: analytics.get_aggregate.__wrapped__(db, ("month", "state"),
+                                                                           ("records", "total")),
+        "aggregate pincode prefix": lambda: analytics.get_aggregate.__wrapped__(db, ("month",), ("total",),
+                                                                            pincode="1"),
+        "options/districts?state=": lambda: analytics.get_unique_districts.__wrapped__(db, state),
+    }
+    for name, query in queries.items():
+        samples = []
+        for _ in range(repeat):
+            t = time.perf_counter()
+            query()
+            samples.append(time.perf_counter() - t)
+        samples.sort()
+        print(f"query {label:<12} {name:<31} {samples[len(samples) // 2] * 1000:8.2f} ms")
+
+def time_drop_month(db, label):
+    from app.services import partitions
+    month = partitions.months(db)[0]
+    started = time.perf_counter()
+    count = partitions.drop(db, [month])
+    print(f"drop  {label:<12} {month} {count:>12,} rows  {(time.perf_counter() - started) * 1000:8.1f} ms")
+
+def run(label, csv_path, chunk_size, writer, defer_indexes=False, legacy_indexes=False, queries=True):
+    from app import database
+    from app.services import datasets, indexes, ingestion
+
+    # Each run starts from empty storage
+    datasets.clear(database.DEFAULT_DATASET)
+    db = datasets.get(database.DEFAULT_DATASET).SessionLocal()
+    if legacy_indexes:
+        use_legacy_indexes(db)
+    total = 0
+    write_seconds = 0.0
+    timings = {}
+    deferral = None
+    started = time.perf_counter()
+    try:
+        with contextlib.ExitStack() as stack:
+            if defer_indexes:
+                deferral = stack.enter_context(indexes.deferred(db, timings))
+            with open(csv_path, "rb") as f:
+                for _, chunk in ingestion.read_csv_frames(f, chunk_size):
+                    t = time.perf_counter()
+                    total += writer(chunk, db, deferral)
+                    write_seconds += time.perf_counter() - t
+            t = time.perf_counter()
+            db.commit()
+            write_seconds += time.perf_counter() - t
+        write_seconds += timings.get("drop_seconds", 0) + timings.get("rebuild_seconds", 0)
+        elapsed = time.perf_counter() - started
+        rebuild = f"  (index rebuild {timings['rebuild_seconds']:.1f}s)" if timings else ""
+        print(f"write {label:<12} {total:>12,} rows  total {elapsed:8.1f}s  write {write_seconds:8.1f}s  "
+              f"{total / write_seconds:>12,.0f} rows/s written{rebuild}")
+        if queries:
+            time_queries(db, label)
+            time_drop_month(db, label)
+    finally:
+        db.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--chunk-size", type=int, default=500_000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="aadhar-bench-")
+    csv_path = os.path.join(workdir, "scaled.csv")
+    print(f"Generating {args.rows:,} rows in {csv_path}...")
+    build_scaled_csv(csv_path, args.rows)
+
+    # Datasets are stored under the working directory, so run in a scratch one
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    from app.services import ingestion
+
+    time_parse("legacy", legacy_parse(csv_path, args.chunk_size))
+    with open(csv_path, "rb") as f:
+        time_parse("typed", (df for _, df in ingestion.read_csv_frames(f, args.chunk_size, engine="c")))
+    if ingestion.pyarrow_csv is not None:
+        with open(csv_path, "rb") as f:
+            time_parse("pyarrow", (df for _, df in ingestion.read_csv_frames(f, args.chunk_size, engine="pyarrow")))
+
+    # The ORM writer does not maintain the aggregates the queries read
+    run("orm", csv_path, args.chunk_size, legacy_insert, queries=False)
+    run("fast-legacy", csv_path, args.chunk_size, ingestion.insert_frame, legacy_indexes=True)
+    run("fast-load", csv_path, args.chunk_size, ingestion.insert_frame)
+    run("fast-defer", csv_path, args.chunk_size, ingestion.insert_frame, defer_indexes=True)
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,17 @@ import requests
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
+import json
+import uuid
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
 # Page configuration
 st.set_page_config(
     page_title="Aadhaar Analytics Dashboard",
@@ -15,6 +24,13 @@ st.set_page_config(
 
 # API Configuration
 API_BASE_URL = "http://127.0.0.1:8000"
+# Body format for row results: Arrow IPC when pyarrow is installed, else columnar JSON
+ROWS_FORMAT = "arrow" if pyarrow is not None else "columnar"
+# Trend chart resolutions, and the most points drawn per line
+GRANULARITIES = {"day": "Daily", "week": "Weekly", "month": "Monthly"}
+CHART_MAX_POINTS = 400
+# Payloads kept for ETag revalidation per browser session, least recently used dropped first
+ETAG_CACHE_SIZE = 64
 
 # Custom CSS for better styling
 st.markdown("""
@@ -36,94 +52,163 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # Helper Functions
+def _etag_store():
+    """
+    Last payload and ETag per URL, for this browser session only: its URLs
+    name its own dataset, and the store goes away with the session
+    """
+    return st.session_state.setdefault('etag_store', OrderedDict())
+
+def _rows_payload(response):
+    """
+    Rows of a ROWS_FORMAT response as a DataFrame, built from its columns
+    without per-row dicts: the whole payload, or its "items" with the other
+    fields alongside
+    """
+    if ROWS_FORMAT == "arrow":
+        table = pyarrow.ipc.open_stream(response.content).read_all()
+        fields = {key.decode(): json.loads(value) for key, value in (table.schema.metadata or {}).items()}
+        frame = table.to_pandas()
+    else:
+        payload = response.json()
+        if "items" in payload:
+            fields, frame = payload, pd.DataFrame(payload.pop("items"))
+        else:
+            fields, frame = {}, pd.DataFrame(payload)
+    return {**fields, "items": frame} if fields else frame
+
+def api_get(path, dataset, params=None, rows=False):
+    """
+    GET a read endpoint of a dataset, revalidating with If-None-Match so an
+    unchanged payload comes back as an empty 304 and is served from the local
+    copy. Returns None for a dataset nothing has been loaded into yet. With
+    rows, the endpoint's rows come in ROWS_FORMAT and are returned as a
+    DataFrame (see _rows_payload).
+    """
+    params = {k: v for k, v in (params or {}).items() if v is not None}
+    params["dataset"] = dataset
+    if rows:
+        params["format"] = ROWS_FORMAT
+    key = (path, tuple(sorted(params.items())))
+    store = _etag_store()
+    cached = store.get(key)
+    if cached:
+        store.move_to_end(key)
+    headers = {"If-None-Match": cached[0]} if cached else {}
+
+    response = requests.get(f"{API_BASE_URL}{path}", params=params, headers=headers)
+    if response.status_code == 304 and cached:
+        return cached[1]
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    payload = _rows_payload(response) if rows else response.json()
+    if response.headers.get("ETag"):
+        store[key] = (response.headers["ETag"], payload)
+        store.move_to_end(key)
+        while len(store) > ETAG_CACHE_SIZE:
+            store.popitem(last=False)
+    return payload
+
+def current_dataset():
+    """Dataset this browser session reads and writes"""
+    return st.session_state['dataset']
+
 @st.cache_data(ttl=60)
-def fetch_summary():
-    """Fetch summary statistics from API"""
+def fetch_summary(dataset, state=None, district=None):
+    """Fetch summary statistics from API, optionally of one state or district"""
     try:
-        response = requests.get(f"{API_BASE_URL}/summary")
-        response.raise_for_status()
-        return response.json()
+        return api_get("/summary", dataset, {"state": state, "district": district})
     except Exception as e:
         st.error(f"Failed to fetch summary: {e}")
         return None
 
 @st.cache_data(ttl=60)
-def fetch_trends_state(state=None):
-    """Fetch state trends from API"""
+def fetch_trends_state(dataset, state=None, granularity="day", max_points=None, district=None):
+    """Fetch state trends from API as a DataFrame"""
     try:
-        url = f"{API_BASE_URL}/trends/state"
-        if state:
-            url += f"?state={state}"
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.json()
+        trends = api_get("/trends/state", dataset,
+                         {"state": state, "district": district, "granularity": granularity, "max_points": max_points},
+                         rows=True)
+        return trends if trends is not None else pd.DataFrame()
     except Exception as e:
         st.error(f"Failed to fetch state trends: {e}")
-        return []
+        return pd.DataFrame()
 
 @st.cache_data(ttl=60)
-def fetch_trends_district(district=None):
-    """Fetch district trends from API"""
+def fetch_trends_district(dataset, district=None):
+    """Fetch district trends from API as a DataFrame"""
     try:
-        url = f"{API_BASE_URL}/trends/district"
-        if district:
-            url += f"?district={district}"
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.json()
+        trends = api_get("/trends/district", dataset, {"district": district}, rows=True)
+        return trends if trends is not None else pd.DataFrame()
     except Exception as e:
         st.error(f"Failed to fetch district trends: {e}")
-        return []
+        return pd.DataFrame()
 
 @st.cache_data(ttl=60)
-def fetch_age_comparison():
-    """Fetch age comparison data from API"""
+def fetch_rankings(dataset, level="state", k=10, state=None, district=None):
+    """Fetch the top k states, districts or pincodes from API as a DataFrame"""
     try:
-        response = requests.get(f"{API_BASE_URL}/age-comparison")
-        response.raise_for_status()
-        return response.json()
+        ranking = api_get("/rankings", dataset, {"level": level, "k": k, "state": state, "district": district},
+                          rows=True)
+        return ranking if ranking is not None else pd.DataFrame()
+    except Exception as e:
+        st.error(f"Failed to fetch rankings: {e}")
+        return pd.DataFrame()
+
+@st.cache_data(ttl=60)
+def fetch_age_comparison(dataset, state=None, district=None):
+    """Fetch age comparison data from API, optionally of one state or district"""
+    try:
+        return api_get("/age-comparison", dataset, {"state": state, "district": district})
     except Exception as e:
         st.error(f"Failed to fetch age comparison: {e}")
         return None
 
+ANOMALY_PAGE_SIZE = 20
+ANOMALY_METHODS = {
+    "Combined": "combined",
+    "Z-score": "zscore",
+    "Median / MAD": "mad",
+    "Sudden drop": "drop",
+    "Below 10 (raw rows)": "threshold",
+}
+
 @st.cache_data(ttl=60)
-def fetch_anomalies():
-    """Fetch anomalies from API"""
+def fetch_anomalies(dataset, method="combined", page=0, state=None, district=None):
+    """Fetch one ranked page of anomalies from API, its items as a DataFrame"""
     try:
-        response = requests.get(f"{API_BASE_URL}/anomalies")
-        response.raise_for_status()
-        return response.json()
+        return api_get("/anomalies", dataset, {"method": method, "limit": ANOMALY_PAGE_SIZE, "offset": page * ANOMALY_PAGE_SIZE,
+                                               "state": state, "district": district},
+                       rows=True)
     except Exception as e:
         st.error(f"Failed to fetch anomalies: {e}")
-        return []
+        return None
 
 @st.cache_data(ttl=60)
-def fetch_state_options():
+def fetch_state_options(dataset):
     """Fetch unique states from API"""
     try:
-        response = requests.get(f"{API_BASE_URL}/options/states")
-        response.raise_for_status()
-        return response.json()
+        return api_get("/options/states", dataset) or []
     except Exception as e:
         return []
 
 @st.cache_data(ttl=60)
-def fetch_district_options(state=None):
+def fetch_district_options(dataset, state=None):
     """Fetch unique districts from API"""
     try:
-        url = f"{API_BASE_URL}/options/districts"
-        if state:
-            url += f"?state={state}"
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.json()
+        return api_get("/options/districts", dataset, {"state": state}) or []
     except Exception as e:
         return []
 
-def sync_api_data(limit, state=None, district=None, fetch_all=False):
-    """Trigger API sync"""
+def _track_job(job_id):
+    st.session_state.setdefault('job_ids', []).append(job_id)
+
+def sync_api_data(limit, state=None, district=None, fetch_all=False, incremental=False):
+    """Queue an API sync as a background job"""
     try:
-        params = {"limit": limit, "fetch_all": fetch_all}
+        params = {"limit": limit, "fetch_all": fetch_all, "incremental": incremental, "background": True,
+                  "dataset": current_dataset()}
         if state:
             params["state"] = state
         if district:
@@ -131,26 +216,48 @@ def sync_api_data(limit, state=None, district=None, fetch_all=False):
         
         response = requests.post(f"{API_BASE_URL}/sync-api", params=params)
         response.raise_for_status()
-        return response.json()
+        result = response.json()
+        _track_job(result["job_id"])
+        return result
     except Exception as e:
         st.error(f"Sync failed: {e}")
         return None
 
 def upload_csv_file(uploaded_file):
-    """Upload CSV file to backend"""
+    """Queue a CSV upload on the backend as a background job"""
     try:
-        files = {"file": (uploaded_file.name, uploaded_file.getvalue(), "text/csv")}
-        response = requests.post(f"{API_BASE_URL}/upload", files=files)
+        uploaded_file.seek(0)
+        files = {"file": (uploaded_file.name, uploaded_file, "text/csv")}
+        response = requests.post(f"{API_BASE_URL}/upload", params={"background": True, "dataset": current_dataset()},
+                                 files=files)
         response.raise_for_status()
-        return response.json()
+        result = response.json()
+        _track_job(result["job_id"])
+        return result
     except Exception as e:
         st.error(f"Upload failed: {e}")
         return None
 
+def get_job_status(job_id):
+    """Get status of a background job from API"""
+    try:
+        response = requests.get(f"{API_BASE_URL}/jobs/{job_id}")
+        response.raise_for_status()
+        return response.json()
+    except Exception as e:
+        return None
+
+def cancel_job(job_id):
+    """Request cancellation of a background job"""
+    try:
+        requests.post(f"{API_BASE_URL}/jobs/{job_id}/cancel").raise_for_status()
+    except Exception as e:
+        st.error(f"Cancel failed: {e}")
+
 def clear_database():
-    """Clear all data from database"""
+    """Clear all data from this session's dataset"""
     try:
-        response = requests.delete(f"{API_BASE_URL}/clear-data")
+        response = requests.delete(f"{API_BASE_URL}/clear-data", params={"dataset": current_dataset()})
         response.raise_for_status()
         return response.json()
     except Exception as e:
@@ -161,16 +268,27 @@ def clear_database():
 st.markdown('<h1 class="main-header">📊 Aadhaar Enrolment Analytics Dashboard</h1>', unsafe_allow_html=True)
 
 # Session State Initialization
-if 'initialized' not in st.session_state:
-    st.session_state['initialized'] = True
-    # Auto-clear DB on first load as requested
-    with st.spinner("Initializing dashboard and clearing previous data..."):
-        clear_database()
-        st.toast("Database cleared for new session", icon="🧹")
+if 'dataset' not in st.session_state:
+    # Each new session starts in an empty dataset of its own, so opening the
+    # dashboard no longer clears the data other sessions are looking at. The
+    # dataset is named in the URL, so reloading the page goes back to it
+    # instead of starting another. The API deletes session datasets left
+    # unused (see SESSION_DATASET_SECONDS in app/database.py)
+    st.session_state['dataset'] = st.query_params.get('dataset') or f"session-{uuid.uuid4().hex[:8]}"
+    st.session_state['dataset_input'] = st.session_state['dataset']
 
 # Sidebar - Filters
 st.sidebar.header("🔍 Filters & Controls")
 
+# Dataset Selection (names are checked by the API)
+dataset_input = st.sidebar.text_input(
+    "🗂️ Dataset", key="dataset_input",
+    help="Uploads, syncs, charts and Clear All Data apply to this dataset. Enter the same name in another session to share it."
+)
+if dataset_input.strip():
+    st.session_state['dataset'] = dataset_input.strip()
+st.query_params['dataset'] = current_dataset()
+
 # --- GLOBAL FILTERS ---
 st.sidebar.subheader("🗺️ Geographic Filters")
 
@@ -179,16 +297,16 @@ filter_mode = st.sidebar.radio("Filter Selection Mode", ["Dropdown", "Manual"],
 
 if filter_mode == "Dropdown":
     # Fetch available options
-    state_options = fetch_state_options()
+    state_options = fetch_state_options(current_dataset())
     state_options = ["All"] + state_options if state_options else ["All"]
 
     filter_state = st.sidebar.selectbox("Filter by State", options=state_options)
 
     # Filter districts based on selected state
     if filter_state != "All":
-        district_options = fetch_district_options(filter_state)
+        district_options = fetch_district_options(current_dataset(), filter_state)
     else:
-        district_options = fetch_district_options()
+        district_options = fetch_district_options(current_dataset())
         
     district_options = ["All"] + district_options if district_options else ["All"]
     filter_district = st.sidebar.selectbox("Filter by District", options=district_options)
@@ -214,19 +332,17 @@ st.sidebar.markdown("---")
 # CSV Upload Section
 with st.sidebar.expander("📤 Upload CSV File", expanded=True):
     uploaded_file = st.file_uploader("Choose a CSV file", type=['csv'])
-    clear_before_upload = st.checkbox("Clear existing data before upload", value=True, key="clear_upload")
+    clear_before_upload = st.checkbox("Clear existing data before upload", value=False, key="clear_upload")
     
     if uploaded_file is not None:
         if st.button("📁 Upload & Process", type="primary", key="upload_btn"):
-            with st.spinner("Processing..."):
-                if clear_before_upload:
-                    clear_database()
-                
-                result = upload_csv_file(uploaded_file)
-                if result:
-                    st.success(result.get("message", "Upload completed!"))
-                    st.cache_data.clear()
-                    st.rerun()
+            if clear_before_upload:
+                clear_database()
+                st.cache_data.clear()
+
+            result = upload_csv_file(uploaded_file)
+            if result:
+                st.success(result.get("message", "Upload started!"))
 
 st.sidebar.markdown("---")
 
@@ -236,19 +352,69 @@ with st.sidebar.expander("🔄 Sync Data from API", expanded=True):
     fetch_all = st.checkbox("Fetch All Records (ignores limit)", value=False)
     sync_limit = st.number_input("Records to fetch", min_value=10, max_value=1000, value=100, step=10, disabled=fetch_all)
     
-    clear_before_sync = st.checkbox("Clear existing data before sync", value=True, key="clear_sync")
+    incremental_sync = st.checkbox("Incremental (resume from the last synced offset)", value=True, key="incremental_sync",
+                                   help="Fetches only records appended since the last sync of this filter; "
+                                        "changes to records already synced need a full sync.")
+    clear_before_sync = st.checkbox("Clear existing data before sync", value=False, key="clear_sync", disabled=incremental_sync)
     
     if st.button("🚀 Sync Now", type="primary"):
-        with st.spinner("Syncing data..."):
-            if clear_before_sync:
-                clear_database()
-                
-            # Use selected_state and selected_district from Global Filters
-            result = sync_api_data(sync_limit, selected_state, selected_district, fetch_all=fetch_all)
-            if result:
-                st.success(result.get("message", "Sync completed!"))
-                st.cache_data.clear()  # Clear cache to refresh data
-                st.rerun()
+        if clear_before_sync and not incremental_sync:
+            clear_database()
+            st.cache_data.clear()
+
+        # Use selected_state and selected_district from Global Filters
+        result = sync_api_data(sync_limit, selected_state, selected_district, fetch_all=fetch_all, incremental=incremental_sync)
+        if result:
+            st.success(result.get("message", "Sync started!"))
+
+st.sidebar.markdown("---")
+
+# Background Jobs Section
+@st.fragment(run_every=2)
+def background_jobs_panel():
+    """Poll the background jobs started from this session"""
+    for message in st.session_state.pop('job_messages', []):
+        st.success(message)
+
+    job_ids = st.session_state.get('job_ids', [])
+    if not job_ids:
+        return
+
+    st.subheader("⏳ Background Jobs")
+    finished = []
+    for job_id in list(job_ids):
+        status = get_job_status(job_id)
+        if status is None:
+            job_ids.remove(job_id)
+            continue
+
+        st.caption(f"{status['description']} ({status['status']})")
+        st.progress(status['progress'] or 0.0)
+        details = f"{status['rows_done']:,} records · {status['rate']:,.0f} rec/s"
+        if status['eta_seconds'] is not None:
+            details += f" · ETA {status['eta_seconds']:.0f}s"
+        st.caption(details)
+
+        if status['status'] in ("queued", "running"):
+            if st.button("✖ Cancel", key=f"cancel_{job_id}"):
+                cancel_job(job_id)
+        else:
+            job_ids.remove(job_id)
+            finished.append(status)
+
+    if finished:
+        messages = st.session_state.setdefault('job_messages', [])
+        for status in finished:
+            if status['status'] == "failed":
+                st.error(f"{status['description']} failed: {'; '.join(status['errors'])}")
+            else:
+                messages.append(status['message'])
+        # New data is in, refresh every chart
+        st.cache_data.clear()
+        st.rerun()
+
+with st.sidebar:
+    background_jobs_panel()
 
 st.sidebar.markdown("---")
 
@@ -270,7 +436,7 @@ if st.sidebar.button("🔄 Refresh Data"):
 # Main Content
 # KPI Cards
 st.subheader("📈 Key Performance Indicators")
-summary = fetch_summary()
+summary = fetch_summary(current_dataset(), selected_state, selected_district)
 
 if summary:
     col1, col2, col3, col4, col5 = st.columns(5)
@@ -294,10 +460,14 @@ col_left, col_right = st.columns(2)
 # Time-series Chart
 with col_left:
     st.subheader("📊 Enrolment Trends Over Time")
-    trends_data = fetch_trends_state(selected_state)
+    granularity = st.radio("Resolution", list(GRANULARITIES), horizontal=True,
+                           format_func=lambda g: GRANULARITIES[g])
+    # Each state's line is downsampled server-side to what the chart can show
+    trends_data = fetch_trends_state(current_dataset(), selected_state, granularity, CHART_MAX_POINTS,
+                                     selected_district)
     
-    if trends_data:
-        df_trends = pd.DataFrame(trends_data)
+    if not trends_data.empty:
+        df_trends = trends_data
         df_trends['date'] = pd.to_datetime(df_trends['date'])
         
         fig_trends = px.line(
@@ -305,7 +475,7 @@ with col_left:
             x='date', 
             y='enrolments',
             color='state' if 'state' in df_trends.columns else None,
-            title="Daily Enrolments",
+            title=f"{GRANULARITIES[granularity]} Enrolments",
             labels={'enrolments': 'Number of Enrolments', 'date': 'Date'}
         )
         fig_trends.update_layout(height=400)
@@ -316,7 +486,7 @@ with col_left:
 # Age Group Pie Chart
 with col_right:
     st.subheader("👥 Age Group Distribution")
-    age_data = fetch_age_comparison()
+    age_data = fetch_age_comparison(current_dataset(), selected_state, selected_district)
     
     if age_data:
         age_df = pd.DataFrame([
@@ -339,47 +509,60 @@ with col_right:
 
 # State-wise Bar Chart
 st.subheader("🗺️ Top States by Enrolment")
-# Use filtered data if state filter is provided, otherwise show all
-state_trends = fetch_trends_state(selected_state)
-
-if state_trends:
-    df_states = pd.DataFrame(state_trends)
-    if 'state' in df_states.columns:
-        state_summary = df_states.groupby('state')['enrolments'].sum().reset_index()
-        state_summary = state_summary.sort_values('enrolments', ascending=False).head(10)
-        
-        # Update title based on filter
-        chart_title = f"Top 10 States" if not selected_state else f"Enrolments for {selected_state}"
-        
-        fig_states = px.bar(
-            state_summary,
-            x='state',
-            y='enrolments',
-            title=chart_title,
-            labels={'enrolments': 'Total Enrolments', 'state': 'State'},
-            color='enrolments',
-            color_continuous_scale='Blues'
-        )
-        fig_states.update_layout(
-            height=400,
-            xaxis={'categoryorder': 'total descending'}
-        )
-        st.plotly_chart(fig_states, use_container_width=True)
-    else:
-        st.info("No state-level data available.")
+# Use filtered data if state filter is provided, otherwise show all.
+# The states are ranked by the backend; only the top 10 come back
+state_summary = fetch_rankings(current_dataset(), "state", 10, selected_state, selected_district)
+
+if not state_summary.empty:
+    # Update title based on filter
+    chart_title = f"Top 10 States" if not selected_state else f"Enrolments for {selected_state}"
+    if selected_district:
+        chart_title += f" ({selected_district} district)"
+    
+    fig_states = px.bar(
+        state_summary,
+        x='state',
+        y='total',
+        title=chart_title,
+        labels={'total': 'Total Enrolments', 'state': 'State'},
+        color='total',
+        color_continuous_scale='Blues'
+    )
+    fig_states.update_layout(
+        height=400,
+        xaxis={'categoryorder': 'total descending'}
+    )
+    st.plotly_chart(fig_states, use_container_width=True)
+else:
+    st.info("No state-level data available.")
 
 # Anomalies Table
-st.subheader("⚠️ Anomaly Alerts (Low Enrolment Days)")
-anomalies = fetch_anomalies()
+st.subheader("⚠️ Anomaly Alerts")
+anomaly_col1, anomaly_col2 = st.columns([3, 1])
+with anomaly_col1:
+    anomaly_method = st.selectbox(
+        "Detection method",
+        options=list(ANOMALY_METHODS),
+        help="Statistical methods score each district's daily series against its previous 28 days"
+    )
+with anomaly_col2:
+    anomaly_page = st.number_input("Page", min_value=1, value=1, step=1)
+
+anomalies = fetch_anomalies(current_dataset(), ANOMALY_METHODS[anomaly_method], int(anomaly_page) - 1,
+                            selected_state, selected_district)
 
-if anomalies:
-    df_anomalies = pd.DataFrame(anomalies)
+if anomalies and not anomalies['items'].empty:
+    df_anomalies = anomalies['items']
     df_anomalies['date'] = pd.to_datetime(df_anomalies['date']).dt.date
+    columns = [c for c in ['date', 'state', 'district', 'total_enrolment', 'expected', 'score', 'type']
+               if c in df_anomalies.columns]
     st.dataframe(
-        df_anomalies[['date', 'district', 'total_enrolment', 'type']].head(20),
+        df_anomalies[columns],
         use_container_width=True,
         hide_index=True
     )
+    first = anomalies['offset'] + 1
+    st.caption(f"Showing {first}-{first + len(df_anomalies) - 1} of {anomalies['total']:,} anomalies, most severe first")
 else:
     st.info("No anomalies detected.")
 
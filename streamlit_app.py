@@ -3,10 +3,16 @@ import pandas as pd
 import plotly.express as px
 from dotenv import load_dotenv
 load_dotenv()
-from app import models, database
-from app.services import ingestion, analytics, api_fetcher
-from sqlalchemy.orm import Session
+from app import database
+from app.services import analytics, jobs, datasets
 from contextlib import contextmanager
+import shutil
+import tempfile
+import uuid
+
+# Trend chart resolutions, and the most points drawn per line
+GRANULARITIES = {"day": "Daily", "week": "Weekly", "month": "Monthly"}
+CHART_MAX_POINTS = 400
 
 # Page configuration
 st.set_page_config(
@@ -37,9 +43,15 @@ st.markdown("""
 
 # Database Helper
 @contextmanager
-def get_db_session():
-    """Context manager for database sessions"""
-    db = database.SessionLocal()
+def get_read_session(dataset):
+    """
+    Context manager for read-only sessions on a dataset; these never wait on a
+    running job. Yields None for a dataset nothing has been loaded into yet.
+    """
+    if not database.registry.exists(dataset):
+        yield None
+        return
+    db = datasets.get(dataset).ReadSessionLocal()
     try:
         yield db
     finally:
@@ -48,121 +60,164 @@ def get_db_session():
 # Initialize API Key check (for compatibility with api_fetcher expectations if any)
 # Note: api_fetcher uses os.getenv("API_KEY"), so ensure it's in .env or secrets
 
-# Ensure tables exist
-models.Base.metadata.create_all(bind=database.engine)
+def current_dataset():
+    """Dataset this browser session reads and writes"""
+    return st.session_state['dataset']
 
 # Helper Functions with Direct Service Calls
 
 @st.cache_data(ttl=60)
-def fetch_summary():
-    """Fetch summary statistics from Service"""
+def fetch_summary(dataset, state=None, district=None):
+    """Fetch summary statistics from Service, optionally of one state or district"""
     try:
-        with get_db_session() as db:
-            return analytics.get_overall_summary(db)
+        with get_read_session(dataset) as db:
+            return analytics.get_overall_summary(db, state, district) if db else None
     except Exception as e:
         st.error(f"Failed to fetch summary: {e}")
         return None
 
+# Row results are fetched as columns and loaded into DataFrames without per-row dicts
+
 @st.cache_data(ttl=60)
-def fetch_trends_state(state=None):
-    """Fetch state trends from Service"""
+def fetch_trends_state(dataset, state=None, granularity="day", max_points=None, district=None):
+    """Fetch state trends from Service as a DataFrame"""
     try:
-        with get_db_session() as db:
-            return analytics.get_trends_by_state(db, state)
+        with get_read_session(dataset) as db:
+            return pd.DataFrame(analytics.get_trends_by_state(db, state, as_columns=True, granularity=granularity,
+                                                              max_points=max_points, district=district)
+                                if db else {})
     except Exception as e:
         st.error(f"Failed to fetch state trends: {e}")
-        return []
+        return pd.DataFrame()
 
 @st.cache_data(ttl=60)
-def fetch_trends_district(district=None):
-    """Fetch district trends from Service"""
+def fetch_trends_district(dataset, district=None):
+    """Fetch district trends from Service as a DataFrame"""
     try:
-        with get_db_session() as db:
-            return analytics.get_trends_by_district(db, district)
+        with get_read_session(dataset) as db:
+            return pd.DataFrame(analytics.get_trends_by_district(db, district, as_columns=True) if db else {})
     except Exception as e:
         st.error(f"Failed to fetch district trends: {e}")
-        return []
+        return pd.DataFrame()
 
 @st.cache_data(ttl=60)
-def fetch_age_comparison():
-    """Fetch age comparison data from Service"""
+def fetch_rankings(dataset, level="state", k=10, state=None, district=None):
+    """Fetch the top k states, districts or pincodes from Service as a DataFrame"""
     try:
-        with get_db_session() as db:
-            return analytics.get_age_comparison(db)
+        with get_read_session(dataset) as db:
+            return pd.DataFrame(analytics.get_rankings(db, level, k=k, state=state, district=district, as_columns=True)
+                                if db else {})
+    except Exception as e:
+        st.error(f"Failed to fetch rankings: {e}")
+        return pd.DataFrame()
+
+@st.cache_data(ttl=60)
+def fetch_age_comparison(dataset, state=None, district=None):
+    """Fetch age comparison data from Service, optionally of one state or district"""
+    try:
+        with get_read_session(dataset) as db:
+            return analytics.get_age_comparison(db, state, district) if db else None
     except Exception as e:
         st.error(f"Failed to fetch age comparison: {e}")
         return None
 
+ANOMALY_PAGE_SIZE = 20
+ANOMALY_METHODS = {
+    "Combined": "combined",
+    "Z-score": "zscore",
+    "Median / MAD": "mad",
+    "Sudden drop": "drop",
+    "Below 10 (raw rows)": "threshold",
+}
+
 @st.cache_data(ttl=60)
-def fetch_anomalies():
-    """Fetch anomalies from Service"""
+def fetch_anomalies(dataset, method="combined", page=0, state=None, district=None):
+    """Fetch one ranked page of anomalies from Service, its items as a DataFrame"""
     try:
-        with get_db_session() as db:
-            return analytics.get_anomalies(db)
+        with get_read_session(dataset) as db:
+            if not db:
+                return None
+            result = analytics.get_anomalies(db, method=method, limit=ANOMALY_PAGE_SIZE, offset=page * ANOMALY_PAGE_SIZE,
+                                             state=state, district=district, as_columns=True)
+            return {**result, "items": pd.DataFrame(result["items"])}
     except Exception as e:
         st.error(f"Failed to fetch anomalies: {e}")
-        return []
+        return None
 
 @st.cache_data(ttl=60)
-def fetch_state_options():
+def fetch_state_options(dataset):
     """Fetch unique states from Service"""
     try:
-        with get_db_session() as db:
-            return analytics.get_unique_states(db)
+        with get_read_session(dataset) as db:
+            return analytics.get_unique_states(db) if db else []
     except Exception as e:
         return []
 
 @st.cache_data(ttl=60)
-def fetch_district_options(state=None):
+def fetch_district_options(dataset, state=None):
     """Fetch unique districts from Service"""
     try:
-        with get_db_session() as db:
-            return analytics.get_unique_districts(db, state)
+        with get_read_session(dataset) as db:
+            return analytics.get_unique_districts(db, state) if db else []
     except Exception as e:
         return []
 
-def sync_api_data(limit, state=None, district=None, fetch_all=False):
-    """Trigger API sync"""
+def _track_job(job_id):
+    st.session_state.setdefault('job_ids', []).append(job_id)
+
+def sync_api_data(limit, state=None, district=None, fetch_all=False, incremental=False):
+    """Queue an API sync as a background job"""
     try:
-        with get_db_session() as db:
-            count = api_fetcher.fetch_and_sync_data(db, limit=limit, offset=0, state=state, district=district, fetch_all=fetch_all)
-            
-            filters_msg = []
-            if state:
-                filters_msg.append(f"state={state}")
-            if district:
-                filters_msg.append(f"district={district}")
-            if fetch_all:
-                filters_msg.append("FETCH_ALL=True")
-                
-            filter_str = f" with filters: {', '.join(filters_msg)}" if filters_msg else ""
-            return {"message": f"Successfully synced {count} records from API{filter_str}."}
+        filters_msg = []
+        if state:
+            filters_msg.append(f"state={state}")
+        if district:
+            filters_msg.append(f"district={district}")
+        if fetch_all:
+            filters_msg.append("FETCH_ALL=True")
+        if incremental:
+            filters_msg.append("INCREMENTAL=True")
+
+        job = jobs.submit_sync(", ".join(filters_msg), dataset=current_dataset(), limit=limit, offset=0,
+                               state=state, district=district, fetch_all=fetch_all, incremental=incremental)
+        _track_job(job.id)
+        return {"message": "API sync started in the background.", "job_id": job.id}
     except Exception as e:
         st.error(f"Sync failed: {e}")
         return None
 
 def upload_csv_file(uploaded_file):
-    """Upload CSV file to backend"""
+    """Queue a CSV upload as a background job"""
     try:
         if not uploaded_file.name.endswith('.csv'):
              st.error("Invalid file type. Please upload a CSV.")
              return None
 
-        content = uploaded_file.getvalue()
-        with get_db_session() as db:
-            count = ingestion.process_csv_and_ingest(content, db)
-            return {"message": f"Successfully processed {count} records."}
+        # Stream the upload to disk so the job can read it after this run ends
+        uploaded_file.seek(0)
+        with tempfile.NamedTemporaryFile(suffix=".csv", delete=False) as tmp:
+            shutil.copyfileobj(uploaded_file, tmp)
+        job = jobs.submit_upload(tmp.name, uploaded_file.name, dataset=current_dataset())
+        _track_job(job.id)
+        return {"message": f"Upload of {uploaded_file.name} started in the background.", "job_id": job.id}
     except Exception as e:
         st.error(f"Upload failed: {e}")
         return None
 
+def get_job_status(job_id):
+    """Get status of a background job"""
+    job = jobs.job_manager.get(job_id)
+    return job.to_dict() if job else None
+
+def cancel_job(job_id):
+    """Request cancellation of a background job"""
+    jobs.job_manager.cancel(job_id)
+
 def clear_database():
-    """Clear all data from database"""
+    """Clear all data from this session's dataset"""
     try:
-        with get_db_session() as db:
-             count = db.query(models.EnrolmentData).delete()
-             db.commit()
-             return {"message": f"Successfully deleted {count} records from database."}
+        count = datasets.clear(current_dataset())
+        return {"message": f"Successfully deleted {count} records from database."}
     except Exception as e:
         st.error(f"Clear failed: {e}")
         return None
@@ -171,16 +226,32 @@ def clear_database():
 st.markdown('<h1 class="main-header">📊 Aadhaar Enrolment Analytics Dashboard</h1>', unsafe_allow_html=True)
 
 # Session State Initialization
-if 'initialized' not in st.session_state:
-    st.session_state['initialized'] = True
-    # Auto-clear DB on first load as requested
-    with st.spinner("Initializing dashboard and clearing previous data..."):
-        clear_database()
-        st.toast("Database cleared for new session", icon="🧹")
+if 'dataset' not in st.session_state:
+    # Each new session starts in an empty dataset of its own, so opening the
+    # dashboard no longer clears the data other sessions are looking at. The
+    # dataset is named in the URL, so reloading the page goes back to it
+    # instead of starting another. Session datasets left unused are deleted
+    # (see SESSION_DATASET_SECONDS in app/database.py)
+    try:
+        st.session_state['dataset'] = database.validate_dataset_name(st.query_params.get('dataset', ''))
+    except ValueError:
+        st.session_state['dataset'] = f"{database.SESSION_DATASET_PREFIX}{uuid.uuid4().hex[:8]}"
+    st.session_state['dataset_input'] = st.session_state['dataset']
 
 # Sidebar - Filters
 st.sidebar.header("🔍 Filters & Controls")
 
+# Dataset Selection
+dataset_input = st.sidebar.text_input(
+    "🗂️ Dataset", key="dataset_input",
+    help="Uploads, syncs, charts and Clear All Data apply to this dataset. Enter the same name in another session to share it."
+)
+try:
+    st.session_state['dataset'] = database.validate_dataset_name(dataset_input.strip())
+except ValueError as e:
+    st.sidebar.error(str(e))
+st.query_params['dataset'] = current_dataset()
+
 # --- GLOBAL FILTERS ---
 st.sidebar.subheader("🗺️ Geographic Filters")
 
@@ -189,16 +260,16 @@ filter_mode = st.sidebar.radio("Filter Selection Mode", ["Dropdown", "Manual"],
 
 if filter_mode == "Dropdown":
     # Fetch available options
-    state_options = fetch_state_options()
+    state_options = fetch_state_options(current_dataset())
     state_options = ["All"] + state_options if state_options else ["All"]
 
     filter_state = st.sidebar.selectbox("Filter by State", options=state_options)
 
     # Filter districts based on selected state
     if filter_state != "All":
-        district_options = fetch_district_options(filter_state)
+        district_options = fetch_district_options(current_dataset(), filter_state)
     else:
-        district_options = fetch_district_options()
+        district_options = fetch_district_options(current_dataset())
         
     district_options = ["All"] + district_options if district_options else ["All"]
     filter_district = st.sidebar.selectbox("Filter by District", options=district_options)
@@ -224,19 +295,17 @@ st.sidebar.markdown("---")
 # CSV Upload Section
 with st.sidebar.expander("📤 Upload CSV File", expanded=True):
     uploaded_file = st.file_uploader("Choose a CSV file", type=['csv'])
-    clear_before_upload = st.checkbox("Clear existing data before upload", value=True, key="clear_upload")
+    clear_before_upload = st.checkbox("Clear existing data before upload", value=False, key="clear_upload")
     
     if uploaded_file is not None:
         if st.button("📁 Upload & Process", type="primary", key="upload_btn"):
-            with st.spinner("Processing..."):
-                if clear_before_upload:
-                    clear_database()
-                
-                result = upload_csv_file(uploaded_file)
-                if result:
-                    st.success(result.get("message", "Upload completed!"))
-                    st.cache_data.clear()
-                    st.rerun()
+            if clear_before_upload:
+                clear_database()
+                st.cache_data.clear()
+
+            result = upload_csv_file(uploaded_file)
+            if result:
+                st.success(result.get("message", "Upload started!"))
 
 st.sidebar.markdown("---")
 
@@ -246,19 +315,69 @@ with st.sidebar.expander("🔄 Sync Data from API", expanded=True):
     fetch_all = st.checkbox("Fetch All Records (ignores limit)", value=False)
     sync_limit = st.number_input("Records to fetch", min_value=10, max_value=1000, value=100, step=10, disabled=fetch_all)
     
-    clear_before_sync = st.checkbox("Clear existing data before sync", value=True, key="clear_sync")
+    incremental_sync = st.checkbox("Incremental (resume from the last synced offset)", value=True, key="incremental_sync",
+                                   help="Fetches only records appended since the last sync of this filter; "
+                                        "changes to records already synced need a full sync.")
+    clear_before_sync = st.checkbox("Clear existing data before sync", value=False, key="clear_sync", disabled=incremental_sync)
     
     if st.button("🚀 Sync Now", type="primary"):
-        with st.spinner("Syncing data..."):
-            if clear_before_sync:
-                clear_database()
-                
-            # Use selected_state and selected_district from Global Filters
-            result = sync_api_data(sync_limit, selected_state, selected_district, fetch_all=fetch_all)
-            if result:
-                st.success(result.get("message", "Sync completed!"))
-                st.cache_data.clear()  # Clear cache to refresh data
-                st.rerun()
+        if clear_before_sync and not incremental_sync:
+            clear_database()
+            st.cache_data.clear()
+
+        # Use selected_state and selected_district from Global Filters
+        result = sync_api_data(sync_limit, selected_state, selected_district, fetch_all=fetch_all, incremental=incremental_sync)
+        if result:
+            st.success(result.get("message", "Sync started!"))
+
+st.sidebar.markdown("---")
+
+# Background Jobs Section
+@st.fragment(run_every=2)
+def background_jobs_panel():
+    """Poll the background jobs started from this session"""
+    for message in st.session_state.pop('job_messages', []):
+        st.success(message)
+
+    job_ids = st.session_state.get('job_ids', [])
+    if not job_ids:
+        return
+
+    st.subheader("⏳ Background Jobs")
+    finished = []
+    for job_id in list(job_ids):
+        status = get_job_status(job_id)
+        if status is None:
+            job_ids.remove(job_id)
+            continue
+
+        st.caption(f"{status['description']} ({status['status']})")
+        st.progress(status['progress'] or 0.0)
+        details = f"{status['rows_done']:,} records · {status['rate']:,.0f} rec/s"
+        if status['eta_seconds'] is not None:
+            details += f" · ETA {status['eta_seconds']:.0f}s"
+        st.caption(details)
+
+        if status['status'] in ("queued", "running"):
+            if st.button("✖ Cancel", key=f"cancel_{job_id}"):
+                cancel_job(job_id)
+        else:
+            job_ids.remove(job_id)
+            finished.append(status)
+
+    if finished:
+        messages = st.session_state.setdefault('job_messages', [])
+        for status in finished:
+            if status['status'] == "failed":
+                st.error(f"{status['description']} failed: {'; '.join(status['errors'])}")
+            else:
+                messages.append(status['message'])
+        # New data is in, refresh every chart
+        st.cache_data.clear()
+        st.rerun()
+
+with st.sidebar:
+    background_jobs_panel()
 
 st.sidebar.markdown("---")
 
@@ -280,7 +399,7 @@ if st.sidebar.button("🔄 Refresh Data"):
 # Main Content
 # KPI Cards
 st.subheader("📈 Key Performance Indicators")
-summary = fetch_summary()
+summary = fetch_summary(current_dataset(), selected_state, selected_district)
 
 if summary:
     col1, col2, col3, col4, col5 = st.columns(5)
@@ -304,10 +423,14 @@ col_left, col_right = st.columns(2)
 # Time-series Chart
 with col_left:
     st.subheader("📊 Enrolment Trends Over Time")
-    trends_data = fetch_trends_state(selected_state)
+    granularity = st.radio("Resolution", list(GRANULARITIES), horizontal=True,
+                           format_func=lambda g: GRANULARITIES[g])
+    # Each state's line is downsampled to what the chart can show
+    trends_data = fetch_trends_state(current_dataset(), selected_state, granularity, CHART_MAX_POINTS,
+                                     selected_district)
     
-    if trends_data:
-        df_trends = pd.DataFrame(trends_data)
+    if not trends_data.empty:
+        df_trends = trends_data
         df_trends['date'] = pd.to_datetime(df_trends['date'])
         
         fig_trends = px.line(
@@ -315,7 +438,7 @@ with col_left:
             x='date', 
             y='enrolments',
             color='state' if 'state' in df_trends.columns else None,
-            title="Daily Enrolments",
+            title=f"{GRANULARITIES[granularity]} Enrolments",
             labels={'enrolments': 'Number of Enrolments', 'date': 'Date'}
         )
         fig_trends.update_layout(height=400)
@@ -326,7 +449,7 @@ with col_left:
 # Age Group Pie Chart
 with col_right:
     st.subheader("👥 Age Group Distribution")
-    age_data = fetch_age_comparison()
+    age_data = fetch_age_comparison(current_dataset(), selected_state, selected_district)
     
     if age_data:
         age_df = pd.DataFrame([
@@ -349,47 +472,60 @@ with col_right:
 
 # State-wise Bar Chart
 st.subheader("🗺️ Top States by Enrolment")
-# Use filtered data if state filter is provided, otherwise show all
-state_trends = fetch_trends_state(selected_state)
-
-if state_trends:
-    df_states = pd.DataFrame(state_trends)
-    if 'state' in df_states.columns:
-        state_summary = df_states.groupby('state')['enrolments'].sum().reset_index()
-        state_summary = state_summary.sort_values('enrolments', ascending=False).head(10)
-        
-        # Update title based on filter
-        chart_title = f"Top 10 States" if not selected_state else f"Enrolments for {selected_state}"
-        
-        fig_states = px.bar(
-            state_summary,
-            x='state',
-            y='enrolments',
-            title=chart_title,
-            labels={'enrolments': 'Total Enrolments', 'state': 'State'},
-            color='enrolments',
-            color_continuous_scale='Blues'
-        )
-        fig_states.update_layout(
-            height=400,
-            xaxis={'categoryorder': 'total descending'}
-        )
-        st.plotly_chart(fig_states, use_container_width=True)
-    else:
-        st.info("No state-level data available.")
+# Use filtered data if state filter is provided, otherwise show all.
+# The states are ranked by the backend; only the top 10 come back
+state_summary = fetch_rankings(current_dataset(), "state", 10, selected_state, selected_district)
+
+if not state_summary.empty:
+    # Update title based on filter
+    chart_title = f"Top 10 States" if not selected_state else f"Enrolments for {selected_state}"
+    if selected_district:
+        chart_title += f" ({selected_district} district)"
+    
+    fig_states = px.bar(
+        state_summary,
+        x='state',
+        y='total',
+        title=chart_title,
+        labels={'total': 'Total Enrolments', 'state': 'State'},
+        color='total',
+        color_continuous_scale='Blues'
+    )
+    fig_states.update_layout(
+        height=400,
+        xaxis={'categoryorder': 'total descending'}
+    )
+    st.plotly_chart(fig_states, use_container_width=True)
+else:
+    st.info("No state-level data available.")
 
 # Anomalies Table
-st.subheader("⚠️ Anomaly Alerts (Low Enrolment Days)")
-anomalies = fetch_anomalies()
+st.subheader("⚠️ Anomaly Alerts")
+anomaly_col1, anomaly_col2 = st.columns([3, 1])
+with anomaly_col1:
+    anomaly_method = st.selectbox(
+        "Detection method",
+        options=list(ANOMALY_METHODS),
+        help="Statistical methods score each district's daily series against its previous 28 days"
+    )
+with anomaly_col2:
+    anomaly_page = st.number_input("Page", min_value=1, value=1, step=1)
+
+anomalies = fetch_anomalies(current_dataset(), ANOMALY_METHODS[anomaly_method], int(anomaly_page) - 1,
+                            selected_state, selected_district)
 
-if anomalies:
-    df_anomalies = pd.DataFrame(anomalies)
+if anomalies and not anomalies['items'].empty:
+    df_anomalies = anomalies['items']
     df_anomalies['date'] = pd.to_datetime(df_anomalies['date']).dt.date
+    columns = [c for c in ['date', 'state', 'district', 'total_enrolment', 'expected', 'score', 'type']
+               if c in df_anomalies.columns]
     st.dataframe(
-        df_anomalies[['date', 'district', 'total_enrolment', 'type']].head(20),
+        df_anomalies[columns],
         use_container_width=True,
         hide_index=True
     )
+    first = anomalies['offset'] + 1
+    st.caption(f"Showing {first}-{first + len(df_anomalies) - 1} of {anomalies['total']:,} anomalies, most severe first")
 else:
     st.info("No anomalies detected.")
 
@@ -0,0 +1,77 @@
+from collections import defaultdict
+import csv
+import requests
+
+BASE_URL = "http://127.0.0.1:8000"
+DATASET = "test-aggregate"
+MEASURES = {"records": (), "total": ("age_0_5", "age_5_17", "age_18_greater"), "age_0_5": ("age_0_5",)}
+
+def aggregate(**params):
+    return requests.get(f"{BASE_URL}/aggregate", params={"dataset": DATASET, **params})
+
+def expected(group_by, measures, state=None, district=None, pincode=None, start=None, end=None):
+    # Groups summed from testingdata.csv directly, in group order
+    sums = defaultdict(lambda: [0] * len(measures))
+    with open('testingdata.csv', newline='') as f:
+        for row in csv.DictReader(f):
+            row["date"] = "-".join(reversed(row["date"].split("-")))
+            row["month"] = row["date"][:8] + "01"
+            if (start and row["date"] < start) or (end and row["date"] > end) or (state and row["state"] != state) \
+                    or (district and row["district"] != district) or (pincode and not row["pincode"].startswith(pincode)):
+                continue
+            group = sums[tuple(row[name] for name in group_by)]
+            for i, measure in enumerate(measures):
+                group[i] += sum(int(row[c]) for c in MEASURES[measure]) if MEASURES[measure] else 1
+    return [dict(zip(group_by + measures, key + tuple(values))) for key, values in sorted(sums.items())]
+
+def test_aggregate():
+    print("1. Upload testingdata.csv into dataset 'test-aggregate'...")
+    with open('testingdata.csv', 'rb') as f:
+        r = requests.post(f"{BASE_URL}/upload", params={"dataset": DATASET},
+                          files={'file': ('testingdata.csv', f, 'text/csv')})
+    print(f"Upload: {r.status_code} - {r.json().get('message')}")
+
+    print("\n2. Compare aggregates with sums over the CSV...")
+    all_match = True
+    for group_by, measures, filters in [
+        ((), ("records", "total"), {}),
+        (("state",), ("total", "age_0_5"), {"start_date": "2025-10-01"}),
+        (("month", "district"), ("total",), {"state": "Gujarat"}),
+        (("pincode",), ("records",), {"district": "Bhavnagar", "pincode": "364"}),
+        (("date", "state", "district"), ("total",), {"start_date": "2025-09-15", "end_date": "2025-11-02"}),
+    ]:
+        params = {"group_by": ",".join(group_by), "measures": ",".join(measures), **filters}
+        items = aggregate(**params).json()
+        match = items == expected(group_by, measures, filters.get("state"), filters.get("district"),
+                                  filters.get("pincode"), filters.get("start_date"), filters.get("end_date"))
+        # The same groups a page at a time
+        pages, cursor = [], None
+        while group_by:
+            page = aggregate(**params, limit=7, **({"cursor": cursor} if cursor else {})).json()
+            pages += page["items"]
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+        match &= not group_by or pages == items
+        all_match &= match
+        print(f"{params}: {len(items)} groups, first {items[0] if items else None}; match: {match}")
+
+    print("\n3. Filtered summary...")
+    summary = requests.get(f"{BASE_URL}/summary", params={"dataset": DATASET, "district": "Bhavnagar"}).json()
+    total = expected((), ("total",), district="Bhavnagar")[0]["total"]
+    print(f"Summary of Bhavnagar: {summary}")
+    all_match &= summary["total_enrolments"] == total
+
+    bad = [aggregate(**params).status_code for params in ({"group_by": "city"}, {"measures": "mean"},
+                                                          {"group_by": "date,month"}, {"pincode": "36x"})]
+    print(f"Invalid group_by / measures / two dates / pincode: {bad}")
+
+    requests.delete(f"{BASE_URL}/datasets/{DATASET}")
+
+    if all_match and bad == [400, 400, 400, 400]:
+        print("\nSUCCESS: Aggregates match the sums over the CSV.")
+    else:
+        print("\nFAILURE: Aggregates differ from the sums over the CSV.")
+
+if __name__ == "__main__":
+    test_aggregate()
@@ -0,0 +1,37 @@
+import requests
+
+BASE_URL = "http://127.0.0.1:8000"
+DATASET = "test-blank-pincode"
+CSV = (b"date,state,district,pincode,age_0_5,age_5_17,age_18_greater\n"
+       b"01-09-2025,Gujarat,Bhavnagar,,2,1,0\n"
+       b"01-09-2025,Gujarat,Bhavnagar,364070,3,0,0\n")
+
+def upload():
+    r = requests.post(f"{BASE_URL}/upload", params={"dataset": DATASET},
+                      files={'file': ('blank_pincode.csv', CSV, 'text/csv')})
+    print(f"Upload: {r.status_code} - {r.json().get('message')}")
+
+def test_blank_pincode():
+    print("1. Upload a CSV with a row without a pincode, twice...")
+    upload()
+    upload()
+
+    print("\n2. Check the second upload overwrote the rows instead of adding copies...")
+    totals = requests.get(f"{BASE_URL}/aggregate", params={"dataset": DATASET, "measures": "records,total"}).json()
+    summary = requests.get(f"{BASE_URL}/summary", params={"dataset": DATASET}).json()
+    pincodes = requests.get(f"{BASE_URL}/aggregate", params={"dataset": DATASET, "group_by": "pincode",
+                                                           "measures": "records"}).json()
+    print(f"Records and total: {totals}")
+    print(f"Summary: {summary}")
+    print(f"By pincode: {pincodes}")
+
+    requests.delete(f"{BASE_URL}/datasets/{DATASET}")
+
+    if totals == [{"records": 2, "total": 6}] and summary["total_enrolments"] == 6 \
+            and pincodes == [{"pincode": "364070", "records": 1}]:
+        print("\nSUCCESS: Rows without a pincode are upserted like any other.")
+    else:
+        print("\nFAILURE: Re-uploading rows without a pincode added copies.")
+
+if __name__ == "__main__":
+    test_blank_pincode()
@@ -0,0 +1,156 @@
+import csv
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+import requests
+
+BASE_URL = "http://127.0.0.1:8000"
+DATASET = "concurrency-test"
+ROWS = int(os.getenv("CONCURRENCY_ROWS", "600000"))
+CHUNK_SIZE = 100000
+READER_THREADS = 4
+# Reads of the idle dataset after the upload, per query, to compare the reads during it with
+BASELINE_SECONDS = 5
+# The upload competes with readers for CPU, but a read that waited for an
+# ingest chunk to commit would be slower than its idle median by far more
+MAX_SLOWDOWN = 5
+
+STATES = ["Assam", "Gujarat", "Kerala", "Maharashtra", "Punjab"]
+
+def write_csv(path, rows):
+    """Synthetic upload: a year of days over 5 states x 8 districts. Returns the total enrolment."""
+    rng = random.Random(42)
+    total = 0
+    start = date(2025, 1, 1)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["date", "state", "district", "pincode", "age_0_5", "age_5_17", "age_18_greater"])
+        for i in range(rows):
+            state = STATES[i % len(STATES)]
+            day = start + timedelta(days=(i // 40) % 365)
+            ages = [rng.randint(0, 50), rng.randint(0, 20), rng.randint(0, 10)]
+            total += sum(ages)
+            writer.writerow([day.strftime("%d-%m-%Y"), state, f"{state} District {i % 8}", 100000 + i, *ages])
+    return total
+
+def random_query():
+    # A dashboard view of about a month: random ranges keep the response cache
+    # out of both the idle and the loaded reads
+    start = date(2025, 1, 1) + timedelta(days=random.randrange(330))
+    params = {"start_date": start.isoformat(), "end_date": (start + timedelta(days=random.randrange(1, 35))).isoformat()}
+    path, extra = random.choice([
+        ("/summary", {}),
+        ("/trends/state", {}),
+        ("/trends/state", {"state": random.choice(STATES)}),
+        ("/age-comparison", {"state": random.choice(STATES)}),
+        ("/anomalies", {}),
+        ("/anomalies", {"method": "threshold", "threshold": 5}),
+    ])
+    return path, {**params, **extra, "dataset": DATASET}
+
+def reader(stop, results):
+    session = requests.Session()
+    while not stop.is_set():
+        path, params = random_query()
+        query = (path, params.get("method"))
+        started = time.perf_counter()
+        try:
+            status = session.get(f"{BASE_URL}{path}", params=params, timeout=30).status_code
+        except requests.RequestException as e:
+            status = str(e)
+        results.append((query, status, time.perf_counter() - started))
+
+def read_until(done):
+    """Run READER_THREADS readers until done() returns. Returns (query, status, seconds) per read."""
+    stop = threading.Event()
+    results = []
+    threads = [threading.Thread(target=reader, args=(stop, results)) for _ in range(READER_THREADS)]
+    for t in threads:
+        t.start()
+    try:
+        done()
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+    return results
+
+def percentile(values, fraction):
+    return sorted(values)[int(len(values) * fraction) - 1]
+
+def test_reads_during_ingest():
+    print(f"1. Removing dataset '{DATASET}' left by an earlier run...")
+    requests.delete(f"{BASE_URL}/datasets/{DATASET}")
+
+    path = os.path.join(tempfile.gettempdir(), "concurrency_test.csv")
+    expected = write_csv(path, ROWS)
+    # Deferred indexes end the upload with one long index-rebuild transaction
+    print(f"2. Background upload of {ROWS} rows in chunks of {CHUNK_SIZE}, deferring indexes...")
+    with open(path, "rb") as f:
+        r = requests.post(f"{BASE_URL}/upload", params={"dataset": DATASET, "background": "true",
+                                                         "defer_indexes": "true", "chunk_size": CHUNK_SIZE},
+                          files={'file': ('concurrency_test.csv', f, 'text/csv')})
+    os.remove(path)
+    if r.status_code != 202:
+        print(f"FAILURE: upload was not queued: {r.status_code} {r.text}")
+        requests.delete(f"{BASE_URL}/datasets/{DATASET}")
+        return
+    job_id = r.json()['job_id']
+
+    print(f"3. {READER_THREADS} readers querying while the upload runs...")
+    status = {}
+    def upload_done():
+        while True:
+            status.update(requests.get(f"{BASE_URL}/jobs/{job_id}").json())
+            if status['status'] not in ("queued", "running"):
+                return
+            time.sleep(0.2)
+    started = time.time()
+    results = read_until(upload_done)
+    print(f"Upload {status['status']}: {status['rows_done']} records in {time.time() - started:.1f}s")
+
+    print(f"4. The same readers for {BASELINE_SECONDS}s on the idle dataset...")
+    idle = read_until(lambda: time.sleep(BASELINE_SECONDS))
+
+    errors = [(q, s) for q, s, _ in results + idle if s != 200]
+    baseline = {}
+    for query, _, seconds in idle:
+        baseline.setdefault(query, []).append(seconds)
+    baseline = {query: statistics.median(times) for query, times in baseline.items()}
+    # Each read during the upload as a multiple of its query's idle median
+    slowdowns = [seconds / baseline[query] for query, _, seconds in results if query in baseline]
+    for label, reads in (("Idle", idle), ("During upload", results)):
+        latencies = [seconds for _, _, seconds in reads]
+        if latencies:
+            print(f"{label} reads: {len(latencies)}, median {statistics.median(latencies) * 1000:.0f} ms, "
+                  f"p95 {percentile(latencies, 0.95) * 1000:.0f} ms, max {max(latencies) * 1000:.0f} ms")
+    if slowdowns:
+        print(f"Slowdown over idle: p95 {percentile(slowdowns, 0.95):.1f}x, p99 {percentile(slowdowns, 0.99):.1f}x, "
+              f"max {max(slowdowns):.1f}x")
+
+    summary = requests.get(f"{BASE_URL}/summary", params={"dataset": DATASET}).json()
+    print(f"Summary after upload: {summary['total_enrolments']} (expected {expected})")
+
+    requests.delete(f"{BASE_URL}/datasets/{DATASET}")
+
+    if status['status'] != "succeeded":
+        print(f"FAILURE: upload did not complete: {status['errors']}")
+    elif errors:
+        print(f"FAILURE: {len(errors)} reads failed, e.g. {errors[:3]}")
+    elif len(slowdowns) < READER_THREADS * 25:
+        print("FAILURE: too few reads overlapped the upload to tell.")
+    elif percentile(slowdowns, 0.99) > MAX_SLOWDOWN:
+        print(f"FAILURE: p99 read was {percentile(slowdowns, 0.99):.1f}x its idle median; "
+              "readers are waiting on the writer.")
+    elif summary['total_enrolments'] != expected:
+        print("FAILURE: readers do not see the committed upload.")
+    else:
+        print("SUCCESS: reads were served throughout the upload.")
+
+if __name__ == "__main__":
+    test_reads_during_ingest()
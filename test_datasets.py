@@ -0,0 +1,40 @@
+import requests
+import time
+
+BASE_URL = "http://127.0.0.1:8000"
+
+def total(dataset):
+    r = requests.get(f"{BASE_URL}/summary", params={"dataset": dataset})
+    return r.json().get('total_enrolments') if r.status_code == 200 else r.status_code
+
+def test_datasets():
+    print("1. Upload testingdata.csv into dataset 'test-a'...")
+    with open('testingdata.csv', 'rb') as f:
+        r = requests.post(f"{BASE_URL}/upload", params={"dataset": "test-a"},
+                          files={'file': ('testingdata.csv', f, 'text/csv')})
+    print(f"Upload: {r.status_code} - {r.json().get('message')}")
+    default_before = total("default")
+    print(f"test-a: {total('test-a')}, default: {default_before}")
+    print(f"Datasets: {requests.get(f'{BASE_URL}/datasets').json()}")
+
+    print("\n2. Clear 'test-a'...")
+    started = time.time()
+    r = requests.delete(f"{BASE_URL}/clear-data", params={"dataset": "test-a"})
+    print(f"Clear: {r.status_code} - {r.json()} in {time.time() - started:.3f}s")
+    test_a_after = total("test-a")
+    default_after = total("default")
+    print(f"test-a: {test_a_after}, default: {default_after}")
+
+    print("\n3. Remove 'test-a'...")
+    r = requests.delete(f"{BASE_URL}/datasets/test-a")
+    print(f"Remove: {r.status_code} - {r.json()}")
+    missing = total("test-a")
+    print(f"Reading removed dataset: {missing}")
+
+    if test_a_after == 0 and default_after == default_before and missing == 404:
+        print("\nSUCCESS: Datasets are isolated and clear independently.")
+    else:
+        print("\nFAILURE: Clearing one dataset affected another, or it was not cleared.")
+
+if __name__ == "__main__":
+    test_datasets()
@@ -0,0 +1,51 @@
+import json
+import requests
+import pandas as pd
+import pyarrow.ipc
+
+BASE_URL = "http://127.0.0.1:8000"
+DATASET = "test-formats"
+
+def get(path, format, **params):
+    return requests.get(f"{BASE_URL}{path}", params={"dataset": DATASET, "format": format, **params})
+
+def frame(response, format):
+    # Rows of a response as a DataFrame, and its other fields
+    if format == "arrow":
+        table = pyarrow.ipc.open_stream(response.content).read_all()
+        return table.to_pandas().astype(str), {k.decode(): json.loads(v) for k, v in (table.schema.metadata or {}).items()}
+    payload = response.json()
+    if isinstance(payload, dict) and "items" in payload:
+        return pd.DataFrame(payload.pop("items")).astype(str), payload
+    return pd.DataFrame(payload).astype(str), {}
+
+def test_formats():
+    print("1. Upload testingdata.csv into dataset 'test-formats'...")
+    with open('testingdata.csv', 'rb') as f:
+        r = requests.post(f"{BASE_URL}/upload", params={"dataset": DATASET},
+                          files={'file': ('testingdata.csv', f, 'text/csv')})
+    print(f"Upload: {r.status_code} - {r.json().get('message')}")
+
+    all_match = True
+    for step, (path, params) in enumerate([("/trends/state", {}), ("/trends/district", {"limit": 20}),
+                                           ("/anomalies", {"method": "threshold", "threshold": 50, "limit": 200})], 2):
+        print(f"\n{step}. {path} {params} as json, columnar and arrow...")
+        rows, fields = frame(get(path, "json", **params), "json")
+        for format in ("columnar", "arrow"):
+            response = get(path, format, **params)
+            got, got_fields = frame(response, format)
+            match = got.equals(rows) and got_fields == fields
+            all_match = all_match and match
+            print(f"{format}: {response.headers['content-type']}, {len(response.content):,} bytes, "
+                  f"{len(got)} rows; same rows and fields as json: {match}")
+        print(f"json: {len(get(path, 'json', **params).content):,} bytes")
+
+    requests.delete(f"{BASE_URL}/datasets/{DATASET}")
+
+    if all_match:
+        print("\nSUCCESS: Columnar and Arrow responses hold the same rows as JSON.")
+    else:
+        print("\nFAILURE: A columnar or Arrow response differs from JSON.")
+
+if __name__ == "__main__":
+    test_formats()
@@ -0,0 +1,56 @@
+from collections import defaultdict
+from datetime import date
+import requests
+
+BASE_URL = "http://127.0.0.1:8000"
+DATASET = "test-granularity"
+
+def trends(**params):
+    return requests.get(f"{BASE_URL}/trends/state", params={"dataset": DATASET, **params}).json()
+
+def test_granularity():
+    print("1. Upload testingdata.csv into dataset 'test-granularity'...")
+    with open('testingdata.csv', 'rb') as f:
+        r = requests.post(f"{BASE_URL}/upload", params={"dataset": DATASET},
+                          files={'file': ('testingdata.csv', f, 'text/csv')})
+    print(f"Upload: {r.status_code} - {r.json().get('message')}")
+    daily = trends()
+
+    print("\n2. Compare weekly and monthly points with sums of the daily ones...")
+    sums_match = True
+    for granularity, bucket in [("week", lambda d: d.toordinal() - d.weekday()),
+                                ("month", lambda d: d.replace(day=1).toordinal())]:
+        expected = defaultdict(int)
+        for point in daily:
+            expected[(date.fromordinal(bucket(date.fromisoformat(point["date"]))).isoformat(),
+                      point["state"])] += point["enrolments"]
+        points = trends(granularity=granularity)
+        got = {(p["date"], p["state"]): p["enrolments"] for p in points}
+        sums_match &= got == dict(expected) and [(p["date"], p["state"]) for p in points] == sorted(got)
+        print(f"{granularity}: {len(points)} points from {len(daily)} daily; sums match: {got == dict(expected)}")
+
+    print("\n3. Downsample each state's daily series to 10 points...")
+    thin = trends(max_points=10)
+    series = defaultdict(list)
+    for point in daily:
+        series[point["state"]].append(point)
+    kept = defaultdict(list)
+    for point in thin:
+        kept[point["state"]].append(point)
+    shape_kept = all(len(kept[s]) == min(10, len(points)) and kept[s][0] == points[0] and kept[s][-1] == points[-1]
+                     and all(p in points for p in kept[s]) for s, points in series.items())
+    print(f"{len(daily)} points -> {len(thin)}; endpoints kept and every point real: {shape_kept}")
+
+    bad = [requests.get(f"{BASE_URL}/trends/state", params={"dataset": DATASET, **params}).status_code
+           for params in ({"granularity": "year"}, {"max_points": 2}, {"max_points": 10, "limit": 5})]
+    print(f"Invalid granularity / max_points: {bad}")
+
+    requests.delete(f"{BASE_URL}/datasets/{DATASET}")
+
+    if sums_match and shape_kept and bad == [400, 400, 400]:
+        print("\nSUCCESS: Resampled and downsampled trends match the daily points.")
+    else:
+        print("\nFAILURE: Resampled or downsampled trends differ from the daily points.")
+
+if __name__ == "__main__":
+    test_granularity()
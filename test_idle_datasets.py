@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# A small registry: three open datasets at most, session datasets expire
+# after two seconds, and datasets in use are marked so every second
+DATA_DIR = tempfile.mkdtemp()
+os.environ.update({"DATA_DIR": DATA_DIR, "MAX_OPEN_DATASETS": "3", "SESSION_DATASET_SECONDS": "2",
+                   "DATASET_HEARTBEAT_SECONDS": "1"})
+
+from sqlalchemy import text
+
+from app import database
+from app.services import datasets, ingestion
+
+def upload(name):
+    with open('testingdata.csv', 'rb') as f:
+        content = f.read()
+    with datasets.get(name).SessionLocal() as db:
+        return ingestion.process_csv_and_ingest(content, db)
+
+def read_until(dataset, stop):
+    # Another process (say the API next to the Streamlit app) reading a dataset
+    while not stop.is_set():
+        with dataset.read_engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        time.sleep(0.2)
+
+def test_idle_datasets():
+    print("1. Upload into two session datasets, then into four more datasets...")
+    records = upload("session-idle")
+    upload("session-shared")
+    for n in range(4):
+        upload(f"idle-{n}")
+    open_names = sorted(database.registry._open)
+    print(f"Open: {open_names}")
+
+    print("\n2. Another registry on the same files keeps reading session-shared...")
+    other = database.DatasetRegistry(DATA_DIR)
+    stop = threading.Event()
+    thread = threading.Thread(target=read_until, args=(other.open("session-shared"), stop))
+    thread.start()
+
+    print("\n3. Wait for the session datasets to expire, then open another dataset...")
+    time.sleep(2.5)
+    datasets.get("idle-0")
+    stop.set()
+    thread.join()
+    idle_kept = database.registry.exists("session-idle")
+    shared_kept = database.registry.exists("session-shared")
+    print(f"Unused session dataset still there: {idle_kept}; one in use elsewhere: {shared_kept}")
+
+    counts = [datasets.row_count(f"idle-{n}") for n in range(4)]
+    print(f"Records after reopening: {counts} (expected {records} each)")
+
+    print("\n4. Remove a dataset and create it again...")
+    removed = datasets.get("idle-3").path
+    datasets.remove("idle-3")
+    recreated = datasets.get("idle-3").path
+    print(f"Storage before: {removed}, after: {recreated}")
+
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+    if (len(open_names) <= 3 and not idle_kept and shared_kept and counts == [records] * 4
+            and recreated != removed):
+        print("\nSUCCESS: Idle datasets were closed, only the unused session dataset was deleted, "
+              "and storage paths are not reused.")
+    else:
+        print("\nFAILURE: Idle datasets stayed open, the wrong session datasets were deleted "
+              "or a storage path was reused.")
+
+if __name__ == "__main__":
+    test_idle_datasets()
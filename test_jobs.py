@@ -0,0 +1,43 @@
+import requests
+import time
+
+BASE_URL = "http://127.0.0.1:8000"
+
+def wait_for_job(job_id, timeout=300):
+    started = time.time()
+    while time.time() - started < timeout:
+        r = requests.get(f"{BASE_URL}/jobs/{job_id}")
+        status = r.json()
+        print(f"  {status['status']}: {status['rows_done']} records, {status['rate']} rec/s, ETA {status['eta_seconds']}")
+        if status['status'] not in ("queued", "running"):
+            return status
+        time.sleep(1)
+    return None
+
+def test_jobs():
+    print("1. Background upload of testingdata.csv...")
+    with open('testingdata.csv', 'rb') as f:
+        r = requests.post(f"{BASE_URL}/upload?background=true", files={'file': ('testingdata.csv', f, 'text/csv')})
+    print(f"Status: {r.status_code} - {r.json()}")
+    if r.status_code != 202:
+        print("FAILURE: upload was not queued.")
+        return
+    status = wait_for_job(r.json()['job_id'])
+    print(f"Final: {status}")
+
+    print("\n2. Background API sync, then cancel...")
+    r = requests.post(f"{BASE_URL}/sync-api?limit=100&fetch_all=true&background=true")
+    print(f"Status: {r.status_code} - {r.json()}")
+    job_id = r.json()['job_id']
+    time.sleep(2)
+    r = requests.post(f"{BASE_URL}/jobs/{job_id}/cancel")
+    print(f"Cancel: {r.status_code} - {r.json()['status']}")
+    status = wait_for_job(job_id)
+    print(f"Final: {status}")
+
+    print("\n3. Job list...")
+    r = requests.get(f"{BASE_URL}/jobs")
+    print(f"Jobs: {[(j['kind'], j['status']) for j in r.json()]}")
+
+if __name__ == "__main__":
+    test_jobs()
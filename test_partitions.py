@@ -0,0 +1,45 @@
+import calendar
+import requests
+
+BASE_URL = "http://127.0.0.1:8000"
+DATASET = "test-partitions"
+
+def get(path, **params):
+    return requests.get(f"{BASE_URL}{path}", params={"dataset": DATASET, **params}).json()
+
+def test_partitions():
+    print("1. Upload testingdata.csv into dataset 'test-partitions'...")
+    with open('testingdata.csv', 'rb') as f:
+        r = requests.post(f"{BASE_URL}/upload", params={"dataset": DATASET},
+                          files={'file': ('testingdata.csv', f, 'text/csv')})
+    print(f"Upload: {r.status_code} - {r.json().get('message')}")
+    partitions = get("/partitions")
+    print(f"Partitions: {[(p['month'], p['records']) for p in partitions]}")
+
+    month = max(partitions, key=lambda p: p['records'])['month']
+    days = calendar.monthrange(int(month[:4]), int(month[5:]))[1]
+    start, end = f"{month}-01", f"{month}-{days}"
+    print(f"\n2. Trends and anomalies for {month} only...")
+    trends = get("/trends/state", start_date=start, end_date=end)
+    low = get("/anomalies", method="threshold", threshold=20, limit=1000, start_date=start, end_date=end)
+    in_range = all(t['date'].startswith(month) for t in trends) and all(a['date'].startswith(month) for a in low['items'])
+    month_total = sum(t['enrolments'] for t in trends)
+    print(f"{len(trends)} trend points totalling {month_total}, {low['total']} low-enrolment rows; all in {month}: {in_range}")
+
+    print(f"\n3. Drop {month}...")
+    before = get("/summary")['total_enrolments']
+    r = requests.delete(f"{BASE_URL}/partitions/{month}", params={"dataset": DATASET})
+    print(f"Drop: {r.status_code} - {r.json()}")
+    after = get("/summary")['total_enrolments']
+    left = [t for t in get("/trends/state") if t['date'].startswith(month)]
+    print(f"Total enrolments {before} -> {after}, {len(left)} trend points left in {month}")
+
+    requests.delete(f"{BASE_URL}/datasets/{DATASET}")
+
+    if in_range and trends and after == before - month_total and not left:
+        print("\nSUCCESS: Date ranges read one month and dropping it removed exactly its data.")
+    else:
+        print("\nFAILURE: Date-range results or the dropped month's totals are wrong.")
+
+if __name__ == "__main__":
+    test_partitions()
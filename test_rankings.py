@@ -0,0 +1,54 @@
+from collections import defaultdict
+import csv
+import requests
+
+BASE_URL = "http://127.0.0.1:8000"
+DATASET = "test-rankings"
+
+def rankings(**params):
+    return requests.get(f"{BASE_URL}/rankings", params={"dataset": DATASET, **params})
+
+def expected(level, by, k, start=None, end=None):
+    # Top k from summing testingdata.csv directly, largest first, ties in name order
+    columns = {"total": ("age_0_5", "age_5_17", "age_18_greater"), "age_0_5": ("age_0_5",)}[by]
+    sums = defaultdict(int)
+    with open('testingdata.csv', newline='') as f:
+        for row in csv.DictReader(f):
+            day = "-".join(reversed(row["date"].split("-")))
+            if (start and day < start) or (end and day > end):
+                continue
+            key = {"state": (row["state"],), "district": (row["state"], row["district"]),
+                   "pincode": (row["pincode"],)}[level]
+            sums[key] += sum(int(row[c]) for c in columns)
+    return sorted(sums.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+def test_rankings():
+    print("1. Upload testingdata.csv into dataset 'test-rankings'...")
+    with open('testingdata.csv', 'rb') as f:
+        r = requests.post(f"{BASE_URL}/upload", params={"dataset": DATASET},
+                          files={'file': ('testingdata.csv', f, 'text/csv')})
+    print(f"Upload: {r.status_code} - {r.json().get('message')}")
+
+    print("\n2. Compare rankings with totals summed from the CSV...")
+    all_match = True
+    for params in ({"level": "state"}, {"level": "district", "by": "age_0_5"}, {"level": "pincode", "k": 5},
+                   {"level": "pincode", "k": 5, "start_date": "2025-10-01", "end_date": "2025-10-31"}):
+        level, by, k = params["level"], params.get("by", "total"), params.get("k", 10)
+        items = rankings(**params).json()
+        got = [(tuple(item[name] for name in item if name != by), item[by]) for item in items]
+        match = got == expected(level, by, k, params.get("start_date"), params.get("end_date"))
+        all_match &= match
+        print(f"{params}: {len(items)} items, top {items[0] if items else None}; match: {match}")
+
+    bad = [rankings(**params).status_code for params in ({"level": "city"}, {"by": "age"}, {"k": 0})]
+    print(f"Invalid level / by / k: {bad}")
+
+    requests.delete(f"{BASE_URL}/datasets/{DATASET}")
+
+    if all_match and bad == [400, 400, 400]:
+        print("\nSUCCESS: Rankings match the totals summed from the CSV.")
+    else:
+        print("\nFAILURE: Rankings differ from the totals summed from the CSV.")
+
+if __name__ == "__main__":
+    test_rankings()
@@ -0,0 +1,66 @@
+import csv
+import os
+import shutil
+import sqlite3
+import tempfile
+
+# A database from before datasets, dimension tables and aggregates lived in
+# ./sql_app.db, which is still where the default dataset starts out
+DATA_DIR = tempfile.mkdtemp()
+os.environ["DATA_DIR"] = DATA_DIR
+
+from app.services import analytics, datasets
+
+BASELINE_SCHEMA = [
+    "CREATE TABLE enrolment_data (id INTEGER NOT NULL, date DATE, state VARCHAR, district VARCHAR, "
+    "pincode VARCHAR, demo_age_0_5 INTEGER, demo_age_5_17 INTEGER, demo_age_17_plus INTEGER, PRIMARY KEY (id))",
+    "CREATE INDEX ix_enrolment_data_id ON enrolment_data (id)",
+    "CREATE INDEX ix_enrolment_data_date ON enrolment_data (date)",
+    "CREATE INDEX ix_enrolment_data_state ON enrolment_data (state)",
+    "CREATE INDEX ix_enrolment_data_district ON enrolment_data (district)",
+    "CREATE INDEX ix_enrolment_data_pincode ON enrolment_data (pincode)",
+]
+
+def write_baseline(path):
+    """testingdata.csv uploaded twice into the baseline schema, which had no natural key. Returns its total."""
+    with open('testingdata.csv', newline='') as f:
+        rows = [("-".join(reversed(row["date"].split("-"))), row["state"], row["district"], row["pincode"],
+                 int(row["age_0_5"]), int(row["age_5_17"]), int(row["age_18_greater"])) for row in csv.DictReader(f)]
+    connection = sqlite3.connect(path)
+    for statement in BASELINE_SCHEMA:
+        connection.execute(statement)
+    for _ in range(2):
+        connection.executemany(
+            "INSERT INTO enrolment_data (date, state, district, pincode, demo_age_0_5, demo_age_5_17, "
+            "demo_age_17_plus) VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+        )
+    connection.commit()
+    connection.close()
+    return len(rows), sum(sum(row[4:]) for row in rows)
+
+def test_upgrade():
+    print("1. Write a baseline sql_app.db with testingdata.csv uploaded twice...")
+    records, total = write_baseline(os.path.join(DATA_DIR, "sql_app.db"))
+
+    print("\n2. Open it, which upgrades it in place...")
+    try:
+        dataset = datasets.get("default")
+    except Exception as e:
+        print(f"\nFAILURE: Upgrading the baseline database failed: {e!r}")
+        shutil.rmtree(DATA_DIR, ignore_errors=True)
+        return
+    with dataset.ReadSessionLocal() as db:
+        summary = analytics.get_overall_summary(db)
+    count = datasets.row_count("default")
+    print(f"Records: {count} (expected {records})")
+    print(f"Summary: {summary} (expected total {total})")
+
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+    if count == records and summary["total_enrolments"] == total:
+        print("\nSUCCESS: The baseline database was upgraded with one row per record.")
+    else:
+        print("\nFAILURE: The upgraded database does not hold the uploaded file once.")
+
+if __name__ == "__main__":
+    test_upgrade()
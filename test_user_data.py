@@ -35,8 +35,11 @@ def test_endpoints():
     print("Age Comparison:", r.json())
 
     # 7. Anomalies
-    r = requests.get(f"{BASE_URL}/anomalies")
-    print("Anomalies:", r.json()[:2])
+    r = requests.get(f"{BASE_URL}/anomalies", params={"limit": 2})
+    print("Anomalies:", r.json()["total"], r.json()["items"])
+
+    r = requests.get(f"{BASE_URL}/anomalies", params={"method": "threshold", "limit": 2})
+    print("Low enrolment rows:", r.json()["total"], r.json()["items"])
 
 if __name__ == "__main__":
     test_endpoints()